@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Created by li huayong on 2020/5/2
+"""
+    标签双仿：完整双线性矩阵（DeepBiaffineScorer）与低秩分解（DeepBiaffineScorer(rank=r)）的对比：
+    （1）参数量
+    （2）训练（ragged打分 + 反向传播）、推理（两阶段推理只对给定位置对打分）的速度，以及CUDA上的峰值显存
+    （3）精度：低秩scorer的全连接层直接复制完整scorer的参数，双线性矩阵用截断SVD得到，
+        比较两者在真实单词位置对上的分数（相对误差）以及预测标签（argmax）的一致率
+    （4）正确性：rank = min(D1, D2)（不截断）时低秩scorer必须复现完整scorer的分数，否则报错
+
+    随机参数的双线性矩阵没有低秩结构，SVD的误差只能作为上界；
+    给出训练好的模型（--checkpoint，即save_pretrained保存的pytorch_model.bin）时使用其中标签双仿的参数：
+        python benchmark_biaffine.py --checkpoint output/xxx/pytorch_model.bin --ranks 16 32 64 128
+    注意：截断SVD只是训练前的参考，正式使用时应该在配置文件中设置 labeled_biaffine_rank 重新训练
+"""
+import argparse
+import time
+
+import torch
+
+from modules.biaffine import DeepBiaffineScorer
+
+# 标签双仿在save_pretrained保存的state_dict中的前缀，参考 models.biaffine_model
+LABELED_BIAFFINE_PREFIX = 'labeled_biaffine.'
+
+
+def count_parameters(module: torch.nn.Module) -> int:
+    return sum(p.numel() for p in module.parameters())
+
+
+def load_full_scorer(args) -> DeepBiaffineScorer:
+    """
+        完整的标签双仿：从checkpoint加载，或者随机初始化（双线性矩阵默认初始化为0，这里改为随机）
+    """
+    if args.checkpoint:
+        state_dict = torch.load(args.checkpoint, map_location='cpu')
+        state_dict = {k[len(LABELED_BIAFFINE_PREFIX):]: v for k, v in state_dict.items()
+                      if k.startswith(LABELED_BIAFFINE_PREFIX)}
+        if 'scorer.W_bilin.weight' not in state_dict:
+            raise RuntimeError(f'{args.checkpoint} 中没有完整的标签双仿参数（direct_biaffine或者已经是低秩的模型）')
+        hidden_dim, input_dim = state_dict['W1.weight'].size()
+        label_num = state_dict['scorer.W_bilin.weight'].size(-1)
+        scorer = DeepBiaffineScorer(input_dim, input_dim, hidden_dim, label_num, pairwise=True)
+        scorer.load_state_dict(state_dict)
+    else:
+        scorer = DeepBiaffineScorer(args.input_dim, args.input_dim, args.hidden_dim, args.label_num, pairwise=True)
+        torch.nn.init.normal_(scorer.scorer.W_bilin.weight, std=args.hidden_dim ** -0.5)
+    return scorer
+
+
+def low_rank_from_full(full_scorer: DeepBiaffineScorer, rank: int) -> DeepBiaffineScorer:
+    scorer = DeepBiaffineScorer(full_scorer.W1.in_features, full_scorer.W2.in_features, full_scorer.W1.out_features,
+                                full_scorer.scorer.W_bilin.output_size, pairwise=True, rank=rank)
+    scorer.W1.load_state_dict(full_scorer.W1.state_dict())
+    scorer.W2.load_state_dict(full_scorer.W2.state_dict())
+    scorer.scorer.W_bilin.load_from_full_weight(full_scorer.scorer.W_bilin.weight)
+    return scorer
+
+
+def random_batch(args, input_dim: int, device):
+    """
+        随机句长的batch（句长在[max_len/4, max_len]之间均匀分布，PAD在句尾），
+        以及每个依存词随机选择一个中心词作为两阶段推理的位置对
+    """
+    lengths = torch.randint(max(1, args.max_len // 4), args.max_len + 1, (args.batch_size,), device=device)
+    inputs = torch.randn(args.batch_size, int(lengths.max()), input_dim, device=device)
+    batch_ids = torch.repeat_interleave(torch.arange(args.batch_size, device=device), lengths)
+    dependents = torch.cat([torch.arange(int(l), device=device) for l in lengths.tolist()])
+    heads = (torch.rand(dependents.size(0), device=device) * lengths[batch_ids].float()).long()
+    return inputs, lengths, torch.stack([batch_ids, dependents, heads])
+
+
+def timeit(func, repeat: int, device) -> float:
+    """
+        平均每次调用的时间（毫秒），先预热一次
+    """
+    func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def peak_memory(func, device) -> float:
+    """
+        一次调用的峰值显存（MB），非CUDA设备返回-1
+    """
+    if device.type != 'cuda':
+        return -1
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    func()
+    torch.cuda.synchronize(device)
+    return (torch.cuda.max_memory_allocated(device) - base) / 1024 ** 2
+
+
+def benchmark(scorer: DeepBiaffineScorer, inputs, lengths, pair_index, args, device) -> dict:
+    scorer = scorer.to(device)
+
+    def train_step():
+        scorer.zero_grad()
+        scores, _ = scorer(inputs, inputs, lengths)
+        scores.sum().backward()
+
+    def pairs_infer():
+        with torch.no_grad():
+            scorer(inputs, inputs, pair_index=pair_index)
+
+    scorer.train()
+    result = {
+        'params': count_parameters(scorer),
+        'train_ms': timeit(train_step, args.repeat, device),
+        'train_mem': peak_memory(train_step, device),
+    }
+    scorer.eval()
+    result['pairs_ms'] = timeit(pairs_infer, args.repeat, device)
+    result['pairs_mem'] = peak_memory(pairs_infer, device)
+    return result
+
+
+@torch.no_grad()
+def parity(full_scorer, low_rank_scorer, inputs, lengths, pair_index) -> dict:
+    full_scorer.eval()
+    low_rank_scorer.eval()
+    full_scores, full_index = full_scorer(inputs, inputs, lengths)
+    low_rank_scores, low_rank_index = low_rank_scorer(inputs, inputs, lengths)
+    assert torch.equal(full_index, low_rank_index)
+    # 两阶段推理的位置对打分与ragged打分中对应位置的分数一致
+    pair_scores = low_rank_scorer(inputs, inputs, pair_index=pair_index)
+    dense_scores = low_rank_scorer(inputs, inputs)[pair_index[0], pair_index[1], pair_index[2]]
+    return {
+        'rel_err': float((low_rank_scores - full_scores).norm() / full_scores.norm().clamp(min=1e-12)),
+        'label_agree': float(torch.eq(low_rank_scores.argmax(-1), full_scores.argmax(-1)).float().mean()),
+        'pairs_rel_diff': float((pair_scores - dense_scores).abs().max() / dense_scores.abs().max().clamp(min=1e-12)),
+    }
+
+
+def check_full_rank(full_scorer, inputs, lengths, pair_index, tolerance: float = 1e-4) -> dict:
+    """
+        不截断的分解（rank = min(D1, D2)）与完整scorer等价：分数的相对误差必须在tolerance之内
+    """
+    bilinear = full_scorer.scorer.W_bilin
+    full_rank_scorer = low_rank_from_full(full_scorer, min(bilinear.input1_size, bilinear.input2_size))
+    result = parity(full_scorer, full_rank_scorer.to(inputs.device), inputs, lengths, pair_index)
+    assert result['rel_err'] < tolerance, f'full rank factorization mismatch: rel err {result["rel_err"]:.2e}'
+    assert result['pairs_rel_diff'] < tolerance, 'full rank factorization: pairs scores mismatch'
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default=None, help='save_pretrained保存的pytorch_model.bin，不给出时随机初始化')
+    parser.add_argument('--input_dim', default=768, type=int, help='encoder输出的维度（随机初始化时使用）')
+    parser.add_argument('--hidden_dim', default=600, type=int, help='biaffine_hidden_dim（随机初始化时使用）')
+    parser.add_argument('--label_num', default=150, type=int, help='标签数量（随机初始化时使用）')
+    parser.add_argument('--ranks', default=[16, 32, 64, 128], type=int, nargs='+', help='比较的低秩分解的秩')
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--max_len', default=64, type=int, help='batch中最长句子的单词数（包含ROOT）')
+    parser.add_argument('--repeat', default=10, type=int, help='计时的重复次数')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seed', default=1234, type=int)
+    cli_args = parser.parse_args()
+    torch.manual_seed(cli_args.seed)
+    device = torch.device(cli_args.device)
+
+    full_scorer = load_full_scorer(cli_args).to(device)
+    inputs, lengths, pair_index = random_batch(cli_args, full_scorer.W1.in_features, device)
+    full_rank_result = check_full_rank(full_scorer, inputs, lengths, pair_index)
+    rows = [('full', benchmark(full_scorer, inputs, lengths, pair_index, cli_args, device), {})]
+    for rank in cli_args.ranks:
+        low_rank_scorer = low_rank_from_full(full_scorer, rank).to(device)
+        rows.append((f'rank={rank}', benchmark(low_rank_scorer, inputs, lengths, pair_index, cli_args, device),
+                     parity(full_scorer, low_rank_scorer, inputs, lengths, pair_index)))
+
+    print(f'device: {device}, batch_size: {cli_args.batch_size}, word num: {int(lengths.sum())}, '
+          f'label num: {full_scorer.scorer.W_bilin.output_size}')
+    print(f'full rank factorization: rel err {full_rank_result["rel_err"]:.2e}, '
+          f'label agree {full_rank_result["label_agree"]:.4f}')
+    print(f'{"scorer":<10}{"params":>12}{"train ms":>10}{"train MB":>10}{"pairs ms":>10}{"pairs MB":>10}'
+          f'{"rel err":>10}{"label agree":>13}')
+    for name, result, parity_result in rows:
+        print(f'{name:<10}{result["params"]:>12,}{result["train_ms"]:>10.2f}{result["train_mem"]:>10.1f}'
+              f'{result["pairs_ms"]:>10.2f}{result["pairs_mem"]:>10.1f}'
+              f'{parity_result.get("rel_err", 0):>10.4f}{parity_result.get("label_agree", 1):>13.4f}')
+        if parity_result:
+            assert parity_result['pairs_rel_diff'] < 1e-3, f'{name}: pairs scores mismatch'
+
+
+if __name__ == '__main__':
+    main()
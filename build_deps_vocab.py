@@ -3,40 +3,159 @@
 """
     在train/test/inference之前必须先建立依存标签的vocab,
     在train/test/inference时应该使用同一份vocab
+
+    同时统计语料的长度分布（字数、单词数、token数），给出推荐的max_seq_len以及按长度分桶的边界，
+    结果保存在 data_dir/corpus_stats.json
 """
-from pathlib import Path
+import argparse
+import json
+import math
 from collections import Counter
-from utils.data.conll_file import load_conllu_file
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+from utils.data.conll_file import FIELD_TO_IDX
+
+# 统计的百分位数
+PERCENTILES = (50, 90, 95, 99, 99.9, 100)
+# create_bert_arrays中除单词之外预留的token数量：[CLS]、[SEP]（RoBERTa两个[SEP]）以及为ROOT等预留的3个位置
+SPECIAL_TOKENS_COUNT = 6
+# ROOT的表示（unused、root、根）占用的token数量
+ROOT_TOKENS_COUNT = 1
+
+_scan_worker_state = {}
+
+
+def _init_scan_worker(tokenizer_path):
+    # 每个进程只加载一次tokenizer
+    if tokenizer_path:
+        from pytorch_transformers import BertTokenizer
+        from utils.data.word_token_cache import WordTokenCache
+        tokenizer = BertTokenizer.from_pretrained(tokenizer_path)
+        _scan_worker_state['token_cache'] = WordTokenCache(tokenizer)
+    else:
+        _scan_worker_state['token_cache'] = None
+
+
+def _iter_sentences(conllu_file):
+    """
+        逐句读取conllu文件（只保留单词行的各列），不会把整个文件读入内存
+    """
+    sent = []
+    with open(str(conllu_file), encoding='utf-8')as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                if sent:
+                    yield sent
+                    sent = []
+                continue
+            if line.startswith('#'):
+                continue
+            cols = line.split('\t')
+            if '-' in cols[0] or '.' in cols[0]:
+                continue
+            sent.append(cols)
+    if sent:
+        yield sent
+
 
+def _scan_file(conllu_file):
+    """
+        流式统计一个文件：依存标签的数量，以及句子长度（字数、单词数、token数）的直方图
+    """
+    token_cache = _scan_worker_state.get('token_cache')
+    deprels = Counter()
+    char_hist, word_hist, token_hist = Counter(), Counter(), Counter()
+    longest = {'char': (0, ''), 'word': (0, '')}
+    for sent in _iter_sentences(conllu_file):
+        words = [cols[FIELD_TO_IDX['word']] for cols in sent]
+        for cols in sent:
+            for arc in cols[FIELD_TO_IDX['deps']].split('|'):
+                if arc != '_':
+                    deprels[arc.split(':')[1]] += 1
+        sentence = ''.join(words)
+        char_hist[len(sentence)] += 1
+        word_hist[len(words)] += 1
+        if token_cache is not None:
+            token_hist[len(token_cache.encode_words(words)[0])] += 1
+        if len(sentence) > longest['char'][0]:
+            longest['char'] = (len(sentence), sentence)
+        if len(words) > longest['word'][0]:
+            longest['word'] = (len(words), sentence)
+    return str(conllu_file), deprels, char_hist, word_hist, token_hist, longest
 
-def build_vocab(data_dir, cutoff=1):
-    deprels = []
+
+def length_stats(hist: Counter, num_buckets: int = 0) -> dict:
+    """
+        由长度直方图计算统计量
+
+    :param hist: {长度: 句子数量}
+    :param num_buckets: >0 时给出等频分桶的边界（每个桶的句子数量大致相同）
+    """
+    if not hist:
+        return {}
+    lengths = np.array(sorted(hist.keys()), dtype=np.int64)
+    counts = np.array([hist[l] for l in lengths], dtype=np.int64)
+    cum_counts = np.cumsum(counts)
+    total = int(cum_counts[-1])
+
+    def _percentile(p):
+        # 至少覆盖p%句子的最小长度
+        return int(lengths[np.searchsorted(cum_counts, math.ceil(total * p / 100))])
+
+    stats = {
+        'sent_num': total,
+        'min': int(lengths[0]),
+        'max': int(lengths[-1]),
+        'mean': float((lengths * counts).sum() / total),
+        'percentiles': {str(p): _percentile(p) for p in PERCENTILES},
+        'histogram': {str(l): int(c) for l, c in zip(lengths.tolist(), counts.tolist())},
+    }
+    if num_buckets > 0:
+        stats['bucket_boundaries'] = sorted({_percentile(100 * k / num_buckets) for k in range(1, num_buckets)})
+    return stats
+
+
+def recommend_max_seq_len(max_token_len: int, multiple: int = 8) -> int:
+    """
+        能容纳最长句子的最小max_seq_len（向上取整到multiple的倍数）
+    """
+    required = max_token_len + ROOT_TOKENS_COUNT + SPECIAL_TOKENS_COUNT
+    return int(math.ceil(required / multiple) * multiple)
+
+
+def build_vocab(data_dir, cutoff=1, worker_num=None, tokenizer_path=None, num_buckets=8):
+    """
+        并行扫描data_dir下所有的conllu文件（每个文件一个任务，逐句流式统计，按文件顺序合并结果），
+        生成 graph_vocab.txt 以及长度统计 corpus_stats.json
+
+    :param data_dir: conllu文件所在目录
+    :param cutoff: 出现次数少于cutoff的依存标签不加入vocab
+    :param worker_num: 并行进程数量，默认为CPU核数
+    :param tokenizer_path: BERT模型（词表）路径，给出时统计token长度，并据此推荐max_seq_len；否则用字数近似
+                           （中文BERT逐字切分，字数与token数基本一致）
+    :param num_buckets: 按长度分桶的桶数量，<=0 则不给出分桶的边界
+    :return: 依存标签的Counter
+    """
     data_dir = Path(data_dir)
-    file_data = []
-    for conllu_file in data_dir.glob("*.conllu"):
-        print(f'Loading {str(conllu_file)} ...')
-        _, _data = load_conllu_file(str(conllu_file))
-        file_data += _data.sentences
-    max_char_length = 0
-    max_word_length = 0
-    max_char_length_sent = ''
-    max_word_length_sent = ''
-    for sent in file_data:
-        words = []
-        for line in sent.words:
-            arcs = line.dep
-            words.append(line.word)
-            arcs = arcs.split('|')
-            for arc in arcs:
-                deprel = arc.split(':')[1]
-                deprels.append(deprel)
-        if len(words) > max_word_length:
-            max_word_length = len(words)
-            max_word_length_sent = ''.join(words)
-        if len(''.join(words)) > max_char_length:
-            max_char_length = len(''.join(words))
-            max_char_length_sent = ''.join(words)
-    counter = Counter(deprels)
+    conllu_files = sorted(data_dir.glob("*.conllu"))
+    counter = Counter()
+    char_hist, word_hist, token_hist = Counter(), Counter(), Counter()
+    longest = {'char': (0, ''), 'word': (0, '')}
+    with Pool(worker_num, initializer=_init_scan_worker, initargs=(tokenizer_path,)) as pool:
+        for file_name, deprels, _char_hist, _word_hist, _token_hist, _longest in \
+                pool.imap(_scan_file, conllu_files):
+            print(f'Loaded {file_name}')
+            counter.update(deprels)
+            char_hist.update(_char_hist)
+            word_hist.update(_word_hist)
+            token_hist.update(_token_hist)
+            for k in longest:
+                if _longest[k][0] > longest[k][0]:
+                    longest[k] = _longest[k]
     for k in list(counter.keys()):
         if counter[k] < cutoff:
             del counter[k]
@@ -45,16 +164,52 @@ def build_vocab(data_dir, cutoff=1):
     with open(str(data_dir / 'graph_vocab.txt'), 'w', encoding='utf-8')as f:
         for u in id2unit:
             f.write(u + '\n')
+
+    length_unit = 'token' if token_hist else 'char'
+    seq_hist = token_hist if token_hist else char_hist
+    stats = {
+        'files': [str(f) for f in conllu_files],
+        'char_length': length_stats(char_hist),
+        'word_length': length_stats(word_hist),
+        'token_length': length_stats(token_hist, num_buckets),
+        'longest_char_sent': longest['char'][1],
+        'longest_word_sent': longest['word'][1],
+    }
+    if seq_hist:
+        seq_stats = length_stats(seq_hist, num_buckets)
+        stats['recommendation'] = {
+            'length_unit': length_unit,
+            # 覆盖所有句子（超过max_seq_len的句子需要滑动窗口编码）
+            'max_seq_len': recommend_max_seq_len(seq_stats['max']),
+            # 覆盖99%的句子
+            'max_seq_len_p99': recommend_max_seq_len(seq_stats['percentiles']['99']),
+            'bucket_boundaries': seq_stats.get('bucket_boundaries', []),
+        }
+    with open(str(data_dir / 'corpus_stats.json'), 'w', encoding='utf-8')as f:
+        json.dump(stats, f, ensure_ascii=False, indent=2)
+
     print(f'max char length sent:')
-    print(max_char_length_sent)
-    print(f'max char length : {max_char_length}')
+    print(longest['char'][1])
+    print(f'max char length : {longest["char"][0]}')
     print(f'max word length sent:')
-    print(max_word_length_sent)
-    print(f'max word length : {max_word_length}')
+    print(longest['word'][1])
+    print(f'max word length : {longest["word"][0]}')
+    if 'recommendation' in stats:
+        print(f'recommended max_seq_len ({length_unit}) : {stats["recommendation"]["max_seq_len"]}')
+        print(f'bucket boundaries ({length_unit}) : {stats["recommendation"]["bucket_boundaries"]}')
+    print(f'corpus stats saved in {str(data_dir / "corpus_stats.json")}')
     return counter
 
 
 if __name__ == '__main__':
     from pprint import pprint
 
-    pprint(build_vocab('dataset/coarse_text'))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_dir', nargs='?', default='dataset/coarse_text', help='conllu文件所在目录')
+    parser.add_argument('--cutoff', default=1, type=int, help='出现次数少于cutoff的依存标签不加入vocab')
+    parser.add_argument('--worker_num', default=None, type=int, help='并行进程数量，默认为CPU核数')
+    parser.add_argument('--tokenizer_path', default=None, help='BERT模型（词表）路径，用于统计token长度')
+    parser.add_argument('--num_buckets', default=8, type=int, help='按长度分桶的桶数量，<=0 则不给出分桶的边界')
+    cli_args = parser.parse_args()
+    pprint(build_vocab(cli_args.data_dir, cutoff=cli_args.cutoff, worker_num=cli_args.worker_num,
+                       tokenizer_path=cli_args.tokenizer_path, num_buckets=cli_args.num_buckets))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Created by li huayong on 2020/4/29
+"""
+    把超出内存的训练语料（例如自动分析得到的大规模语料）预先转换为shard目录，
+    训练时在配置文件中设置 train_shards_dir 即可流式读取（参考 utils.data.sharded_dataset）
+
+    使用训练时相同的配置文件（词表、root_representation、use_pos等必须一致，max_seq_len可以不同）：
+        python build_train_shards.py -c config_files/bert_biaffine.yaml -i silver.conllu -o dataset/silver_shards
+"""
+import argparse
+from types import SimpleNamespace
+
+from utils.arguments import load_configs_from_yaml
+from utils.data.bertology_loader import build_train_shards
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config_file', required=True, help='训练时的yaml配置文件路径')
+    parser.add_argument('-i', '--input_conllu_path', required=True, help='输入的训练语料（CoNLL-U）')
+    parser.add_argument('-o', '--shards_dir', required=True, help='输出的shard目录')
+    parser.add_argument('--shard_size', default=100000, type=int, help='每个shard的句子数量')
+    cli_args = parser.parse_args()
+    args = SimpleNamespace(**load_configs_from_yaml(cli_args.config_file))
+    build_train_shards(args, cli_args.input_conllu_path, cli_args.shards_dir, shard_size=cli_args.shard_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,7 @@ import yaml
 from trainers.bertology_trainer import BERTologyBaseTrainer
 from models.biaffine_model import BiaffineDependencyModel
 from utils.arguments import parse_args
-from utils.data.bertology_loader import load_bertology_input
+from utils.data.bertology_loader import load_bertology_input, load_streaming_inference_input
 from PyToolkit.PyToolkit import Timer, init_logger, get_logger
 from PyToolkit.PyToolkit.seed import set_seed
 
@@ -138,7 +138,11 @@ def train(configs) -> None:
         # 目前仅仅支持BERTology形式的输入
         train_data_loader, _, dev_data_loader, dev_conllu = load_bertology_input(configs)
 
-    logger.info(f'train batch size: {configs.train_batch_size}')
+    train_batch_max_tokens = getattr(configs, 'train_batch_max_tokens', 0)
+    if train_batch_max_tokens > 0:
+        logger.info(f'train batch max {getattr(configs, "batch_length_unit", "token")}s: {train_batch_max_tokens}')
+    else:
+        logger.info(f'train batch size: {configs.train_batch_size}')
     logger.info(f'train data batch num: {len(train_data_loader)}')
     # dev的间隔步数：
     configs.eval_interval = len(train_data_loader) * configs.eval_epoch
@@ -196,8 +200,18 @@ def dev(configs):
 
 
 def inference(configs):
-    if configs.command != 'inference':
+    if configs.command != 'infer':
         raise RuntimeError('Not in inference mode')
+    if configs.streaming:
+        # 流式推理：按chunk读取、预测、写入，内存占用和输入文件的大小无关
+        sent_num, inference_chunks = load_streaming_inference_input(configs)
+        with Timer('load trainer'):
+            trainer = load_trainer(configs)
+        with Timer('inference'):
+            trainer.inference_streaming(inference_chunks, output_conllu_path=configs.output_conllu_path,
+                                        sent_num=sent_num)
+        print(f'INFERENCE output file saved in {configs.output_conllu_path}')
+        return
     inference_data_loader, inference_conllu = load_bertology_input(configs)
     with Timer('load trainer'):
         trainer = load_trainer(configs)
@@ -223,7 +237,7 @@ def main():
     elif configs.command == 'dev':
         dev(configs)
     # 支持训练完成之后立刻在test上测试结果
-    elif configs.command == 'inference':
+    elif configs.command == 'infer':
         inference(configs)
 
 
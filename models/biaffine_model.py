@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # Created by li huayong on 2019/10/7
 
+import torch
 import torch.nn as nn
 
 from utils.data.graph_vocab import GraphVocab
@@ -25,11 +26,14 @@ class BiaffineDependencyModel(BaseModel):
                                             max_seq_len=args.max_seq_len,
                                             bertology_after=args.bertology_after,
                                             after_layers=args.after_layers,
-                                            after_dropout=args.after_dropout)
+                                            after_dropout=args.after_dropout,
+                                            window_stride=getattr(args, 'window_stride', None))
         elif args.encoder_type in ['lstm', 'gru']:
             self.encoder = None  # Do NOT support now #todo
         elif args.encoder_type == 'transformer':
             self.encoder = None  # Do NOT support now #todo
+        # 标签双仿的双线性矩阵低秩分解的秩，0 表示使用完整的双线性矩阵，参考 modules.biaffine.LowRankPairwiseBilinear
+        labeled_biaffine_rank = getattr(args, 'labeled_biaffine_rank', 0) or 0
         if args.direct_biaffine:
             self.unlabeled_biaffine = DirectBiaffineScorer(args.encoder_output_dim,
                                                            args.encoder_output_dim,
@@ -37,7 +41,7 @@ class BiaffineDependencyModel(BaseModel):
             self.labeled_biaffine = DirectBiaffineScorer(args.encoder_output_dim,
                                                          args.encoder_output_dim,
                                                          len(self.graph_vocab.get_labels()),
-                                                         pairwise=True)
+                                                         pairwise=True, rank=labeled_biaffine_rank)
         else:
             self.unlabeled_biaffine = DeepBiaffineScorer(args.encoder_output_dim,
                                                          args.encoder_output_dim,
@@ -49,7 +53,12 @@ class BiaffineDependencyModel(BaseModel):
                                                        args.biaffine_hidden_dim,
                                                        len(self.graph_vocab.get_labels()),
                                                        pairwise=True,
-                                                       dropout=args.biaffine_dropout)
+                                                       dropout=args.biaffine_dropout,
+                                                       rank=labeled_biaffine_rank)
+        # 标签分类只计算真实单词之间的位置对（不计算PAD），参考 modules.biaffine.PairwiseBilinear.forward_ragged
+        # DataParallel会把各个GPU上的输出直接拼接起来（位置对的batch下标无法对应），此时使用dense的计算
+        self.ragged_labeled_scoring = getattr(args, 'ragged_biaffine', False) and \
+                                      not (getattr(args, 'n_gpu', 1) > 1 and getattr(args, 'local_rank', -1) == -1)
         if args.use_pos:
             # todo: support CRF
             self.pos_classifier = nn.Linear(args.encoder_output_dim, args.pos_label_num)
@@ -59,11 +68,41 @@ class BiaffineDependencyModel(BaseModel):
         # else:
         #     self.label_loss_ratio = args.label_loss_ratio
 
+    def forward_unlabeled(self, inputs):
+        """
+            两阶段推理的第一阶段：只计算依存弧（无标签）的分数，
+            解码之后再用score_labels只对预测出的依存弧计算标签分数
+        """
+        assert isinstance(inputs, dict)
+        encoder_output = self.encoder(**inputs)
+        unlabeled_scores = self.unlabeled_biaffine(encoder_output, encoder_output).squeeze(3)
+        return {
+            'unlabeled_scores': unlabeled_scores,
+            'encoder_output': encoder_output,
+            'pos_logits': self.pos_classifier(encoder_output) if self.args.use_pos else None,
+        }
+
+    def score_labels(self, encoder_output, pair_index):
+        """
+            两阶段推理的第二阶段：只计算给定依存弧的标签分数
+        :param encoder_output: forward_unlabeled 的输出
+        :param pair_index: (3 x arc_num)，每条依存弧的 [batch, dependent, head]
+        :return: (arc_num x label_num)
+        """
+        return self.labeled_biaffine(encoder_output, encoder_output, pair_index=pair_index)
+
     def forward(self, inputs):
         assert isinstance(inputs, dict)
         encoder_output = self.encoder(**inputs)
         unlabeled_scores = self.unlabeled_biaffine(encoder_output, encoder_output).squeeze(3)
-        labeled_scores = self.labeled_biaffine(encoder_output, encoder_output)
+        if self.ragged_labeled_scoring:
+            # 单词位置的PAD值为该batch的token长度-1（参考 utils.data.collate.BERTologyCollator）
+            word_lens = torch.ne(inputs['start_pos'], inputs['input_ids'].size(1) - 1).sum(dim=1)
+            # labeled_scores: (pair_num x label_num); labeled_pair_index: (3 x pair_num)
+            labeled_scores, labeled_pair_index = self.labeled_biaffine(encoder_output, encoder_output, word_lens)
+        else:
+            labeled_scores = self.labeled_biaffine(encoder_output, encoder_output)
+            labeled_pair_index = None
         if self.args.use_pos:
             pos_logits = self.pos_classifier(encoder_output)
         else:
@@ -71,5 +110,6 @@ class BiaffineDependencyModel(BaseModel):
         return {
             'unlabeled_scores': unlabeled_scores,
             'labeled_scores': labeled_scores,
+            'labeled_pair_index': labeled_pair_index,
             'pos_logits': pos_logits,
         }
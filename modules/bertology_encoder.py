@@ -44,6 +44,7 @@ class BERTologyEncoder(nn.Module):
             after_layers=0,
             max_seq_len=None,
             after_dropout=0.1,
+            window_stride=None,
             **kwargs,
     ):
         super().__init__()
@@ -61,6 +62,13 @@ class BERTologyEncoder(nn.Module):
         # 注意这里不加载BERT的预训练参数
         # BERT的参数通过Model.from_pretrained方法加载
         self.bertology = self.bertology_model_class(config=self.bertology_config)
+        # max_seq_len为编码窗口的长度：超过该长度的句子切分为互相重叠的窗口编码，参考 _encode_sliding_window
+        assert max_seq_len <= self.bertology_config.max_position_embeddings, \
+            f'max_seq_len不能超过{self.bertology_config.max_position_embeddings}'
+        # 窗口中除[CLS]和[SEP]之外的token数量
+        window_content_len = max_seq_len - 2
+        self.window_stride = window_stride if window_stride and window_stride > 0 else max(1, window_content_len // 2)
+        assert self.window_stride <= window_content_len, 'window_stride不能超过max_seq_len-2'
         self.dropout = nn.Dropout(self.bertology_config.hidden_dropout_prob)
         self.bertology_output_mode = bertology_output_mode
         self.bertology_word_select_mode = bertology_word_select_mode
@@ -83,8 +91,11 @@ class BERTologyEncoder(nn.Module):
         else:
             self.after_encoder = None
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None,
-                position_ids=None, head_mask=None, end_pos=None, start_pos=None):
+    def _encode(self, input_ids, token_type_ids=None, attention_mask=None, position_ids=None, head_mask=None):
+        """
+            BERTology编码，并按照bertology_output_mode组合各层的输出
+        :return: batch X Seq_len X dim
+        """
         bert_outputs = self.bertology(input_ids, position_ids=position_ids,
                                       token_type_ids=token_type_ids,
                                       attention_mask=attention_mask, head_mask=head_mask)
@@ -106,6 +117,87 @@ class BERTologyEncoder(nn.Module):
             encoder_output = self.layer_attention(all_layers_hidden_states, attention_mask)
         else:
             raise Exception('bad bertology output mode')
+        return encoder_output
+
+    def _encode_sliding_window(self, input_ids, token_type_ids, attention_mask, head_mask=None):
+        """
+            超过max_seq_len的batch：把每个句子的正文（[CLS]和[SEP]之间的token）切分为步长为window_stride、互相重叠的窗口，
+            每个窗口前后补上该句子的[CLS]和[SEP]，所有句子的所有窗口在同一个batch中编码，
+            再按照"最大上下文"原则（token在窗口中左右两侧上下文的较小值最大，参考BERT SQuAD的doc_stride）
+            为每个token选择一个窗口的输出，拼接回原来的token序列
+            [CLS]取第一个窗口的输出，[SEP]取最后一个窗口的输出
+
+            较短的句子只有一个窗口，输出和直接编码一致
+        :return: batch X Seq_len X dim
+        """
+        batch_size, seq_len = input_ids.size()
+        device = input_ids.device
+        window_len = self.max_seq_len
+        content_window_len = window_len - 2
+        stride = self.window_stride
+        # 每个句子的token数量（包含[CLS]和[SEP]）以及正文的token数量
+        sent_lens = attention_mask.sum(1).long()
+        content_lens = sent_lens - 2
+        # 每个句子的窗口数量
+        window_nums = ((content_lens - content_window_len).clamp(min=0) + stride - 1) // stride + 1
+        max_window_num = int(window_nums.max())
+        # batch_size X max_window_num
+        window_starts = (torch.arange(max_window_num, device=device) * stride).unsqueeze(0).expand(batch_size, -1)
+        window_exists = torch.arange(max_window_num, device=device).unsqueeze(0) < window_nums.unsqueeze(1)
+        dense_window_lens = torch.min(content_lens.unsqueeze(1) - window_starts,
+                                      torch.full_like(window_starts, content_window_len))
+        dense_window_lens = dense_window_lens.masked_fill(~window_exists, 0)
+
+        # 展平所有有效的窗口：window_num
+        window_sent_ids = torch.arange(batch_size, device=device).unsqueeze(1).expand(-1, max_window_num)[window_exists]
+        starts = window_starts[window_exists]
+        window_lens = dense_window_lens[window_exists]
+        window_num = window_sent_ids.size(0)
+        # 窗口中第j个正文token在原序列中的位置为 1+start+j（超出句子的部分在attention mask中被mask掉）
+        src_pos = (1 + starts.unsqueeze(1) + torch.arange(content_window_len, device=device).unsqueeze(0)) \
+            .clamp(max=seq_len - 1)
+        sep_pos = sent_lens[window_sent_ids] - 1
+        rows = torch.arange(window_num, device=device)
+
+        def _to_windows(t):
+            windows = t.new_zeros(window_num, window_len)
+            windows[:, 0] = t[window_sent_ids, 0]
+            windows[:, 1:window_len - 1] = t[window_sent_ids.unsqueeze(1), src_pos]
+            windows[rows, window_lens + 1] = t[window_sent_ids, sep_pos]
+            return windows
+
+        window_input_ids = _to_windows(input_ids)
+        window_token_type_ids = _to_windows(token_type_ids) if token_type_ids is not None else None
+        window_attention_mask = (torch.arange(window_len, device=device).unsqueeze(0) <
+                                 (window_lens + 2).unsqueeze(1)).to(attention_mask.dtype)
+        # window_num X window_len X dim
+        window_output = self._encode(window_input_ids, window_token_type_ids, window_attention_mask,
+                                     head_mask=head_mask)
+
+        # 最大上下文：batch_size X max_window_num X seq_len
+        token_pos = torch.arange(seq_len, device=device)
+        local_pos = (token_pos - 1).view(1, 1, -1) - window_starts.unsqueeze(2)
+        lens = dense_window_lens.unsqueeze(2)
+        in_window = (local_pos >= 0) & (local_pos < lens)
+        context_score = torch.min(local_pos, lens - 1 - local_pos).float() + 0.01 * lens.float()
+        context_score = context_score.masked_fill(~in_window, -1.)
+        # 不在任何窗口正文中的位置（[CLS]、PAD）取第一个窗口，[SEP]取最后一个窗口
+        best_window = context_score.argmax(dim=1)
+        is_sep = token_pos.unsqueeze(0) == (sent_lens - 1).unsqueeze(1)
+        best_window = torch.where(is_sep, (window_nums - 1).unsqueeze(1).expand_as(best_window), best_window)
+        pos_in_window = (token_pos.unsqueeze(0) - window_starts.gather(1, best_window)).clamp(0, window_len - 1)
+        # 每个句子的第一个窗口在展平之后的下标
+        first_window = torch.cumsum(window_nums, 0) - window_nums
+        flat_window = first_window.unsqueeze(1) + best_window
+        return window_output[flat_window, pos_in_window]
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None,
+                position_ids=None, head_mask=None, end_pos=None, start_pos=None):
+        if input_ids.size(1) > self.max_seq_len:
+            # batch中存在超过编码窗口的句子
+            encoder_output = self._encode_sliding_window(input_ids, token_type_ids, attention_mask, head_mask)
+        else:
+            encoder_output = self._encode(input_ids, token_type_ids, attention_mask, position_ids, head_mask)
         # mask:
         # encoder_output = attention_mask.unsqueeze(-1).to(encoder_output.dtype) * encoder_output
         output_pad_mask = torch.eq(attention_mask, 0)
@@ -124,7 +216,8 @@ class BERTologyEncoder(nn.Module):
         # transformer输入需要attention pad，也就是需要指出哪些是pad的输入
         # 注意这里不能直接使用attention mask作为transformer的输入，这是因为attention mask是原来的字序列的mask
         # 这里我们需要词序列的mask：
-        word_attention_pad_mask = torch.eq(start_pos, self.max_seq_len - 1)
+        # 单词位置的PAD值为（该batch的）token长度-1，参考 utils.data.collate.BERTologyCollator
+        word_attention_pad_mask = torch.eq(start_pos, input_ids.size(1) - 1)
         # 确保pad位置向量为0
         encoder_output *= (1 - word_attention_pad_mask.unsqueeze(-1).type_as(encoder_output))
         if self.after_encoder is not None:
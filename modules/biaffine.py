@@ -8,7 +8,9 @@ class PairwiseBilinear(nn.Module):
     使用版本
     A bilinear module that deals with broadcasting for efficient memory usage.
     Input: tensors of sizes (N x L1 x D1) and (N x L2 x D2)
-    Output: tensor of size (N x L1 x L2 x O)'''
+    Output: tensor of size (N x L1 x L2 x O)
+    注意：forward中没有使用bias（仿射项由 PairwiseBiaffineScorer 在输入后拼接的全1维提供），
+    保留该参数只是为了兼容已有的checkpoint'''
 
     def __init__(self, input1_size, input2_size, output_size, bias=True):
         super().__init__()
@@ -22,7 +24,19 @@ class PairwiseBilinear(nn.Module):
         self.weight = nn.Parameter(torch.Tensor(input1_size, input2_size, output_size))
         self.bias = nn.Parameter(torch.Tensor(output_size)) if bias else 0
 
-    def forward(self, input1, input2):
+    def forward(self, input1, input2, lengths=None, pair_index=None):
+        """
+        :param lengths: 为None时计算所有位置对（包括PAD），输出 (N x L1 x L2 x O)；
+                        否则只计算每个句子前lengths[i]个位置之间的位置对，参考 forward_ragged
+        :param pair_index: 不为None时只计算给定的位置对，参考 forward_pairs
+        """
+        if pair_index is not None:
+            return self.forward_pairs(input1, input2, pair_index)
+        if lengths is not None:
+            return self.forward_ragged(input1, input2, lengths)
+        return self.forward_dense(input1, input2)
+
+    def forward_dense(self, input1, input2):
         input1_size = list(input1.size())
         input2_size = list(input2.size())
         output_size = [input1_size[0], input1_size[1], input2_size[1], self.output_size]
@@ -49,6 +63,135 @@ class PairwiseBilinear(nn.Module):
 
         return output
 
+    def forward_ragged(self, input1, input2, lengths):
+        """
+            只计算真实单词之间的位置对：长度相同的句子组成一组（不需要padding），逐组计算，
+            计算量和显存为 sum(len_i^2) 而不是 N x L^2
+        Input: tensors of sizes (N x L x D1) and (N x L x D2)，lengths (N,)：每个句子的真实长度（PAD在句尾）
+        Output: (scores, pair_index)
+            scores: (P x O)，P = sum(len_i^2)
+            pair_index: (3 x P)，每个位置对在dense输出 (N x L1 x L2 x O) 中的下标 [batch, i (input1), j (input2)]
+        """
+        scores = []
+        pair_index = []
+        for length in torch.unique(lengths).tolist():
+            if length == 0:
+                continue
+            batch_ids = torch.nonzero(torch.eq(lengths, length)).view(-1)
+            group_size = batch_ids.size(0)
+            # 与dense计算完全相同（只是没有PAD）
+            group_scores = self.forward_dense(input1[:, :length][batch_ids], input2[:, :length][batch_ids])
+            scores.append(group_scores.reshape(-1, self.output_size))
+            positions = torch.arange(length, device=input1.device)
+            pair_index.append(torch.stack([
+                batch_ids.view(-1, 1, 1).expand(group_size, length, length).reshape(-1),
+                positions.view(1, -1, 1).expand(group_size, length, length).reshape(-1),
+                positions.view(1, 1, -1).expand(group_size, length, length).reshape(-1),
+            ]))
+        return torch.cat(scores, dim=0), torch.cat(pair_index, dim=1)
+
+    def forward_pairs(self, input1, input2, pair_index):
+        """
+            只计算给定位置对的分数（例如两阶段推理时只对预测出的依存弧计算标签分数），
+            同一个input1位置的中间结果只计算一次，该位置的所有位置对一起用bmm计算
+        Input: tensors of sizes (N x L1 x D1) and (N x L2 x D2)，pair_index (3 x P)：每个位置对的 [batch, i, j]
+        Output: (P x O)，和dense输出中 [batch, i, j] 位置的分数一致
+        """
+        batch_ids, ids1, ids2 = pair_index[0], pair_index[1], pair_index[2]
+        keys = batch_ids * input1.size(1) + ids1
+        unique_keys, inverse = torch.unique(keys, return_inverse=True)
+        # 每个位置对在同一个input1位置的所有位置对中的序号
+        counts = torch.bincount(inverse, minlength=unique_keys.size(0))
+        order = torch.argsort(inverse)
+        group_starts = torch.cumsum(counts, dim=0) - counts
+        ranks = torch.empty_like(inverse)
+        ranks[order] = torch.arange(inverse.size(0), device=inverse.device) - group_starts[inverse[order]]
+        # (U x D1) * (D1 x (D2 x O)) -> (U x O x D2)，与forward中intermediate的view方式一致
+        intermediate = torch.mm(input1.reshape(-1, input1.size(2))[unique_keys],
+                                self.weight.view(-1, self.input2_size * self.output_size))
+        intermediate = intermediate.view(-1, self.output_size, self.input2_size)
+        # U x max_pair_num x D2
+        grouped_input2 = input2.new_zeros(unique_keys.size(0), int(counts.max()), input2.size(2))
+        grouped_input2[inverse, ranks] = input2[batch_ids, ids2]
+        # (U x O x D2) * (U x D2 x max_pair_num) -> (U x O x max_pair_num)
+        output = intermediate.bmm(grouped_input2.transpose(1, 2))
+        return output[inverse, :, ranks]
+
+
+class LowRankPairwiseBilinear(PairwiseBilinear):
+    """
+    低秩分解的PairwiseBilinear：每个标签o的双线性矩阵分解为 W_o = U_o · V_o^T（U_o: D1 x r，V_o: D2 x r），
+    score[i, j, o] = sum_k (x1_i·U_o[:, k]) * (x2_j·V_o[:, k])
+    参数量从 D1 x D2 x O 降为 (D1 + D2) x O x r，
+    中间结果从 (N x L1) x (D2 x O) 降为 (N x L1) x (O x r) 和 (N x L2) x (O x r)
+    Input: tensors of sizes (N x L1 x D1) and (N x L2 x D2)
+    Output: tensor of size (N x L1 x L2 x O)，ragged/pairs的输入输出与 PairwiseBilinear 完全一致
+    与 PairwiseBilinear 的计算方式相同，没有bias
+    """
+
+    def __init__(self, input1_size, input2_size, output_size, rank):
+        # 不调用PairwiseBilinear.__init__，不创建完整的weight
+        nn.Module.__init__(self)
+        assert rank > 0
+        self.input1_size = input1_size
+        self.input2_size = input2_size
+        self.output_size = output_size
+        self.rank = rank
+        self.weight1 = nn.Parameter(torch.Tensor(input1_size, output_size, rank))
+        self.weight2 = nn.Parameter(torch.Tensor(input2_size, output_size, rank))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # 完整的PairwiseBilinear初始化为0；两个因子都为0时梯度也都为0，
+        # 所以只把weight2初始化为0（初始分数仍然全为0），weight1随机初始化
+        nn.init.xavier_uniform_(self.weight1.data.view(self.input1_size, -1))
+        self.weight2.data.zero_()
+
+    @torch.no_grad()
+    def load_from_full_weight(self, weight):
+        """
+            用截断SVD把完整PairwiseBilinear的weight (D1 x D2 x O) 分解为rank-r的因子（用于比较精度损失），
+            rank >= min(D1, D2) 时与完整的PairwiseBilinear等价
+            注意：PairwiseBilinear中标签o的矩阵为 weight.view(D1, O, D2)[:, o, :]，参考 PairwiseBilinear.forward_dense
+        :param weight: PairwiseBilinear.weight
+        """
+        matrices = weight.view(self.input1_size, self.output_size, self.input2_size).permute(1, 0, 2)
+        u, s, v = torch.svd(matrices.float())
+        # rank超过min(D1, D2)时多出的分量为0
+        rank = min(self.rank, s.size(-1))
+        sqrt_s = s[:, :rank].sqrt().unsqueeze(1)
+        self.weight1.data.zero_()
+        self.weight2.data.zero_()
+        # (O x D1 x r) -> (D1 x O x r)
+        self.weight1.data[:, :, :rank] = (u[:, :, :rank] * sqrt_s).permute(1, 0, 2)
+        self.weight2.data[:, :, :rank] = (v[:, :, :rank] * sqrt_s).permute(1, 0, 2)
+
+    def _project(self, inputs, weight):
+        # (M x D) * (D x (O x r)) -> M x O x r
+        return torch.mm(inputs.reshape(-1, inputs.size(-1)), weight.view(weight.size(0), -1)).view(
+            -1, self.output_size, self.rank)
+
+    def forward_dense(self, input1, input2):
+        batch_size, len1, len2 = input1.size(0), input1.size(1), input2.size(1)
+        # (N x L1 x O x r) -> ((N x O) x L1 x r)
+        proj1 = self._project(input1, self.weight1).view(batch_size, len1, self.output_size, self.rank)
+        proj1 = proj1.permute(0, 2, 1, 3).reshape(-1, len1, self.rank)
+        # (N x L2 x O x r) -> ((N x O) x r x L2)
+        proj2 = self._project(input2, self.weight2).view(batch_size, len2, self.output_size, self.rank)
+        proj2 = proj2.permute(0, 2, 3, 1).reshape(-1, self.rank, len2)
+        # ((N x O) x L1 x L2) -> (N x L1 x L2 x O)
+        output = proj1.bmm(proj2).view(batch_size, self.output_size, len1, len2)
+        return output.permute(0, 2, 3, 1)
+
+    def forward_pairs(self, input1, input2, pair_index):
+        """
+            每个位置对只需要 O x r 次乘加，不需要分组
+        """
+        batch_ids, ids1, ids2 = pair_index[0], pair_index[1], pair_index[2]
+        proj1 = self._project(input1[batch_ids, ids1], self.weight1)
+        proj2 = self._project(input2[batch_ids, ids2], self.weight2)
+        return (proj1 * proj2).sum(dim=-1)
+
 
 class BiaffineScorer(nn.Module):
     def __init__(self, input1_size, input2_size, output_size):
@@ -72,12 +215,13 @@ class BiaffineScorer(nn.Module):
 
 
 class PairwiseBiaffineScorer(nn.Module):
-    def __init__(self, input1_size, input2_size, output_size):
+    def __init__(self, input1_size, input2_size, output_size, rank=0):
         """
         使用版本
         :param input1_size:
         :param input2_size:
         :param output_size:双仿的分类空间
+        :param rank: >0 时使用低秩分解的双线性矩阵，参考 LowRankPairwiseBilinear
         """
         super().__init__()
         # 为什么+1:
@@ -90,35 +234,45 @@ class PairwiseBiaffineScorer(nn.Module):
         #       bmm-> [batch_size, (seq_len*output_size), seq_len]
         # [batch_size, (seq_len*output_size), seq_len]
         #       view-> [batch_size, seq_len, seq_len, output_size]
-        self.W_bilin = PairwiseBilinear(input1_size + 1, input2_size + 1, output_size)
+        if rank > 0:
+            self.W_bilin = LowRankPairwiseBilinear(input1_size + 1, input2_size + 1, output_size, rank)
+        else:
+            self.W_bilin = PairwiseBilinear(input1_size + 1, input2_size + 1, output_size)
 
-        self.W_bilin.weight.data.zero_()
-        self.W_bilin.bias.data.zero_()
+            self.W_bilin.weight.data.zero_()
+            self.W_bilin.bias.data.zero_()
 
-    def forward(self, input1, input2):
+    def forward(self, input1, input2, lengths=None, pair_index=None):
         # input1 size：[batch_size, seq_len, feature_size]
         # input1.new_ones(*input1.size()[:-1], 1)'s size: [batch_size, seq_len, 1]
         input1 = torch.cat([input1, input1.new_ones(*input1.size()[:-1], 1)], len(input1.size()) - 1)
         # 拼接后的size:[batch_size, seq_len, (feature_size+1)]
         input2 = torch.cat([input2, input2.new_ones(*input2.size()[:-1], 1)], len(input2.size()) - 1)
-        return self.W_bilin(input1, input2)
+        # lengths不为None时返回 (scores, pair_index)，参考 PairwiseBilinear.forward_ragged
+        # pair_index不为None时只计算给定的位置对，参考 PairwiseBilinear.forward_pairs
+        return self.W_bilin(input1, input2, lengths, pair_index)
 
 
 class DirectBiaffineScorer(nn.Module):
-    def __init__(self, input1_size, input2_size, output_size, pairwise=True):
+    def __init__(self, input1_size, input2_size, output_size, pairwise=True, rank=0):
         super().__init__()
         if pairwise:
-            self.scorer = PairwiseBiaffineScorer(input1_size, input2_size, output_size)
+            self.scorer = PairwiseBiaffineScorer(input1_size, input2_size, output_size, rank)
         else:
+            assert rank == 0, 'low rank biaffine only support pairwise scorer'
             self.scorer = BiaffineScorer(input1_size, input2_size, output_size)
+        self.pairwise = pairwise
 
-    def forward(self, input1, input2):
-        return self.scorer(input1, input2)
+    def forward(self, input1, input2, lengths=None, pair_index=None):
+        if lengths is None and pair_index is None:
+            return self.scorer(input1, input2)
+        assert self.pairwise, 'ragged scoring only support pairwise scorer'
+        return self.scorer(input1, input2, lengths, pair_index)
 
 
 class DeepBiaffineScorer(nn.Module):
     def __init__(self, input1_size, input2_size, hidden_size, output_size, hidden_func=F.relu, dropout=0,
-                 pairwise=True):
+                 pairwise=True, rank=0):
         """
         使用版本
         :param input1_size:
@@ -128,6 +282,7 @@ class DeepBiaffineScorer(nn.Module):
         :param hidden_func:
         :param dropout:
         :param pairwise:
+        :param rank: >0 时双仿使用低秩分解的双线性矩阵（只支持pairwise），参考 LowRankPairwiseBilinear
         """
         super().__init__()
         # 先对输入做两个线性变换得到两个H_dep、H_head
@@ -136,15 +291,26 @@ class DeepBiaffineScorer(nn.Module):
         # 默认经过relu激活函数：
         self.hidden_func = hidden_func
         if pairwise:
-            self.scorer = PairwiseBiaffineScorer(hidden_size, hidden_size, output_size)
+            self.scorer = PairwiseBiaffineScorer(hidden_size, hidden_size, output_size, rank)
         else:
+            assert rank == 0, 'low rank biaffine only support pairwise scorer'
             self.scorer = BiaffineScorer(hidden_size, hidden_size, output_size)
+        self.pairwise = pairwise
         # 进入双仿前dropout:
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, input1, input2):
-        return self.scorer(self.dropout(self.hidden_func(self.W1(input1))),
-                           self.dropout(self.hidden_func(self.W2(input2))))
+    def forward(self, input1, input2, lengths=None, pair_index=None):
+        """
+        :param lengths: 每个句子的真实长度，不为None时只计算真实单词之间的位置对，
+                        返回 (scores, pair_index)，参考 PairwiseBilinear.forward_ragged
+        :param pair_index: (3 x P) 不为None时只计算给定的位置对，返回 (P x O)，参考 PairwiseBilinear.forward_pairs
+        """
+        input1 = self.dropout(self.hidden_func(self.W1(input1)))
+        input2 = self.dropout(self.hidden_func(self.W2(input2)))
+        if lengths is None and pair_index is None:
+            return self.scorer(input1, input2)
+        assert self.pairwise, 'ragged scoring only support pairwise scorer'
+        return self.scorer(input1, input2, lengths, pair_index)
 
 
 if __name__ == "__main__":
@@ -2,16 +2,18 @@
 # Created by li huayong on 2019/9/28
 import os
 import re
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import TensorDataset
 from tqdm import tqdm, trange
 from abc import ABCMeta, abstractmethod
 from typing import Dict, List, Tuple
-from utils.data.conll_file import CoNLLFile
+from utils.data.conll_file import CoNLLFile, CoNLLUWriter
 from utils.data.graph_vocab import GraphVocab
+from utils.data.prefetcher import DevicePrefetcher
 from utils.model.get_optimizer import get_optimizer
-from utils.model.parser_funs import sdp_decoder, parse_semgraph
+from utils.model.parser_funs import sdp_decoder_from_heads, sdp_decoder_heads
 import utils.model.sdp_simple_scorer as sdp_scorer
 from utils.best_result import BestResult
 from utils.model.label_smoothing import label_smoothed_kl_div_loss
@@ -63,17 +65,33 @@ class BaseDependencyTrainer(metaclass=ABCMeta):
         """
         pass
 
+    @staticmethod
+    def _set_data_loader_epoch(data_loader, epoch: int):
+        """
+            DistributedSampler、BucketBatchSampler等需要在每个epoch开始时调用set_epoch，以重新打乱数据
+            （DistributedSampler可能被BatchSampler包装，参考 utils.data.bertology_loader.get_data_loader；
+            流式读取的ShardedIterableDataset在dataset内部打乱）
+        """
+        for sampler in (data_loader.sampler, data_loader.batch_sampler,
+                        getattr(data_loader.sampler, 'sampler', None), data_loader.dataset):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+
     def _update_and_predict(self, unlabeled_scores, labeled_scores, unlabeled_target, labeled_target, word_pad_mask,
                             label_loss_ratio=0.5, sentence_lengths=None,
                             calc_loss=True, update=True, calc_prediction=False,
                             pos_logits=None, pos_target=None, pos_loss_ratio=1.0,
-                            summary_writer=None, global_step=None):
+                            summary_writer=None, global_step=None, labeled_pair_index=None):
         """
             针对一个batch输入：计算loss，反向传播，计算预测结果
             :param word_pad_mask: 以word为单位，1为PAD，0为真实输入
+            :param labeled_pair_index: 不为None时labeled_scores只包含真实单词之间的位置对 (pair_num x label_num)，
+                                       labeled_pair_index (3 x pair_num) 为每个位置对的 [batch, dependent, head] 下标，
+                                       参考 modules.biaffine.PairwiseBilinear.forward_ragged
         :return:
         """
-        weights = torch.ones(word_pad_mask.size(0), self.configs.max_seq_len, self.configs.max_seq_len,
+        # 动态padding：单词维度由batch内最长的句子决定，而不是max_seq_len
+        weights = torch.ones(word_pad_mask.size(0), word_pad_mask.size(1), word_pad_mask.size(1),
                              dtype=unlabeled_scores.dtype,
                              device=unlabeled_scores.device)
         # 将PAD的位置权重设为0，其余位置为1
@@ -89,10 +107,12 @@ class BaseDependencyTrainer(metaclass=ABCMeta):
             dep_arc_loss = dep_arc_loss_func(unlabeled_scores, unlabeled_target)
 
             dep_label_loss_func = nn.CrossEntropyLoss(ignore_index=-1, reduction='sum')
+            if labeled_pair_index is not None:
+                labeled_target = labeled_target[labeled_pair_index[0], labeled_pair_index[1], labeled_pair_index[2]]
             dependency_mask = labeled_target.eq(0)
             labeled_target = labeled_target.masked_fill(dependency_mask, -1)
-            labeled_scores = labeled_scores.contiguous().view(-1, len(self.graph_vocab.get_labels()))
-            dep_label_loss = dep_label_loss_func(labeled_scores, labeled_target.view(-1))
+            dep_label_loss = dep_label_loss_func(
+                labeled_scores.contiguous().view(-1, len(self.graph_vocab.get_labels())), labeled_target.view(-1))
 
             if self.configs.use_pos:
                 assert pos_logits is not None
@@ -149,15 +169,18 @@ class BaseDependencyTrainer(metaclass=ABCMeta):
             loss = None
         if calc_prediction:
             assert sentence_lengths
-            weights = weights.unsqueeze(3)
-            head_probs = torch.sigmoid(unlabeled_scores).unsqueeze(3)
-            label_probs = torch.softmax(labeled_scores, dim=3)
-            batch_probs = head_probs * label_probs * weights
-            batch_probs = batch_probs.detach().cpu().numpy()
-            # debug_print(batch_probs)
-            sem_graph = sdp_decoder(batch_probs, sentence_lengths)
-            sem_sents = parse_semgraph(sem_graph, sentence_lengths)
-            batch_prediction = self.graph_vocab.parse_to_sent_batch(sem_sents)
+            # 解码只需要依存弧的概率以及每个位置对概率最大的标签（不需要把 batch x L x L x label_num 的概率拷贝到CPU）
+            # 标签的概率之和为1，所以 sum(head_prob * label_probs) = head_prob；argmax(softmax) = argmax(logits)
+            head_probs = (torch.sigmoid(unlabeled_scores) * weights).detach().cpu().numpy()
+            if labeled_pair_index is not None:
+                label_preds = torch.zeros_like(weights, dtype=torch.long)
+                label_preds[labeled_pair_index[0], labeled_pair_index[1], labeled_pair_index[2]] = \
+                    labeled_scores.argmax(dim=-1)
+            else:
+                label_preds = labeled_scores.argmax(dim=3)
+            sem_graph = sdp_decoder_from_heads(head_probs, label_preds.cpu().numpy(), sentence_lengths)
+            # 每个单词的 (head, deprel, deps)，可以直接写入conllu文件
+            batch_prediction = self.graph_vocab.graph_to_arcs_batch(sem_graph, sentence_lengths)
         else:
             batch_prediction = None
         return loss, batch_prediction
@@ -173,13 +196,15 @@ class BaseDependencyTrainer(metaclass=ABCMeta):
             summary_writer = SummaryWriter(log_dir=self.configs.summary_dir)
         for epoch in range(1, self.configs.max_train_epochs + 1):
             epoch_ave_loss = 0
-            train_data_loader = tqdm(train_data_loader, desc=f'Training epoch {epoch}',
-                                     disable=self.configs.local_rank not in [-1, 0])
+            self._set_data_loader_epoch(train_data_loader, epoch)
+            # 下一个batch在当前step计算时异步拷贝到device
+            epoch_iterator = tqdm(DevicePrefetcher(train_data_loader, self.configs.device),
+                                  desc=f'Training epoch {epoch}',
+                                  disable=self.configs.local_rank not in [-1, 0])
             # 某些模型在训练时可能需要一些定制化的操作，默认什么都不做
             # 具体参考子类中_custom_train_operations的实现
             self._custom_train_operations(epoch)
-            for step, batch in enumerate(train_data_loader):
-                batch = tuple(t.to(self.configs.device) for t in batch)
+            for step, batch in enumerate(epoch_iterator):
                 self.model.train()
                 # debug_print(batch)
                 # word_mask:以word为单位，1为真实输入，0为PAD
@@ -201,6 +226,7 @@ class BaseDependencyTrainer(metaclass=ABCMeta):
                                                    # label_loss_ratio=self.model.module.label_loss_ratio if hasattr(self.model,'module') else self.model.label_loss_ratio,
                                                    calc_loss=True, update=True, calc_prediction=False,
                                                    pos_logits=pos_logits, pos_target=pos_target,
+                                                   labeled_pair_index=model_output['labeled_pair_index'],
                                                    summary_writer=summary_writer if self.configs.local_rank in [-1,
                                                                                                                 0] else None,
                                                    global_step=global_step)
@@ -257,11 +283,10 @@ class BaseDependencyTrainer(metaclass=ABCMeta):
             input_conllu_path = os.path.join(self.configs.data_dir, self.configs.dev_file)
         if output_conllu_path is None:
             output_conllu_path = self.configs.dev_output_path if not self.configs.no_output else None
-        dev_data_loader = tqdm(dev_data_loader, desc='Evaluation')
+        dev_data_loader = tqdm(DevicePrefetcher(dev_data_loader, self.configs.device), desc='Evaluation')
         predictions = []
         for step, batch in enumerate(dev_data_loader):
             self.model.eval()
-            batch = tuple(t.to(self.configs.device) for t in batch)
             unpacked_batch = self._unpack_batch(batch)
             """
             unpacked_batch = {
@@ -274,6 +299,10 @@ class BaseDependencyTrainer(metaclass=ABCMeta):
             """
             inputs, word_mask, sent_lens, dep_ids = unpacked_batch['inputs'], unpacked_batch['word_mask'], \
                                                     unpacked_batch['sent_len'], unpacked_batch['dep_ids']
+            if getattr(self.configs, 'two_stage_inference', False):
+                with torch.no_grad():
+                    predictions += self._two_stage_predict(unpacked_batch)
+                continue
             word_mask = torch.eq(word_mask, 0)
             model_output = self.model(inputs)
             unlabeled_scores, labeled_scores = model_output['unlabeled_scores'], model_output['labeled_scores']
@@ -283,49 +312,95 @@ class BaseDependencyTrainer(metaclass=ABCMeta):
                                                                    word_mask,
                                                                    # label_loss_ratio=self.model.module.label_loss_ratio if hasattr(self.model,'module') else self.model.label_loss_ratio,
                                                                    sentence_lengths=sent_lens,
-                                                                   calc_loss=False, update=False, calc_prediction=True)
+                                                                   calc_loss=False, update=False, calc_prediction=True,
+                                                                   labeled_pair_index=model_output['labeled_pair_index'])
             except Exception as e:
                 for b in batch:
                     print(b.shape)
                 raise e
             predictions += batch_prediction
             # batch_sent_lens += sent_lens
-        dev_CoNLLU_file.set(['deps'], [dep for sent in predictions for dep in sent])
         if output_conllu_path:
-            dev_CoNLLU_file.write_conll(output_conllu_path)
+            dev_CoNLLU_file.write_conll(output_conllu_path, arcs=predictions)
         UAS, LAS = sdp_scorer.score(output_conllu_path, input_conllu_path)
         return UAS, LAS
 
-    def inference(self, inference_data_loader, inference_CoNLLU_file, output_conllu_path):
-        inference_data_loader = tqdm(inference_data_loader, desc='Inference')
+    def _predict(self, data_loader, desc=None):
+        """
+            逐个batch预测，按输入顺序返回每个句子的预测结果（每个单词的 (head, deprel, deps)）
+        :param desc: 不为None时显示进度条
+        """
+        self.model.eval()
         predictions = []
-        for step, batch in enumerate(inference_data_loader):
-            self.model.eval()
-            unpacked_batch = self._unpack_batch(batch)
-            """
-            unpacked_batch = {
-                    'inputs': inputs,
-                    'word_mask': word_mask,
-                    'sent_len': sent_len,
-                    'dep_ids': dep_ids,
-                    'pos_ids': pos_ids,
-                }
-            """
-            inputs, word_mask, sent_lens, _ = unpacked_batch['inputs'], unpacked_batch['word_mask'], \
-                                              unpacked_batch['sent_len'], unpacked_batch['dep_ids']
-            word_mask = torch.eq(word_mask, 0)
-            model_output = self.model(inputs)
-            unlabeled_scores, labeled_scores = model_output['unlabeled_scores'], model_output['labeled_scores']
-            with torch.no_grad():
+        with torch.no_grad():
+            for batch in tqdm(DevicePrefetcher(data_loader, self.configs.device), desc=desc, disable=desc is None):
+                unpacked_batch = self._unpack_batch(batch)
+                if getattr(self.configs, 'two_stage_inference', False):
+                    predictions += self._two_stage_predict(unpacked_batch)
+                    continue
+                inputs, word_mask, sent_lens = unpacked_batch['inputs'], unpacked_batch['word_mask'], \
+                                               unpacked_batch['sent_len']
+                word_mask = torch.eq(word_mask, 0)
+                model_output = self.model(inputs)
+                unlabeled_scores, labeled_scores = model_output['unlabeled_scores'], model_output['labeled_scores']
                 _, batch_prediction = self._update_and_predict(unlabeled_scores, labeled_scores, None, None, word_mask,
-                                                               # label_loss_ratio=self.model.label_loss_ratio if not self.args.data_paralle else self.model.module.label_loss_ratio,
                                                                sentence_lengths=sent_lens,
-                                                               calc_loss=False, update=False, calc_prediction=True)
-            predictions += batch_prediction
-        inference_CoNLLU_file.set(['deps'], [dep for sent in predictions for dep in sent])
-        inference_CoNLLU_file.write_conll(output_conllu_path)
+                                                               calc_loss=False, update=False, calc_prediction=True,
+                                                               labeled_pair_index=model_output['labeled_pair_index'])
+                predictions += batch_prediction
         return predictions
 
+    def _two_stage_predict(self, unpacked_batch):
+        """
+            两阶段推理（需要在torch.no_grad()下调用）：
+            （1）只计算依存弧（无标签）的分数并解码，得到预测出的依存弧
+            （2）只对预测出的依存弧计算标签分数（arc_num x label_num），而不是所有位置对（batch x L x L x label_num）
+            结果和一次计算所有分数之后再解码一致
+
+        :return: 每个句子每个单词的 (head, deprel, deps)
+        """
+        model = self.model.module if hasattr(self.model, 'module') else self.model
+        inputs, sent_lens = unpacked_batch['inputs'], unpacked_batch['sent_len']
+        word_pad_mask = torch.eq(unpacked_batch['word_mask'], 0)
+        model_output = model.forward_unlabeled(inputs)
+        head_probs = torch.sigmoid(model_output['unlabeled_scores'])
+        head_probs = head_probs.masked_fill(word_pad_mask.unsqueeze(1), 0).masked_fill(word_pad_mask.unsqueeze(2), 0)
+        head_preds = sdp_decoder_heads(head_probs.cpu().numpy(), sent_lens)
+        # [b, dependent, head] 为 标签id+1，0表示没有依存弧（与sdp_decoder的结果一致）
+        sem_graph = np.zeros(head_preds.shape, dtype=np.int64)
+        arcs = np.nonzero(head_preds)
+        if len(arcs[0]):
+            pair_index = torch.from_numpy(np.stack(arcs).astype(np.int64)).to(model_output['encoder_output'].device)
+            label_scores = model.score_labels(model_output['encoder_output'], pair_index)
+            sem_graph[arcs] = label_scores.argmax(dim=-1).cpu().numpy() + 1
+        return self.graph_vocab.graph_to_arcs_batch(sem_graph, sent_lens)
+
+    def inference(self, inference_data_loader, inference_CoNLLU_file, output_conllu_path):
+        predictions = self._predict(inference_data_loader, desc='Inference')
+        inference_CoNLLU_file.write_conll(output_conllu_path, arcs=predictions)
+        return predictions
+
+    def inference_streaming(self, inference_chunks, output_conllu_path, sent_num=None):
+        """
+            流式推理：逐个chunk预测，并按输入顺序把预测好的句子追加写入输出文件，
+            不保存所有的预测结果，峰值内存和输入文件的大小无关
+
+        :param inference_chunks: 生成器，每个元素为 (batches, sents)，batches为该chunk padding之后的batch列表，
+                                 参考 utils.data.bertology_loader.load_streaming_inference_input
+        :param output_conllu_path: 输出文件
+        :param sent_num: 句子总数，仅用于显示进度
+        :return: 预测的句子数量
+        """
+        done_num = 0
+        with CoNLLUWriter(output_conllu_path) as writer, \
+                tqdm(total=sent_num, desc='Inference', unit='sent') as progress:
+            for batches, sents in inference_chunks:
+                writer.write_sentences(sents, self._predict(batches))
+                writer.flush()
+                done_num += len(sents)
+                progress.update(len(sents))
+        return done_num
+
 
 class TransformerBaseTrainer(BaseDependencyTrainer):
     def _unpack_batch(self, batch):
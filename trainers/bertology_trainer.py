@@ -30,7 +30,8 @@ class BERTologyBaseTrainer(BaseDependencyTrainer):
         if self.configs.use_pos:
             pos_ids = batch[6]
         # word_mask:以word为单位，1为真实输入，0为PAD
-        word_mask = (batch[3] != (self.configs.max_seq_len - 1)).to(torch.long).to(self.configs.device)
+        # 动态padding下，单词位置的PAD值为该batch的token长度-1（参考 utils.data.collate.BERTologyCollator）
+        word_mask = (batch[3] != (batch[0].size(1) - 1)).to(torch.long).to(self.configs.device)
         sent_len = torch.sum(word_mask, 1).cpu().tolist()
         unpacked_batch = {
             'inputs': inputs,
@@ -61,9 +61,14 @@ def parse_args() -> SimpleNamespace:
                                          help='输入CONLL-U文件，dev模式下是一个gold file，infer模式下是一个空conllu file')
     dev_infer_parent_parser.add_argument('-o', '--output_conllu_path', required=True, help='dev或者infer的输出文件路径')
     dev_infer_parent_parser.add_argument('-b', '--batch_size', default=5, type=int, help='dev或者infer时刻的batch大小')
+    dev_infer_parent_parser.add_argument('--two_stage_inference', action='store_true', default=False,
+                                         help='两阶段推理：先预测依存弧，再只对预测出的依存弧计算标签分数（结果不变，速度更快）')
     # -----------------------再处理dev和infer各自的参数（如果有）--------------------------------------------
     parser_dev = subparsers.add_parser('dev', help='验证模式', parents=[dev_infer_parent_parser])
     parser_infer = subparsers.add_parser('infer', help='推理模式', parents=[dev_infer_parent_parser])
+    parser_infer.add_argument('--streaming', action='store_true', default=False,
+                              help='流式推理：按chunk读取、预测并写入结果，适用于无法一次性读入内存的大文件')
+    parser_infer.add_argument('--stream_chunk_size', default=10000, type=int, help='流式推理时每个chunk的句子数量')
     # --------------------------------------------------------------------------------------------------
 
     configs = vars(parser.parse_args())
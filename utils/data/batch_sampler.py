@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Created by li huayong on 2020/4/25
+import math
+from typing import List
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def get_dist_info(num_replicas=None, rank=None):
+    """
+        获取分布式训练下的进程数量和当前进程的rank，非分布式训练时为(1, 0)
+    """
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+    if rank is None:
+        rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+    return num_replicas, rank
+
+
+class BucketBatchSampler(Sampler):
+    r"""
+    按照累计句长划分batch：
+    （1）先按照 句长 + U(0, length_noise) 排序，使得同一个batch内的句子长度相近，
+        同时句长相差不超过length_noise的句子之间随机打乱，每个epoch的batch由不同的句子组成
+    （2）依次往batch中填入句子，直到 batch内最长句长 x 句子数量（即padding之后的大小）超过max_tokens
+    （3）最后打乱batch的顺序
+    batch的数量在各个epoch之间略有不同：__len__给出当前epoch（set_epoch之后）准确的batch数量，
+    epoch 0 的batch数量可作为steps per epoch的估计（学习率的warmup依赖于max_train_steps）
+
+    分布式训练时，所有进程使用相同的随机种子划分batch，然后每个进程各取一部分batch
+    （batch数量不能整除进程数时，重复使用开头的batch补齐）
+    注意：每个epoch开始时需要调用set_epoch以重新打乱
+    """
+
+    def __init__(self, lengths, max_tokens: int, shuffle: bool = True, seed: int = 0,
+                 num_replicas: int = None, rank: int = None, length_noise: float = None):
+        """
+
+        :param lengths: 每个样本的长度（token数量或者单词数量）
+        :param max_tokens: 每个batch的（padding之后的）长度预算，单个句子超过预算时单独成为一个batch
+        :param shuffle: 是否打乱
+        :param length_noise: 排序时加在句长上的随机噪声的上界，默认为平均句长的10%，0表示只打乱句长相同的句子
+        :param seed: 随机种子，和epoch一起决定打乱的顺序
+        :param num_replicas: 分布式训练的进程数量，默认自动获取
+        :param rank: 当前进程的rank，默认自动获取
+        """
+        super().__init__(None)
+        assert max_tokens > 0
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        if length_noise is None:
+            length_noise = 0.1 * float(self.lengths.mean()) if len(self.lengths) else 0
+        self.length_noise = length_noise
+        self.num_replicas, self.rank = get_dist_info(num_replicas, rank)
+        self._batches = None
+        self.set_epoch(0)
+
+    def _make_batches(self, sorted_indices) -> List[List[int]]:
+        batches = []
+        batch = []
+        batch_max_len = 0
+        lengths = self.lengths.tolist()
+        for idx in sorted_indices.tolist():
+            length = lengths[idx]
+            new_max_len = max(batch_max_len, length)
+            if batch and new_max_len * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                new_max_len = length
+            batch.append(idx)
+            batch_max_len = new_max_len
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _plan_epoch(self) -> List[List[int]]:
+        """
+            划分当前epoch的batch（所有进程的划分相同）
+        """
+        rng = np.random.RandomState(self.seed + self.epoch)
+        if self.shuffle:
+            # 主键为 句长+有界噪声，次键为随机数（噪声为0时句长相同的句子之间也随机打乱）
+            tie_breaker = rng.random_sample(len(self.lengths))
+            noisy_lengths = self.lengths + rng.uniform(0, self.length_noise, len(self.lengths))
+            sorted_indices = np.lexsort((tie_breaker, noisy_lengths))
+        else:
+            sorted_indices = np.argsort(self.lengths, kind='stable')
+        batches = self._make_batches(sorted_indices)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self._batches = self._plan_epoch()
+        self.batch_num = len(self._batches)
+        self.num_batches_per_replica = int(math.ceil(self.batch_num / self.num_replicas))
+
+    def __iter__(self):
+        batches = list(self._batches)
+        # 补齐到进程数量的整数倍
+        total_size = self.num_batches_per_replica * self.num_replicas
+        while len(batches) < total_size:
+            batches += batches[:total_size - len(batches)]
+        return iter(batches[self.rank:total_size:self.num_replicas])
+
+    def __len__(self):
+        return self.num_batches_per_replica
+
+
+class MixtureBatchSampler(Sampler):
+    r"""
+    多个源（例如text和news）按概率混合采样的batch sampler，数据集为这些源的 torch.utils.data.ConcatDataset：
+    （1）每个epoch开始时一次性规划整个epoch的采样序列：先按概率（向量化地）抽取每个位置的源，
+        再在每个源内部按随机排列依次取样（一个源的样本全部用完之后才会重复）
+    （2）分布式训练时，所有进程使用相同的随机种子得到相同的规划，然后按rank交错划分，各个进程之间没有重复的样本
+    （3）每个epoch开始时需要调用set_epoch
+    """
+
+    def __init__(self, source_lengths: List[int], probs, batch_size: int, num_samples: int = None,
+                 seed: int = 0, num_replicas: int = None, rank: int = None):
+        """
+
+        :param source_lengths: 每个源的数据量（和ConcatDataset中的顺序一致）
+        :param probs: 每个源的采样概率，参考 utils.data.custom_dataset.get_mixture_probs
+        :param batch_size: 每个进程的batch大小
+        :param num_samples: 每个epoch（所有进程）采样的总数量，默认为 sum(源数据量 x 源概率)
+        :param seed: 随机种子，和epoch一起决定采样序列
+        :param num_replicas: 分布式训练的进程数量，默认自动获取
+        :param rank: 当前进程的rank，默认自动获取
+        """
+        super().__init__(None)
+        assert len(source_lengths) == len(probs) and min(source_lengths) > 0
+        self.source_lengths = np.asarray(source_lengths, dtype=np.int64)
+        self.source_offsets = np.concatenate([[0], np.cumsum(self.source_lengths)[:-1]])
+        self.probs = np.asarray(probs, dtype=np.float64) / np.sum(probs)
+        self.batch_size = batch_size
+        if num_samples is None:
+            num_samples = int(np.sum(self.source_lengths * self.probs))
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas, self.rank = get_dist_info(num_replicas, rank)
+        self.num_samples_per_replica = int(math.ceil(self.num_samples / self.num_replicas))
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def plan_epoch(self) -> np.ndarray:
+        """
+            当前epoch（所有进程）的采样序列，元素为ConcatDataset中的下标
+        """
+        rng = np.random.RandomState(self.seed + self.epoch)
+        sources = rng.choice(len(self.source_lengths), size=self.num_samples, p=self.probs)
+        plan = np.empty(self.num_samples, dtype=np.int64)
+        for source, (length, offset) in enumerate(zip(self.source_lengths.tolist(), self.source_offsets.tolist())):
+            positions = np.flatnonzero(sources == source)
+            if len(positions) == 0:
+                continue
+            # 按随机排列依次取样，不够时再拼接新的随机排列
+            perm_num = int(math.ceil(len(positions) / length))
+            local = np.concatenate([rng.permutation(length) for _ in range(perm_num)])[:len(positions)]
+            plan[positions] = offset + local
+        return plan
+
+    def __iter__(self):
+        plan = self.plan_epoch()
+        # 补齐到进程数量的整数倍
+        total_size = self.num_samples_per_replica * self.num_replicas
+        if total_size > len(plan):
+            plan = np.resize(plan, total_size)
+        indices = plan[self.rank:total_size:self.num_replicas].tolist()
+        for start in range(0, len(indices), self.batch_size):
+            yield indices[start:start + self.batch_size]
+
+    def __len__(self):
+        return int(math.ceil(self.num_samples_per_replica / self.batch_size))
+
+
+if __name__ == '__main__':
+    pass
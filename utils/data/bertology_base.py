@@ -1,49 +1,9 @@
 # -*- coding: utf-8 -*-
 # Created by li huayong on 2019/11/19
-from typing import List
-
 import numpy as np
-from utils.data.conll_file import load_conllu_file
+from utils.data.custom_dataset import compact_int_array, lengths_to_offsets
 from utils.data.graph_vocab import GraphVocab
-
-
-class InputExample(object):
-    """A single training/test example for simple sequence classification."""
-
-    def __init__(self, guid: str, sentence: str, start_pos: List, end_pos: List, deps: List = None, pos: List = None):
-        """Constructs a InputExample.
-        """
-        self.guid = guid
-        self.sentence = sentence
-        self.start_pos = start_pos
-        self.end_pos = end_pos
-        self.deps = deps
-        self.pos = pos
-
-
-class InputFeatures(object):
-    """A single set of features of data."""
-
-    def __init__(self, input_ids: List, input_mask: List, segment_ids: List, dep_ids: List, start_pos: List = None,
-                 end_pos: List = None, pos_ids: List = None):
-        """
-            输入的特征，python类型
-        :param input_ids:
-        :param input_mask: 如果mask_padding_with_zero=True（默认），则 1 代表 实际输入，0 代表 padding
-        :param segment_ids:
-        :param dep_ids:
-        :param start_pos: 词语的对应开始序号
-        :param end_pos: 词语的对应结束序号
-        :param pos_ids: 词性ids，开始是一个<PAD>,代表ROOT，后面接<PAD>补足长度, <PAD>均不计算loss
-        """
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.dep_ids = dep_ids
-        self.start_pos = start_pos
-        self.end_pos = end_pos
-        if pos_ids:
-            self.pos_ids = pos_ids
+from utils.data.word_token_cache import WordTokenCache
 
 
 class CoNLLUProcessor(object):
@@ -58,133 +18,133 @@ class CoNLLUProcessor(object):
         assert args.encoder_type == 'bertology', "暂时不支持xlent等类似BERT的模型，输入端需要适配（ROOT,start_pos,end_pos等等）"
         # TODO：支持xlnet,roberta,xlm等模型
         self.word_vocab = word_vocab
+        # 单词切分缓存，参考 get_token_cache
+        self.token_cache = None
 
-    # def get_train_examples(self, data_dir, file_name, max_seq_length):
-    #     """Gets a collection of `InputExample`s for the train set."""
-    #     CoNLLU_file, CoNLLU_data = load_conllu_file(os.path.join(data_dir, file_name))
-    #     return self._create_bert_example(CoNLLU_data, 'train', max_seq_length), CoNLLU_file
-
-    def get_examples(self, file_path, max_seq_length, training=False):
-        """Gets a collection of `InputExample`s for the dev set."""
-        CoNLLU_file, CoNLLU_data = load_conllu_file(file_path)
-        return self.create_bert_example(CoNLLU_data,
-                                        'train' if training else 'dev',
-                                        max_seq_length,
-                                        training=training,
-                                        ), CoNLLU_file
+    def get_token_cache(self, tokenizer) -> WordTokenCache:
+        """
+            tokenizer对应的单词切分缓存（多进程预处理时每个worker进程各有一个）
+        """
+        if self.token_cache is None or self.token_cache.tokenizer is not tokenizer:
+            self.token_cache = WordTokenCache(tokenizer, getattr(self.args, 'word_token_cache_size', 100000))
+        return self.token_cache
 
-    def _get_words_start_end_pos(self, words_list, max_seq_length):
+    def _get_root_pos_and_base(self):
         """
-            注意：这里会自动在开始添加一个ROOT的表示
-        :param words_list:
-        :param max_seq_length:
-        :return:
+        :return: (ROOT的位置, 第一个真实单词的开始位置)
         """
-        s = []
-        e = []
-        # 0 for ROOT if root_representation == [CLS]
-        if self.args.root_representation == 'cls':
-            s.append(0)
-            e.append(0)
-        else:
-            # 1 for other root_representation
-            s.append(1)
-            e.append(1)
-        if self.args.root_representation != 'cls':
-            # 如果ROOT的表示不是CLS，那么words_list第一个元素就是ROOT，应当跳过（因为前面已经用0或者1表示了）
-            clear_words_list = words_list[1:]
-        else:
-            clear_words_list = words_list
         #  BERT For single sequences:
         #  tokens:   [CLS] the dog is hairy . [SEP]
         #  type_ids:   0   0   0   0  0     0   0
-        # 如果ROOT是用[CLS]表示，则从1开始计算；否则，则从2开始计算
         # 0永远是CLS
         if self.args.root_representation == 'cls':
-            sum_len = 1
+            # 0 for ROOT if root_representation == [CLS]，单词从1开始计算
+            return 0, 1
         else:
-            sum_len = 2
-        for w in clear_words_list:
-            s.append(sum_len) if sum_len < max_seq_length else s.append(max_seq_length - 1)
-            if w.lower() not in self.word_vocab:  # 如果单词不在词表中，说明会被分割，要分开计算
-                sum_len += len(w)
-            else:
-                # 如果单词在词表中，可以视长度为1
-                # 注意[MASK],[unused1]等特殊字符都在BERT的vocab中
-                sum_len += 1
-            e.append(sum_len - 1) if sum_len - 1 < max_seq_length else e.append(max_seq_length - 1)
-        return s, e
+            # 1 for other root_representation，单词从2开始计算
+            return 1, 2
 
-    def create_bert_example(self, CoNLLU_data, set_type, max_seq_length, training=False):
-        examples = []
-        # print(CoNLLU_data)
-        for i, sent in enumerate(CoNLLU_data.sentences):
-            guid = f"{set_type}-{i}"
+    def create_bert_arrays(self, conllu_sents, tokenizer, pos_tokenizer=None,
+                           cls_token_segment_id=0, sequence_a_segment_id=0, sep_token_extra=False):
+        """
+            从CoNLL-U的列直接生成按列存储（struct-of-arrays）的特征，不生成InputExample/InputFeatures对象，
+            也不做padding（padding在collate阶段完成）
+
+        :param conllu_sents: CoNLLFile.get(['word', 'upos', 'deps'], as_sentences=True) 的结果
+        :param tokenizer: BERTology tokenizer
+        :param pos_tokenizer: use_pos时的词性tokenizer
+        :param cls_token_segment_id:
+        :param sequence_a_segment_id:
+        :param sep_token_extra: roberta uses an extra separator
+        :return: (values, offsets)，可直接构造 utils.data.custom_dataset.RaggedTensorDataset
+        """
+        root_pos, base = self._get_root_pos_and_base()
+        # 句子的长度不受max_seq_len的限制：超过编码窗口的句子由BERTologyEncoder切分为重叠的窗口编码
+        end_ids = tokenizer.convert_tokens_to_ids([tokenizer.sep_token] * (2 if sep_token_extra else 1))
+        cls_ids = tokenizer.convert_tokens_to_ids([tokenizer.cls_token])
+        token_cache = self.get_token_cache(tokenizer)
+
+        token_lens, word_nums, arc_nums = [], [], []
+        flat_input_ids, flat_token_nums, flat_pos, flat_arcs = [], [], [], []
+        for sent in conllu_sents:
             words = []
-            deps = []
             pos = []
+            arc_num = 0
+            for word_idx, (word, upos, dep) in enumerate(sent, start=1):
+                words.append(word)
+                if dep == '_':
+                    # 若dep == '_'，则说明是一个空白conllu文件，只有word（假定没有pos）
+                    if arc_num:
+                        raise Exception('illegal CoNLLU data')
+                    continue
+                for arc in dep.split('|'):
+                    head, dep_rel = arc.split(':')
+                    flat_arcs += (word_idx, int(head), self.graph_vocab.unit2id[dep_rel])
+                    arc_num += 1
+                pos.append(upos)
+            if arc_num and len(pos) != len(words):
+                raise Exception('illegal CoNLLU data')
             if self.args.root_representation == 'cls':
-                # BERT输入会自动添加一个CLS，所以此时不需要特殊处理
-                pass
+                root_words = []
             elif self.args.root_representation == 'unused':
-                # BERT中预留了部分未经训练的空位，这里使用unused1 （1~99都可以）
-                words.append('[unused1]')
-                pass
+                root_words = ['[unused1]']
             elif self.args.root_representation in ['root', '根']:
-                # 其他可能的表示形式，注意，这些字符已经被BERT预训练过，所以可能效果不佳
-                words.append(self.args.root_representation)
+                root_words = [self.args.root_representation]
             else:
                 raise Exception(f'illegal root representation:{self.args.root_representation}')
-            for line in sent.words:
-                line_res = []
-                if line.dep == '_':
-                    # 若line[-1] == '_'，则说明是一个空白conllu文件，只有word（假定没有pos）
-                    if deps:
-                        # print(CoNLLU_data)
-                        raise Exception('illegal CoNLLU data')
-                    # line[0] 是 词语
-                    # 此时只读取word，因为其他位置为空
-                    words.append(line.word)
-                    continue
-                # line[2] 是 依存关系，多个关系用|分割
-                arcs = line.dep.split('|')
-                for arc in arcs:
-                    head, dep_rel = arc.split(':')
-                    dep_rel_idx = self.graph_vocab.unit2id[dep_rel]
-                    line_res.append([int(head), dep_rel_idx])
-                deps.append(line_res)
-                words.append(line.word)
-                pos.append(line.pos)
-            if not deps:
-                deps = None
-
-            sentence = "".join(words)
-            if self.args.input_mask and training:
-                # input_mask应该只在training的时候使用
-                if self.args.input_mask_granularity == 'char':
-                    input_mask = np.random.uniform(0, 1, len(sentence)) < self.args.input_mask_prob
-                    # 注意这里我们只对正文字符做mask，
-                    # 因为英文单词不是逐个字符切分，如果对英文字符mask可能使得分词后的总长度变化
-                    # 而中文是逐个字切分，即使做了mask也不影响分词后的长度
-                    chars = ['[MASK]' if (z[1] and '\u4e00' <= z[0] <= '\u9fa5') else z[0] for z in
-                             zip(sentence, input_mask)]
-                    sentence = ''.join(chars)
-                else:
-                    # 单词粒度的mask
-                    # 注意单词粒度的mask破坏了句子的长度！
-                    # 因此_get_words_start_end_pos必须在mask操作之后执行
-                    input_mask = np.random.uniform(0, 1, len(words)) < self.args.input_mask_prob
-                    words = ['[MASK]' if z[1] else z[0] for z in zip(words, input_mask)]
-                    sentence = "".join(words)
-            # 词语的起始位置
-            # 由于BERT是基于token（中文是字）序列输入的，依存分析是以单词为单位的，所以必须确定单词的表示，
-            # 这里使用对应起始位置的向量来表示单词
-            start_pos, end_pos = self._get_words_start_end_pos(words, max_seq_length)
-
-            examples.append(
-                InputExample(guid=guid, sentence=sentence, start_pos=start_pos, end_pos=end_pos, deps=deps, pos=pos)
-            )
-        return examples
+            # 逐个单词切分（使用缓存），句子的token序列由单词的token拼接得到
+            # 注意：训练时的Input Mask在collate阶段动态完成（utils.data.collate.InputMasker），缓存中的特征始终不做mask
+            ids_a, token_nums = token_cache.encode_words(root_words + words)
+            token_nums = token_nums[len(root_words):]
+            input_ids = cls_ids + ids_a + end_ids
+            flat_input_ids += input_ids
+            flat_token_nums += token_nums
+            # 开始位置是ROOT，对应的pos设置为PAD (不计算loss)；空白conllu文件的pos全部为PAD
+            flat_pos += ['<PAD>'] + (pos if pos else ['<PAD>'] * len(words))
+            token_lens.append(len(input_ids))
+            word_nums.append(len(words))
+            arc_nums.append(arc_num)
+
+        token_offsets = lengths_to_offsets(token_lens)
+        word_nums = np.asarray(word_nums, dtype=np.int64)
+        # 单词序列包含ROOT
+        word_offsets = lengths_to_offsets(word_nums + 1)
+        arc_offsets = lengths_to_offsets(arc_nums)
+
+        # 用累加和计算所有句子所有单词的开始、结束位置
+        flat_token_nums = np.asarray(flat_token_nums, dtype=np.int64)
+        cum_token_nums = np.cumsum(flat_token_nums)
+        # 每个句子之前所有单词的token数量之和
+        sent_token_base = np.concatenate([[0], cum_token_nums])[lengths_to_offsets(word_nums)[:-1]]
+        word_ends = base + cum_token_nums - np.repeat(sent_token_base, word_nums)
+        is_root = np.zeros(word_offsets[-1], dtype=np.bool_)
+        is_root[word_offsets[:-1]] = True
+        start_pos = np.full(word_offsets[-1], root_pos, dtype=np.int64)
+        end_pos = np.full(word_offsets[-1], root_pos, dtype=np.int64)
+        start_pos[~is_root] = word_ends - flat_token_nums
+        end_pos[~is_root] = word_ends - 1
+
+        segment_ids = np.full(token_offsets[-1], sequence_a_segment_id, dtype=np.int64)
+        segment_ids[token_offsets[:-1]] = cls_token_segment_id
+
+        values = {
+            'input_ids': compact_int_array(np.asarray(flat_input_ids, dtype=np.int64)),
+            'segment_ids': compact_int_array(segment_ids),
+            'start_pos': compact_int_array(start_pos),
+            'end_pos': compact_int_array(end_pos),
+            'arcs': np.asarray(flat_arcs, dtype=np.int16).reshape(-1, 3),
+        }
+        offsets = {
+            'input_ids': token_offsets,
+            'segment_ids': token_offsets,
+            'start_pos': word_offsets,
+            'end_pos': word_offsets,
+            'arcs': arc_offsets,
+        }
+        if pos_tokenizer:
+            values['pos_ids'] = compact_int_array(pos_tokenizer.encode(flat_pos))
+            offsets['pos_ids'] = word_offsets
+        return values, offsets
 
 
 if __name__ == '__main__':
@@ -1,19 +1,30 @@
 # -*- coding: utf-8 -*-
 # Created by li huayong on 2019/9/24
 import json
+import math
 import os
 import pathlib
 import pickle
+import shutil
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
-from functools import partial
+from itertools import chain
+from typing import List
+import numpy as np
 import torch
+from tqdm import tqdm
 from pytorch_transformers import BertTokenizer, RobertaTokenizer, XLMTokenizer, XLNetTokenizer
 from utils.data.bertology_base import *
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import BatchSampler, ConcatDataset, DataLoader, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
-from utils.data.conll_file import CoNLLUData
-from utils.data.custom_dataset import ConcatTensorRandomDataset
+from utils.data.conll_file import CoNLLFile, CoNLLUData, ColumnarCoNLLFile, IndexedCoNLLFile, FIELD_TO_IDX
+from utils.data.custom_dataset import RaggedTensorDataset, concat_ragged_arrays, get_mixture_probs
+from utils.data.collate import BERTologyCollator, InputMasker, get_cjk_token_table
+from utils.data.id_map import IdMap
+from utils.data.batch_sampler import BucketBatchSampler, MixtureBatchSampler, get_dist_info
+from utils.data.dataset_cache import get_feature_cache_key, get_feature_info, get_cache_paths
+from utils.data.sharded_dataset import ShardedIterableDataset, get_shard_name, write_shards_manifest
 from PyToolkit.PyToolkit import get_logger, Timer
 
 BERTology_TOKENIZER = {
@@ -24,319 +35,88 @@ BERTology_TOKENIZER = {
 }
 
 
-def _make_label_target(arcs, max_seq_length):
-    if arcs:
-        graphs = [[0] * max_seq_length for _ in range(max_seq_length)]
-        for word_idx, word in enumerate(arcs, start=1):
-            for arc in word:
-                head_idx = arc[0]
-                rel_idx = arc[1]
-                graphs[word_idx][head_idx] = rel_idx
-    else:
-        graphs = [[-1] * max_seq_length for _ in range(max_seq_length)]
-    return graphs
-
-
-def convert_examples_to_features(examples, label_list, max_seq_length,
-                                 tokenizer,
-                                 cls_token_at_end=False,
-                                 cls_token='[CLS]',
-                                 cls_token_segment_id=1,
-                                 sep_token='[SEP]',
-                                 sep_token_extra=False,
-                                 pad_on_left=False,
-                                 pad_token=0,
-                                 pad_token_segment_id=0,
-                                 sequence_a_segment_id=0,
-                                 # sequence_b_segment_id=1,
-                                 mask_padding_with_zero=True,
-                                 # skip_too_long_input=True,
-                                 pos_tokenizer=None):
-    """ Loads a data file into a list of `InputBatch`s
-        `cls_token_at_end` define the location of the CLS token:
-            - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
-            - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
-        `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
-    """
-    assert not cls_token_at_end, "CLS必须在句首，目前不支持xlnet"
-    assert not pad_on_left, "PAD必须在句子右侧，目前不支持xlnet"
-    features = []
-    # skip_input_num = 0
-    for example in examples:
-        assert isinstance(example, InputExample)
-        tokens_a = tokenizer.tokenize(example.sentence)
-        # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-        special_tokens_count = 3 if sep_token_extra else 2
-        # 为ROOT表示等预留足够的空间(目前至少预留5个位置)
-        special_tokens_count += 3
-        if len(tokens_a) > max_seq_length - special_tokens_count:
-            # 由于无论是跳过过长的句子还是截断过长的句子都会导致在dev时无法写入文件，
-            # 这里我们暂时不允许过小的max_seq_len
-            # todo: 基于ConlluToolkit重写数据加载
-            raise RuntimeError(f'当前max_seq_len过小，至少要大于{len(tokens_a) + special_tokens_count},请重新设置')
-            # if skip_too_long_input:
-            #     # 这里直接跳过过长的句子
-            #     skip_input_num += 1
-            #     continue
-            # else:
-            #     tokens_a = tokens_a[:(max_seq_length - special_tokens_count)]
-        tokens = tokens_a + [sep_token]
-        if sep_token_extra:
-            # roberta uses an extra separator b/w pairs of sentences
-            tokens += [sep_token]
-        segment_ids = [sequence_a_segment_id] * len(tokens)
-
-        if cls_token_at_end:
-            tokens = tokens + [cls_token]
-            segment_ids = segment_ids + [cls_token_segment_id]
-        else:
-            tokens = [cls_token] + tokens
-            segment_ids = [cls_token_segment_id] + segment_ids
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        # input_mask:
-        #   如果mask_padding_with_zero=True（默认），则 1 代表 实际输入，0 代表 padding
-        input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-
-        start_pos = example.start_pos
-        end_pos = example.end_pos
-        # print(end_pos)
-
-        if start_pos:
-            assert len(start_pos) == len(end_pos)
-
-        # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
-        position_padding_length = max_seq_length - len(start_pos)
-
-        if pad_on_left:
-            input_ids = ([pad_token] * padding_length) + input_ids
-            input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-            segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-            # 由于batched_index_select的限制，position idx的pad不能为-1
-            # 如果为0的话，又容易和CLS重复，
-            # 所以这里选择用max_seq_length-1表示PAD
-            # 注意这里max_seq_length至少应该大于实际句长（以字数统计）3到4个位置
-            start_pos = ([max_seq_length - 1] * position_padding_length) + start_pos
-            end_pos = ([max_seq_length - 1] * position_padding_length) + end_pos
-            assert start_pos[0] == max_seq_length - 1
-            assert end_pos[0] == max_seq_length - 1
-        else:
-            input_ids = input_ids + ([pad_token] * padding_length)
-            input_mask = input_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-            segment_ids = segment_ids + ([pad_token_segment_id] * padding_length)
-            # 由于batched_index_select的限制，position idx的pad不能为-1
-            # 如果为0的话，又容易和CLS重复，
-            # 所以这里选择用max_seq_length-1表示PAD
-            # 注意这里max_seq_length至少应该大于实际句长（以字数统计）3到4个位置
-            start_pos = start_pos + ([max_seq_length - 1] * position_padding_length)
-            end_pos = end_pos + ([max_seq_length - 1] * position_padding_length)
-            assert start_pos[-1] == max_seq_length - 1
-            assert end_pos[-1] == max_seq_length - 1
-        # 开始位置是ROOT，对应的pos设置为PAD (不计算loss)
-        example.pos = ['<PAD>'] + example.pos
-        # 如果长度超过max_seq_length，则需要截断
-        example.pos = example.pos[:max_seq_length]
-        # 将pos序列补足到max_seq_length的长度（用PAD，不计算loss）
-        POS_padding_length = max_seq_length - len(example.pos)
-        example.pos = example.pos + (['<PAD>'] * POS_padding_length)
-        if pos_tokenizer:
-            pos_ids = pos_tokenizer.convert_tokens_to_ids(example.pos)
-            assert len(pos_ids) == max_seq_length
-        else:
-            pos_ids = None
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-        assert len(start_pos) == len(end_pos) == max_seq_length
-
-        dep_ids = _make_label_target(example.deps, max_seq_length)
-
-        features.append(
-            InputFeatures(input_ids=input_ids,
-                          input_mask=input_mask,
-                          segment_ids=segment_ids,
-                          dep_ids=dep_ids,
-                          start_pos=start_pos,
-                          end_pos=end_pos,
-                          pos_ids=pos_ids, ))
-    # if skip_input_num > 0:
-    #     print(f'\n>> convert_examples_to_features skip input:{skip_input_num} !!\n')
-    # else:
-    #     print('\n>> No sentences are skipped :)\n')
-    return features
-
-
-def convert_examples_to_features_pool(examples, max_seq_length,
-                                      tokenizer,
-                                      cls_token_at_end=False,
-                                      cls_token='[CLS]',
-                                      cls_token_segment_id=1,
-                                      sep_token='[SEP]',
-                                      sep_token_extra=False,
-                                      pad_on_left=False,
-                                      pad_token=0,
-                                      pad_token_segment_id=0,
-                                      sequence_a_segment_id=0,
-                                      mask_padding_with_zero=True,
-                                      pos_tokenizer=None):
-    """ Loads a data file into a list of `InputBatch`s
-        `cls_token_at_end` define the location of the CLS token:
-            - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
-            - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
-        `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+# 预处理worker进程内的状态（CoNLLUProcessor、tokenizer等），每个worker进程只在启动时初始化一次，
+# 避免每个任务都序列化整个tokenizer
+_convert_worker_state = {}
+
+
+def _init_convert_worker(args, graph_vocab, pos_tokenizer, convert_kwargs):
+    tokenizer = load_bert_tokenizer(args.saved_model_path, args.bertology_type)
+    _convert_worker_state['tokenizer'] = tokenizer
+    _convert_worker_state['processor'] = CoNLLUProcessor(args, graph_vocab, tokenizer.vocab)
+    _convert_worker_state['pos_tokenizer'] = pos_tokenizer
+    _convert_worker_state['convert_kwargs'] = convert_kwargs
+
+
+def _convert_chunk_in_worker(conllu_sents):
+    processor = _convert_worker_state['processor']
+    tokenizer = _convert_worker_state['tokenizer']
+    token_cache = processor.get_token_cache(tokenizer)
+    hits, misses = token_cache.hits, token_cache.misses
+    part = processor.create_bert_arrays(conllu_sents, tokenizer,
+                                        pos_tokenizer=_convert_worker_state['pos_tokenizer'],
+                                        **_convert_worker_state['convert_kwargs'])
+    # 同时返回本chunk的单词切分缓存命中情况
+    return part, token_cache.hits - hits, token_cache.misses - misses
+
+
+def convert_conllu_to_arrays(args, processor, conllu_sents, tokenizer, pos_tokenizer=None,
+                             worker_num=0, chunk_size=2000, **convert_kwargs):
     """
-    process_fun = partial(one_example_to_feature, max_seq_length=max_seq_length, tokenizer=tokenizer,
-                          cls_token_at_end=cls_token_at_end,
-                          cls_token=cls_token, cls_token_segment_id=cls_token_segment_id, sep_token=sep_token,
-                          sep_token_extra=sep_token_extra, pad_token=pad_token,
-                          pad_token_segment_id=pad_token_segment_id,
-                          sequence_a_segment_id=sequence_a_segment_id, mask_padding_with_zero=mask_padding_with_zero,
-                          pos_tokenizer=pos_tokenizer)
-    assert not cls_token_at_end, "CLS必须在句首，目前不支持xlnet"
-    assert not pad_on_left, "PAD必须在句子右侧，目前不支持xlnet"
-    with Pool(4) as pool:
-        print(f'pool._processes:{pool._processes}')
-        # Ref:
-        # [multithreading - Python 3: does Pool keep the original order of data passed to map? - Stack Overflow]
-        # https://stackoverflow.com/questions/41273960/python-3-does-pool-keep-the-original-order-of-data-passed-to-map
-        features = pool.map(process_fun, examples)
-    return features
-
-
-def one_example_to_feature(example, max_seq_length,
-                           tokenizer,
-                           cls_token_at_end=False,
-                           cls_token='[CLS]',
-                           cls_token_segment_id=1,
-                           sep_token='[SEP]',
-                           sep_token_extra=False,
-                           pad_on_left=False,
-                           pad_token=0,
-                           pad_token_segment_id=0,
-                           sequence_a_segment_id=0,
-                           mask_padding_with_zero=True,
-                           pos_tokenizer=None):
-    """ Loads a data file into a list of `InputBatch`s
-        `cls_token_at_end` define the location of the CLS token:
-            - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
-            - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
-        `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        将CoNLL-U的列转换为按列存储的特征数组，支持多进程并行：
+        （1）输入按照chunk_size分块，使用pool.imap按输入顺序返回结果，最后拼接
+        （2）每个worker进程只在启动时加载一次tokenizer（_init_convert_worker）
+        （3）worker_num<=1或者输入较少（不足两个chunk）时，直接在当前进程串行处理
+
+    :param args: 配置参数
+    :param processor: CoNLLUProcessor，串行处理时使用
+    :param conllu_sents: CoNLLFile.get(['word', 'upos', 'deps'], as_sentences=True) 的结果
+    :param tokenizer: 串行处理时使用的tokenizer
+    :param pos_tokenizer:
+    :param worker_num: 并行的进程数量
+    :param chunk_size: 每个任务处理的句子数量
+    :param convert_kwargs: 传递给 CoNLLUProcessor.create_bert_arrays 的其他参数
+    :return: (values, offsets)
     """
-    assert not cls_token_at_end, "CLS必须在句首，目前不支持xlnet"
-    assert not pad_on_left, "PAD必须在句子右侧，目前不支持xlnet"
-    assert isinstance(example, InputExample)
-    tokens_a = tokenizer.tokenize(example.sentence)
-    # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-    special_tokens_count = 3 if sep_token_extra else 2
-    # 为ROOT表示等预留足够的空间(目前至少预留5个位置)
-    special_tokens_count += 3
-    if len(tokens_a) > max_seq_length - special_tokens_count:
-        # 由于无论是跳过过长的句子还是截断过长的句子都会导致在dev时无法写入文件，
-        # 这里我们暂时不允许过小的max_seq_len
-        # todo: 基于ConlluToolkit重写数据加载
-        raise RuntimeError(f'当前max_seq_len过小，至少要大于{len(tokens_a) + special_tokens_count},请重新设置')
-        # if skip_too_long_input:
-        #     # 这里直接跳过过长的句子
-        #     skip_input_num += 1
-        #     continue
-        # else:
-        #     tokens_a = tokens_a[:(max_seq_length - special_tokens_count)]
-    tokens = tokens_a + [sep_token]
-    if sep_token_extra:
-        # roberta uses an extra separator b/w pairs of sentences
-        tokens += [sep_token]
-    segment_ids = [sequence_a_segment_id] * len(tokens)
-    if cls_token_at_end:
-        tokens = tokens + [cls_token]
-        segment_ids = segment_ids + [cls_token_segment_id]
-    else:
-        tokens = [cls_token] + tokens
-        segment_ids = [cls_token_segment_id] + segment_ids
-    input_ids = tokenizer.convert_tokens_to_ids(tokens)
-    # The mask has 1 for real tokens and 0 for padding tokens. Only real
-    # tokens are attended to.
-    # input_mask:
-    #   如果mask_padding_with_zero=True（默认），则 1 代表 实际输入，0 代表 padding
-    input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-    start_pos = example.start_pos
-    end_pos = example.end_pos
-    # print(end_pos)
-    if start_pos:
-        assert len(start_pos) == len(end_pos)
-    # Zero-pad up to the sequence length.
-    padding_length = max_seq_length - len(input_ids)
-    position_padding_length = max_seq_length - len(start_pos)
-    if pad_on_left:
-        input_ids = ([pad_token] * padding_length) + input_ids
-        input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
-        segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
-        # 由于batched_index_select的限制，position idx的pad不能为-1
-        # 如果为0的话，又容易和CLS重复，
-        # 所以这里选择用max_seq_length-1表示PAD
-        # 注意这里max_seq_length至少应该大于实际句长（以字数统计）3到4个位置
-        start_pos = ([max_seq_length - 1] * position_padding_length) + start_pos
-        end_pos = ([max_seq_length - 1] * position_padding_length) + end_pos
-        assert start_pos[0] == max_seq_length - 1
-        assert end_pos[0] == max_seq_length - 1
-    else:
-        input_ids = input_ids + ([pad_token] * padding_length)
-        input_mask = input_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-        segment_ids = segment_ids + ([pad_token_segment_id] * padding_length)
-        # 由于batched_index_select的限制，position idx的pad不能为-1
-        # 如果为0的话，又容易和CLS重复，
-        # 所以这里选择用max_seq_length-1表示PAD
-        # 注意这里max_seq_length至少应该大于实际句长（以字数统计）3到4个位置
-        start_pos = start_pos + ([max_seq_length - 1] * position_padding_length)
-        end_pos = end_pos + ([max_seq_length - 1] * position_padding_length)
-        assert start_pos[-1] == max_seq_length - 1
-        assert end_pos[-1] == max_seq_length - 1
-    # 开始位置是ROOT，对应的pos设置为PAD (不计算loss)
-    example.pos = ['<PAD>'] + example.pos
-    # 如果长度超过max_seq_length，则需要截断
-    example.pos = example.pos[:max_seq_length]
-    # 将pos序列补足到max_seq_length的长度（用PAD，不计算loss）
-    POS_padding_length = max_seq_length - len(example.pos)
-    example.pos = example.pos + (['<PAD>'] * POS_padding_length)
-    if pos_tokenizer:
-        pos_ids = pos_tokenizer.convert_tokens_to_ids(example.pos)
-        assert len(pos_ids) == max_seq_length
-    else:
-        pos_ids = None
-    assert len(input_ids) == max_seq_length
-    assert len(input_mask) == max_seq_length
-    assert len(segment_ids) == max_seq_length
-    assert len(start_pos) == len(end_pos) == max_seq_length
-    dep_ids = _make_label_target(example.deps, max_seq_length)
-    feature = InputFeatures(input_ids=input_ids,
-                            input_mask=input_mask,
-                            segment_ids=segment_ids,
-                            dep_ids=dep_ids,
-                            start_pos=start_pos,
-                            end_pos=end_pos,
-                            pos_ids=pos_ids, )
-    return feature
+    logger = get_logger(args.log_name)
+    if worker_num <= 1 or len(conllu_sents) < 2 * chunk_size:
+        values, offsets = processor.create_bert_arrays(conllu_sents, tokenizer, pos_tokenizer=pos_tokenizer,
+                                                       **convert_kwargs)
+        logger.info(processor.get_token_cache(tokenizer).stats())
+        return values, offsets
+    chunks = [conllu_sents[i:i + chunk_size] for i in range(0, len(conllu_sents), chunk_size)]
+    parts = []
+    hits = misses = 0
+    with Pool(worker_num, initializer=_init_convert_worker,
+              initargs=(args, processor.graph_vocab, pos_tokenizer, convert_kwargs)) as pool:
+        # imap 保证结果的顺序和输入顺序一致
+        for part, part_hits, part_misses in tqdm(pool.imap(_convert_chunk_in_worker, chunks), total=len(chunks),
+                                                 desc=f'Convert features ({worker_num} workers)',
+                                                 disable=args.local_rank not in [-1, 0]):
+            parts.append(part)
+            hits += part_hits
+            misses += part_misses
+    logger.info(f'word token cache ({worker_num} workers): hits {hits}, misses {misses}, '
+                f'hit rate {hits / max(1, hits + misses):.2%}')
+    return concat_ragged_arrays(parts)
 
 
 class POSTokenizer(object):
     def __init__(self, pos_list: List):
         self.pos_list = ['<PAD>', '<UNK>'] + pos_list
+        self.id_map = IdMap(self.pos_list, unk='<UNK>')
 
     def convert_tokens_to_ids(self, input_seq: List[str]):
-        result = []
-        for t in input_seq:
-            if t in self.pos_list:
-                result.append(self.pos_list.index(t))
-            else:
-                result.append(self.pos_list.index('<UNK>'))
-        return result
+        return [self.id_map.get_id(t) for t in input_seq]
+
+    def encode(self, input_seq) -> np.ndarray:
+        """
+            批量编码（输入为列表或者numpy数组），返回int64数组
+        """
+        return self.id_map.encode(input_seq)
 
     def get_idx(self, token):
-        return self.pos_list.index(token)
+        return self.id_map.unit2id[token]
 
     def get_label_num(self):
         return len(self.pos_list)
@@ -344,7 +124,7 @@ class POSTokenizer(object):
 
 def get_pos_tokenizer(new_pos_list, file_path, merge_train=False, conllu_data=None):
     if conllu_data is not None:
-        assert isinstance(conllu_data, CoNLLUData)
+        assert isinstance(conllu_data, (CoNLLUData, CoNLLFile))
     assert isinstance(file_path, pathlib.Path)
     if conllu_data is not None and \
             ((new_pos_list and not merge_train) or
@@ -352,11 +132,15 @@ def get_pos_tokenizer(new_pos_list, file_path, merge_train=False, conllu_data=No
         # conllu_data不为空
         # 而且
         # [(存在new_pos_list 且 非merge_train) 或者 (存在new_pos_list 且 merge_train 且 不存在pos_list.json)]
-        pos_counter = Counter()
-        for sent in conllu_data.sentences:
-            for word in sent.words:
-                pos_counter[word.pos] += 1
-        pos_list = list(pos_counter.keys())
+        if isinstance(conllu_data, CoNLLFile):
+            # 按照第一次出现的顺序，和CoNLLUData的结果一致
+            pos_list = list(dict.fromkeys(conllu_data.get(['upos'])))
+        else:
+            pos_counter = Counter()
+            for sent in conllu_data.sentences:
+                for word in sent.words:
+                    pos_counter[word.pos] += 1
+            pos_list = list(pos_counter.keys())
         with open(str(file_path / 'pos_list.json'), 'w', encoding='utf-8')as f:
             json.dump(pos_list, f, ensure_ascii=False)
         print('>>> get new pos tokenizer')
@@ -370,120 +154,228 @@ def get_pos_tokenizer(new_pos_list, file_path, merge_train=False, conllu_data=No
     return pos_tokenizer
 
 
+def convert_and_cache_sharded(convert_fn, conllu_sents, cached_dataset, logger, save_cache=True):
+    """
+        分布式训练时并行预处理：
+        （1）每个进程只转换连续的 1/N 句子，保存为一个分片缓存（原子rename）
+        （2）barrier之后rank 0按顺序合并所有分片，保存为完整的缓存（原子rename），并删除分片
+        （3）再次barrier之后所有进程以memmap的方式加载同一份缓存
+        save_cache为False（不使用缓存）时，（2）改为每个进程按顺序把所有分片读入内存并合并，
+        再次barrier之后由rank 0删除分片，不保存完整的缓存
+        所有进程都必须调用本函数
+
+    :param convert_fn: conllu_sents -> (values, offsets)
+    :param conllu_sents: 所有句子
+    :param cached_dataset: 完整缓存的路径（分片保存在它旁边）
+    :param save_cache: 是否保存完整的缓存
+    :return: RaggedTensorDataset
+    """
+    world_size, rank = get_dist_info()
+    shard_size = int(math.ceil(len(conllu_sents) / world_size))
+    shard_dirs = [cached_dataset.with_name(f'{cached_dataset.name}.shard{i}-of-{world_size}')
+                  for i in range(world_size)]
+    values, offsets = convert_fn(conllu_sents[rank * shard_size:(rank + 1) * shard_size])
+    RaggedTensorDataset(values, offsets).save_to_dir(shard_dirs[rank])
+    logger.info(f'rank {rank}: saved shard {rank}/{world_size} ({len(offsets["input_ids"]) - 1} sentences)')
+    del values, offsets
+    # 等待所有分片完成
+    torch.distributed.barrier()
+    if not save_cache:
+        shards = [RaggedTensorDataset.load_from_dir(d) for d in shard_dirs]
+        data_set = RaggedTensorDataset(*concat_ragged_arrays([(d.values, d.offsets) for d in shards]))
+        del shards
+        # 等待所有进程读取完成之后再删除分片
+        torch.distributed.barrier()
+        if rank == 0:
+            for d in shard_dirs:
+                shutil.rmtree(str(d))
+        return data_set
+    if rank == 0:
+        shards = [RaggedTensorDataset.load_from_dir(d) for d in shard_dirs]
+        with Timer('Merge and save data set shards'):
+            RaggedTensorDataset(*concat_ragged_arrays([(d.values, d.offsets) for d in shards])).save_to_dir(
+                cached_dataset)
+        del shards
+        for d in shard_dirs:
+            shutil.rmtree(str(d))
+        logger.info("Saved dateset into cached file %s", str(cached_dataset))
+    # 等待合并完成，之后所有进程读取同一份缓存
+    torch.distributed.barrier()
+    return RaggedTensorDataset.load_from_dir(cached_dataset)
+
+
+def get_convert_kwargs(args):
+    """
+        CoNLLUProcessor.create_bert_arrays 中依赖于配置的参数
+    """
+    return dict(
+        cls_token_segment_id=2 if args.encoder_type in ['xlnet'] else 0,
+        # roberta uses an extra separator b/w pairs of sentences,
+        # cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
+        sep_token_extra=bool(args.encoder_type in ['roberta']),
+    )
+
+
 def load_and_cache_examples(args, conllu_file_path, graph_vocab, tokenizer, training=False):
     logger = get_logger(args.log_name)
     word_vocab = tokenizer.vocab if args.encoder_type == 'bertology' else None
     processor = CoNLLUProcessor(args, graph_vocab, word_vocab)
-    label_list = graph_vocab.get_labels()
-
-    if args.use_cache:
-        cached_dir, _file_name = pathlib.Path(args.data_dir) / 'cached', pathlib.Path(conllu_file_path).name
-        cached_dataset = cached_dir / \
-                         f'{_file_name}_{args.encoder_type}_pos-{args.use_pos}_len-{args.max_seq_len}-dataset.torch.cache'
-        cached_conllu = cached_dir / \
-                        f'{_file_name}-conllu.pickle.cache'
-        if not cached_dir.is_dir():
-            cached_dir.mkdir()
-
-    if args.use_cache and args.command == 'train' and cached_dataset.is_file():
+    # 分布式训练时（无论是否使用缓存）各个进程只处理一部分句子，再合并为同一份数据集，参考 convert_and_cache_sharded
+    world_size = get_dist_info()[0]
+    sharded = args.command == 'train' and world_size > 1
+
+    # pos_list.json也保存在缓存目录中（训练时生成，非训练数据读取）
+    cached_dir = pathlib.Path(args.data_dir) / 'cached'
+    # 只有训练时（command == 'train'）才读写数据集缓存（分布式训练时的分片也保存在缓存目录中），
+    # dev/infer不计算缓存的key，避免为了计算哈希值额外读一遍输入文件
+    if args.command == 'train':
+        cached_dir.mkdir(exist_ok=True)
+    if args.command == 'train' and (args.use_cache or sharded):
+        # 缓存的key由输入文件、tokenizer词表、graph vocab以及影响特征的配置项的哈希值决定，
+        # 任何一项变化都会自动使用新的缓存，参考 utils.data.dataset_cache
+        # 训练时会根据训练数据重新生成pos_list，所以只有非训练数据依赖已有的pos_list.json
+        feature_cache_key = get_feature_cache_key(args, conllu_file_path,
+                                                  tokenizer_vocab_file=pathlib.Path(args.saved_model_path) / 'vocab.txt',
+                                                  graph_vocab_file=args.graph_vocab_file,
+                                                  pos_list_file=cached_dir / 'pos_list.json'
+                                                  if args.use_pos and not training else None,
+                                                  training=training)
+        # 缓存为一个目录（numpy.memmap格式），参考 RaggedTensorDataset.save_to_dir
+        cached_dataset, cached_conllu = get_cache_paths(cached_dir, conllu_file_path, feature_cache_key)
+
+    if args.use_cache and args.command == 'train':
+        if RaggedTensorDataset.is_saved_dir(cached_dataset):
+            logger.info(f'Cache hit: {str(cached_dataset)}')
+        elif cached_dataset.exists():
+            logger.info(f'Cache rebuild (incomplete or outdated format): {str(cached_dataset)}')
+        else:
+            logger.info(f'Cache miss: {str(cached_dataset)}')
+
+    if args.use_cache and args.command == 'train' and RaggedTensorDataset.is_saved_dir(cached_dataset):
         # 加载缓存
         logger.info("Loading cached file")
         if cached_conllu.is_file():
             with open(str(cached_conllu), 'rb')as f:
                 conllu_file = pickle.load(f)
         else:
-            conllu_file, _ = load_conllu_file(conllu_file_path)
+            conllu_file = ColumnarCoNLLFile(conllu_file_path)
         with Timer('Load cached data set'):
-            data_set = torch.load(cached_dataset)
+            data_set = RaggedTensorDataset.load_from_dir(cached_dataset)
         # if args.use_pos:
         #     pos_tokenizer = get_pos_tokenizer(new_pos_list=training, file_path=cached_dir)
         #     args.pos_label_pad_idx = pos_tokenizer.get_idx('<PAD>')
         #     args.pos_label_num = pos_tokenizer.get_label_num()
         return data_set, conllu_file
     else:
-        conllu_file, conllu_data = load_conllu_file(conllu_file_path)
+        # 按列存储的conllu文件（不再生成CoNLLUData对象树），pickle缓存时也只需要保存几个数组
+        conllu_file = ColumnarCoNLLFile(conllu_file_path)
         if args.use_pos:
             # 仅在training=True时，生成新的pos_list
-            pos_tokenizer = get_pos_tokenizer(new_pos_list=training, file_path=cached_dir, conllu_data=conllu_data)
+            pos_tokenizer = get_pos_tokenizer(new_pos_list=training, file_path=cached_dir, conllu_data=conllu_file)
             args.pos_label_pad_idx = pos_tokenizer.get_idx('<PAD>')
             args.pos_label_num = pos_tokenizer.get_label_num()
-        with Timer(f'Create {"train" if training else "dev|infer"} example'):
-            examples = processor.create_bert_example(conllu_data,
-                                                     'train' if training else 'dev',
-                                                     args.max_seq_len,
-                                                     training=training,
-                                                     )
-        with Timer(f'Convert {"train" if training else "dev|infer"} example to features'):
-            features = convert_examples_to_features(examples, label_list, args.max_seq_len, tokenizer,
-                                                    cls_token_at_end=bool(args.encoder_type in ['xlnet']),
-                                                    # xlnet has a cls token at the end
-                                                    cls_token=tokenizer.cls_token,
-                                                    cls_token_segment_id=2 if args.encoder_type in ['xlnet'] else 0,
-                                                    sep_token=tokenizer.sep_token,
-                                                    sep_token_extra=bool(args.encoder_type in ['roberta']),
-                                                    # roberta uses an extra separator b/w pairs of sentences,
-                                                    # cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
-                                                    pad_on_left=bool(args.encoder_type in ['xlnet']),
-                                                    # pad on the left for xlnet
-                                                    pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-                                                    pad_token_segment_id=4 if args.encoder_type in ['xlnet'] else 0,
-                                                    # skip_too_long_input=args.skip_too_long_input,
-                                                    pos_tokenizer=pos_tokenizer if args.use_pos else None
-                                                    )
-
-        # Convert to Tensors and build dataset
-        with Timer(f'{"train" if training else "dev|infer"} Features to Dataset'):
-            data_set = feature_to_dataset(features)
+        def _convert(conllu_sents):
+            # 直接从CoNLL-U的列生成按列存储的特征数组（不再逐句生成InputExample/InputFeatures对象）
+            return convert_conllu_to_arrays(
+                args,
+                processor,
+                conllu_sents,
+                tokenizer,
+                pos_tokenizer=pos_tokenizer if args.use_pos else None,
+                # 分布式训练时同一台机器上的各个进程同时预处理，平分预处理的进程数量
+                worker_num=getattr(args, 'preprocess_worker_num', 0) // world_size,
+                chunk_size=getattr(args, 'preprocess_chunk_size', 2000),
+                **get_convert_kwargs(args)
+            )
+
+        with Timer(f'Convert {"train" if training else "dev|infer"} CoNLL-U to features'):
+            if sharded:
+                data_set = convert_and_cache_sharded(_convert, conllu_file.get(['word', 'upos', 'deps'],
+                                                                               as_sentences=True),
+                                                     cached_dataset, logger, save_cache=args.use_cache)
+            else:
+                data_set = RaggedTensorDataset(*_convert(conllu_file.get(['word', 'upos', 'deps'], as_sentences=True)))
 
         if args.local_rank in [-1, 0] and args.use_cache and args.command == 'train':
             # with Timer(f'Save {"train" if training else "dev|infer"} cache'):
             #     torch.save((conllu_file, features), str(cached_features_file))
             with open(str(cached_conllu), 'wb')as f:
                 pickle.dump(conllu_file, f)
-            with Timer('Save data set'):
-                torch.save(data_set, cached_dataset)
-            logger.info("Saved dateset into cached file %s", str(cached_dataset))
+            if not sharded:
+                with Timer('Save data set'):
+                    data_set.save_to_dir(cached_dataset)
+                logger.info("Saved dateset into cached file %s", str(cached_dataset))
+                # 重新以memmap的方式加载，各个DataLoader worker共享同一份数据
+                data_set = RaggedTensorDataset.load_from_dir(cached_dataset)
 
     return data_set, conllu_file
 
 
-def feature_to_dataset(features):
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-    all_start_pos = torch.tensor([t.start_pos for t in features], dtype=torch.long)
-    # print([t.end_pos for t in features])
-    all_end_pos = torch.tensor([t.end_pos for t in features], dtype=torch.long)
-    all_dep_ids = torch.tensor([t.dep_ids for t in features], dtype=torch.long)
-    tensors = [all_input_ids, all_input_mask, all_segment_ids, all_start_pos, all_end_pos, all_dep_ids]
-    if hasattr(features[0], 'pos_ids'):
-        all_pos_ids = torch.tensor([t.pos_ids for t in features], dtype=torch.long)
-        tensors.append(all_pos_ids)
-    dataset = TensorDataset(*tensors)
-    # Input Tensors:
-    #   all_input_ids,
-    #   all_input_mask,
-    #   all_segment_ids,
-    #   all_start_pos,
-    #   all_end_pos,
-    #   all_dep_ids,
-    #   all_pos_ids, (如果有)
-    return dataset
-
-
 def get_data_loader(dataset, batch_size, evaluation=False,
-                    custom_dataset=False, num_worker=6, local_rank=-1):
+                    custom_dataset=False, num_worker=6, local_rank=-1, collate_fn=None,
+                    batch_max_tokens=0, batch_length_unit='token', seed=0, mixture_probs=None,
+                    pin_memory=False):
+    """
+
+    :param dataset:
+    :param batch_size: 每个batch的句子数量，batch_max_tokens>0时不起作用
+    :param evaluation:
+    :param custom_dataset: 为True时dataset是多个源的ConcatDataset，使用MixtureBatchSampler按mixture_probs混合采样
+    :param num_worker:
+    :param local_rank:
+    :param collate_fn:
+    :param batch_max_tokens: >0时（仅训练）按照累计句长划分batch，见 utils.data.batch_sampler.BucketBatchSampler
+    :param batch_length_unit: 按照累计句长划分batch时句长的单位，token 或者 word
+    :param seed: 按照累计句长划分batch（或者混合采样）时的随机种子
+    :param mixture_probs: custom_dataset为True时各个源的采样概率
+    :param pin_memory: 使用GPU时为True，batch放在pinned memory中以便异步拷贝（参考 utils.data.prefetcher）
+    :return:
+    """
+    if isinstance(dataset, ShardedIterableDataset):
+        # 流式读取的shard数据集直接产生整个batch（划分、打乱都在dataset内部完成）
+        print(f'get_data_loader: training:{not evaluation}; sharded dataset:{dataset.shards_dir}')
+        return DataLoader(dataset, batch_size=None, num_workers=num_worker, collate_fn=collate_fn,
+                          pin_memory=pin_memory)
+    if not evaluation and custom_dataset:
+        assert isinstance(dataset, ConcatDataset) and mixture_probs is not None
+        batch_sampler = MixtureBatchSampler([len(d) for d in dataset.datasets], mixture_probs,
+                                            batch_size=batch_size, seed=seed,
+                                            num_replicas=None if local_rank != -1 else 1,
+                                            rank=None if local_rank != -1 else 0)
+        print(f'get_data_loader: training:{not evaluation}; batch_sampler:{batch_sampler}')
+        return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_worker, collate_fn=collate_fn,
+                          pin_memory=pin_memory)
+    if not evaluation and not custom_dataset and batch_max_tokens > 0:
+        assert batch_length_unit in ['token', 'word'], 'batch_length_unit只能为token或者word'
+        lengths = dataset.get_lengths('input_ids' if batch_length_unit == 'token' else 'start_pos')
+        batch_sampler = BucketBatchSampler(lengths, max_tokens=batch_max_tokens, shuffle=True, seed=seed,
+                                           num_replicas=None if local_rank != -1 else 1,
+                                           rank=None if local_rank != -1 else 0)
+        print(f'get_data_loader: training:{not evaluation}; batch_sampler:{batch_sampler}')
+        return _make_batch_data_loader(dataset, batch_sampler, num_worker, collate_fn, pin_memory)
     if evaluation:
         sampler = SequentialSampler(dataset)
     else:
-        if not custom_dataset:
-            # 使用 DistributedSampler 对数据集进行划分
-            sampler = RandomSampler(dataset) if local_rank == -1 else DistributedSampler(dataset)
-        else:
-            sampler = None
+        # 使用 DistributedSampler 对数据集进行划分
+        sampler = RandomSampler(dataset) if local_rank == -1 else DistributedSampler(dataset)
     print(f'get_data_loader: training:{not evaluation}; sampler:{sampler}')
-    data_loader = DataLoader(dataset, sampler=sampler, batch_size=batch_size, num_workers=num_worker)
-    return data_loader
+    return _make_batch_data_loader(dataset, BatchSampler(sampler, batch_size, drop_last=False),
+                                   num_worker, collate_fn, pin_memory)
+
+
+def _make_batch_data_loader(dataset, batch_sampler, num_worker, collate_fn, pin_memory):
+    """
+        RaggedTensorDataset支持按batch取数据（RaggedTensorDataset.get_batch）：
+        把batch sampler作为DataLoader的sampler，并设置batch_size=None，
+        DataLoader每次把一整个batch的下标交给dataset，每个字段只需要一次fancy indexing（下标连续时直接切片），
+        collate_fn（BERTologyCollator）直接对整个batch做padding
+        其他数据集仍然逐个样本取数据
+    """
+    if isinstance(dataset, RaggedTensorDataset):
+        return DataLoader(dataset, sampler=batch_sampler, batch_size=None, num_workers=num_worker,
+                          collate_fn=collate_fn, pin_memory=pin_memory)
+    return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_worker, collate_fn=collate_fn,
+                      pin_memory=pin_memory)
 
 
 def load_bert_tokenizer(model_path, model_type, do_lower_case=True):
@@ -493,11 +385,158 @@ def load_bert_tokenizer(model_path, model_type, do_lower_case=True):
                                                                                       '[unused3]'])
 
 
+def get_collator(args, tokenizer, training=False):
+    # 动态padding：每个batch只padding到batch内最长的句子
+    # 训练数据的Input Mask在collate阶段动态完成，每个epoch重新采样，不影响预处理缓存
+    input_masker = None
+    if training and args.input_mask:
+        granularity = args.input_mask_granularity
+        input_masker = InputMasker(mask_token_id=tokenizer.convert_tokens_to_ids([tokenizer.mask_token])[0],
+                                   mask_prob=args.input_mask_prob,
+                                   granularity=granularity,
+                                   cjk_token_table=get_cjk_token_table(tokenizer) if granularity == 'char' else None)
+    return BERTologyCollator(pad_token_id=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+                             pad_segment_id=4 if args.encoder_type in ['xlnet'] else 0,
+                             pos_pad_id=0,
+                             input_masker=input_masker)
+
+
+def _sents_to_columns(sents):
+    """
+        CoNLLFile.sents格式的句子 -> CoNLLUProcessor.create_bert_arrays 的输入（跳过multi-word token行）
+    """
+    return [[[ln[FIELD_TO_IDX[f]] for f in ('word', 'upos', 'deps')] for ln in sent if '-' not in ln[0]]
+            for sent in sents]
+
+
+def load_streaming_inference_input(args):
+    """
+        流式推理的输入：按chunk（args.stream_chunk_size个句子）读取输入的conllu文件，
+        每个chunk单独完成 分词 -> 特征转换 -> padding，峰值内存只和chunk的大小有关，和输入文件的大小无关
+        后台线程会提前准备下一个chunk，和当前chunk的模型推理重叠
+
+        注意：后台线程在模型已经放到GPU上之后运行，这时不能再fork子进程（多线程+CUDA之后fork可能死锁），
+        所以这里不使用进程池（忽略preprocess_worker_num）和DataLoader的worker（忽略loader_worker_num）：
+        整个推理过程只使用一个tokenizer（WordTokenCache在各个chunk之间共享），
+        特征转换和padding都在后台线程中串行完成，和GPU上的推理重叠
+
+    :return: (sent_num, chunks)，chunks为生成器，每个元素为 (batches, sents)，
+             batches为该chunk padding之后的batch列表（使用GPU时位于pinned memory），
+             sents为该chunk的原始句子（CoNLLFile.sents的格式），用于写入预测结果
+    """
+    logger = get_logger(args.log_name)
+    assert (pathlib.Path(args.saved_model_path) / 'vocab.txt').exists()
+    tokenizer = load_bert_tokenizer(args.saved_model_path, args.bertology_type)
+    vocab = GraphVocab(args.graph_vocab_file)
+    word_vocab = tokenizer.vocab if args.encoder_type == 'bertology' else None
+    processor = CoNLLUProcessor(args, vocab, word_vocab)
+    pos_tokenizer = get_pos_tokenizer(new_pos_list=False,
+                                      file_path=pathlib.Path(args.data_dir) / 'cached') if args.use_pos else None
+    collator = get_collator(args, tokenizer)
+    conllu_file = IndexedCoNLLFile(args.input_conllu_path)
+    chunk_size = args.stream_chunk_size
+    pin_memory = args.device.type == 'cuda'
+    logger.info(f'Streaming inference: {len(conllu_file)} sentences, chunk size: {chunk_size}')
+
+    def _load_chunk(start):
+        sents = conllu_file.get_sentences(start, start + chunk_size)
+        conllu_sents = _sents_to_columns(sents)
+        values, offsets = convert_conllu_to_arrays(args, processor, conllu_sents, tokenizer,
+                                                   pos_tokenizer=pos_tokenizer, worker_num=1,
+                                                   **get_convert_kwargs(args))
+        dataset = RaggedTensorDataset(values, offsets)
+        batches = []
+        for batch_start in range(0, len(dataset), args.eval_batch_size):
+            batch = collator(dataset.get_batch(np.arange(batch_start,
+                                                         min(batch_start + args.eval_batch_size, len(dataset)))))
+            batches.append(tuple(t.pin_memory() for t in batch) if pin_memory else batch)
+        return batches, sents
+
+    def _chunks():
+        starts = range(0, len(conllu_file), chunk_size)
+        if len(starts) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(_load_chunk, starts[0])
+            for next_start in chain(starts[1:], [None]):
+                chunk = future.result()
+                # 预先加载下一个chunk（最多同时保留两个chunk）
+                future = executor.submit(_load_chunk, next_start) if next_start is not None else None
+                yield chunk
+        conllu_file.close()
+
+    return len(conllu_file), _chunks()
+
+
+def build_train_shards(args, conllu_file_path, shards_dir, shard_size=100000):
+    """
+        把（超出内存的）训练语料转换为一个shard目录：按shard_size个句子读取输入文件，
+        每个shard单独完成特征转换并保存为一个 RaggedTensorDataset 目录，峰值内存只和shard_size有关
+        训练时设置 train_shards_dir 即可流式读取，参考 utils.data.sharded_dataset.ShardedIterableDataset
+
+        注意：use_pos时使用 data_dir/cached/pos_list.json 中已有的词性列表
+    """
+    logger = get_logger(args.log_name)
+    tokenizer = load_bert_tokenizer(args.saved_model_path, args.bertology_type)
+    vocab = GraphVocab(args.graph_vocab_file)
+    word_vocab = tokenizer.vocab if args.encoder_type == 'bertology' else None
+    processor = CoNLLUProcessor(args, vocab, word_vocab)
+    pos_list_file = pathlib.Path(args.data_dir) / 'cached' / 'pos_list.json'
+    pos_tokenizer = get_pos_tokenizer(new_pos_list=False, file_path=pos_list_file.parent) if args.use_pos else None
+    shards_dir = pathlib.Path(shards_dir)
+    shards_dir.mkdir(parents=True, exist_ok=True)
+    conllu_file = IndexedCoNLLFile(conllu_file_path)
+    logger.info(f'Build train shards: {len(conllu_file)} sentences, shard size: {shard_size}')
+    shard_sizes = []
+    for shard_idx, start in enumerate(tqdm(range(0, len(conllu_file), shard_size), desc='Build shards')):
+        sents = conllu_file.get_sentences(start, start + shard_size)
+        values, offsets = convert_conllu_to_arrays(args, processor, _sents_to_columns(sents), tokenizer,
+                                                   pos_tokenizer=pos_tokenizer,
+                                                   worker_num=getattr(args, 'preprocess_worker_num', 0),
+                                                   chunk_size=getattr(args, 'preprocess_chunk_size', 2000),
+                                                   **get_convert_kwargs(args))
+        RaggedTensorDataset(values, offsets).save_to_dir(shards_dir / get_shard_name(shard_idx))
+        shard_sizes.append(len(sents))
+    conllu_file.close()
+    # manifest最后写入，没有manifest的目录不会被当做完整的shard目录
+    write_shards_manifest(shards_dir, shard_sizes,
+                          get_feature_info(args, pathlib.Path(args.saved_model_path) / 'vocab.txt',
+                                           args.graph_vocab_file, pos_list_file if args.use_pos else None))
+    logger.info(f'Saved {len(shard_sizes)} shards into {str(shards_dir)}')
+    return shard_sizes
+
+
+def load_train_shards(args):
+    """
+        流式读取build_train_shards生成的训练数据，检查生成shard时的词表和配置是否和当前一致
+    """
+    logger = get_logger(args.log_name)
+    train_dataset = ShardedIterableDataset(args.train_shards_dir,
+                                           batch_size=args.train_batch_size,
+                                           shuffle_buffer_size=getattr(args, 'shuffle_buffer_size', 10000),
+                                           seed=args.seed,
+                                           num_workers=args.loader_worker_num,
+                                           num_replicas=None if args.local_rank != -1 else 1,
+                                           rank=None if args.local_rank != -1 else 0)
+    pos_list_file = pathlib.Path(args.data_dir) / 'cached' / 'pos_list.json'
+    if args.use_pos:
+        pos_tokenizer = get_pos_tokenizer(new_pos_list=False, file_path=pos_list_file.parent)
+        args.pos_label_pad_idx = pos_tokenizer.get_idx('<PAD>')
+        args.pos_label_num = pos_tokenizer.get_label_num()
+    feature_info = get_feature_info(args, pathlib.Path(args.saved_model_path) / 'vocab.txt',
+                                    args.graph_vocab_file, pos_list_file if args.use_pos else None)
+    if train_dataset.feature_info != feature_info:
+        raise RuntimeError(f'{args.train_shards_dir} 的词表或特征配置与当前配置不一致，请重新生成shard')
+    if getattr(args, 'train_batch_max_tokens', 0) > 0:
+        logger.warning('train_shards_dir: 流式读取时不支持train_batch_max_tokens，按照train_batch_size划分batch')
+    logger.info(f'Load train shards from {args.train_shards_dir}: '
+                f'{len(train_dataset.shard_sizes)} shards, {train_dataset.manifest["size"]} sentences')
+    return train_dataset
+
+
 def load_bertology_input(args):
     # todo: 现在没有很好地区分加载不同数据的过程，建议改写为显示输入加载位置，而不是在本程序中根据configs硬编码
-    # Make sure only the first process in distributed training process the dataset, and the others will use the cache
-    # if args.local_rank not in [-1, 0] and args.run_mode == 'train':
-    #     torch.distributed.barrier()
+    # 分布式训练时各个进程并行处理数据集的一部分，再合并为同一份缓存（参考 convert_and_cache_sharded）
     logger = get_logger(args.log_name)
     logger.info(f'data loader worker num: {args.loader_worker_num}')
     assert (pathlib.Path(args.saved_model_path) / 'vocab.txt').exists()
@@ -505,31 +544,40 @@ def load_bertology_input(args):
     vocab = GraphVocab(args.graph_vocab_file)
     if args.command == 'train' and args.local_rank in [-1, 0]:
         tokenizer.save_pretrained(args.output_model_dir)
+    collator = get_collator(args, tokenizer)
 
     if args.command in ['dev', 'infer', 'test_after_train']:
-        # training 影响 Input Mask
         logger.info(f'Load data from {args.input_conllu_path}')
         dataset, conllu_file = load_and_cache_examples(args, args.input_conllu_path, vocab, tokenizer, training=False)
         data_loader = get_data_loader(dataset, batch_size=args.eval_batch_size, evaluation=True,
-                                      num_worker=args.loader_worker_num)
+                                      num_worker=args.loader_worker_num, collate_fn=collator,
+                                      pin_memory=args.device.type == 'cuda')
         return data_loader, conllu_file
     elif args.command == 'train':
-        if not args.merge_training:
+        mixture_probs = None
+        if getattr(args, 'train_shards_dir', None):
+            # 超出内存的训练语料：流式读取预先生成的shard
+            train_dataset = load_train_shards(args)
+            train_conllu_file = None
+        elif not args.merge_training:
             train_dataset, train_conllu_file = load_and_cache_examples(args,
                                                                        os.path.join(args.data_dir, args.train_file),
                                                                        vocab, tokenizer, training=True)
         else:
-            logger.info(f'merge train: use the ConcatTensorRandomDataset!!!')
+            logger.info(f'merge train: use the MixtureBatchSampler!!!')
             train_text_dataset, _ = load_and_cache_examples(args,
                                                             os.path.join(args.data_dir, args.train_text_file),
                                                             vocab, tokenizer, training=True)
             train_news_dataset, _ = load_and_cache_examples(args,
                                                             os.path.join(args.data_dir, args.train_news_file),
                                                             vocab, tokenizer, training=True)
-            train_dataset = ConcatTensorRandomDataset(datasets=[train_text_dataset, train_news_dataset],
-                                                      probs=None,
-                                                      exp=args.merge_train_exp,
-                                                      mode=args.merge_train_mode)
+            # 混合采样由 MixtureBatchSampler 在每个epoch开始时统一规划（支持分布式训练）
+            train_dataset = ConcatDataset([train_text_dataset, train_news_dataset])
+            mixture_probs = get_mixture_probs([len(train_text_dataset), len(train_news_dataset)],
+                                              probs=args.merge_train_prob,
+                                              exp=args.merge_train_exp,
+                                              mode=args.merge_train_mode)
+            logger.info(f'merge train probs (text, news): {mixture_probs.tolist()}')
             # 此时无法产生正确的train_conllu_file，不过所幸训练时可以不用train_conllu_file（不过这样就无法计算train metrics了）
             train_conllu_file = None
         train_data_loader = get_data_loader(train_dataset,
@@ -537,7 +585,15 @@ def load_bertology_input(args):
                                             evaluation=False,
                                             custom_dataset=args.merge_training,
                                             num_worker=args.loader_worker_num,
-                                            local_rank=args.local_rank)
+                                            local_rank=args.local_rank,
+                                            collate_fn=get_collator(args, tokenizer, training=True),
+                                            # DataParallel时一个batch会被均分到各个GPU上
+                                            batch_max_tokens=getattr(args, 'train_batch_max_tokens', 0) *
+                                                             max(1, args.n_gpu),
+                                            batch_length_unit=getattr(args, 'batch_length_unit', 'token'),
+                                            seed=args.seed,
+                                            mixture_probs=mixture_probs,
+                                            pin_memory=args.device.type == 'cuda')
 
         dev_dataset, dev_conllu_file = load_and_cache_examples(args,
                                                                os.path.join(args.data_dir, args.dev_file),
@@ -545,7 +601,9 @@ def load_bertology_input(args):
         dev_data_loader = get_data_loader(dev_dataset,
                                           batch_size=args.eval_batch_size,
                                           evaluation=True,
-                                          num_worker=args.loader_worker_num)
+                                          num_worker=args.loader_worker_num,
+                                          collate_fn=collator,
+                                          pin_memory=args.device.type == 'cuda')
         return train_data_loader, train_conllu_file, dev_data_loader, dev_conllu_file
     else:
         raise RuntimeError('不支持的command {train、dev、infer、test_after_train}')
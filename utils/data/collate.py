@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Created by li huayong on 2020/4/25
+from typing import Dict, List, Union
+
+import numpy as np
+import torch
+
+from utils.data.id_map import is_cjk_char
+
+
+def arcs_to_label_target(arcs: torch.Tensor, arc_nums: torch.Tensor, word_seq_len: int) -> torch.Tensor:
+    """
+        由 (dependent, head, label) 三元组生成dense的label target (batch_size x word_seq_len x word_seq_len)，
+        可以在collate阶段（CPU）调用，也可以直接在GPU上调用（arcs与arc_nums在哪个设备上就在哪个设备上生成）
+
+        没有任何依存弧的句子（空白的conllu文件，例如inference的输入）整体填充为-1
+
+    :param arcs: (arc_num x 3), batch内所有句子的依存弧拼接在一起
+    :param arc_nums: (batch_size,), 每个句子的依存弧数量
+    :param word_seq_len: 单词维度的长度（包含ROOT）
+    :return: long tensor
+    """
+    batch_size = arc_nums.size(0)
+    label_target = torch.zeros(batch_size, word_seq_len, word_seq_len, dtype=torch.long, device=arcs.device)
+    label_target[torch.eq(arc_nums, 0)] = -1
+    arcs = arcs.long()
+    batch_idx = torch.repeat_interleave(torch.arange(batch_size, device=arcs.device), arc_nums.long())
+    label_target[batch_idx, arcs[:, 0], arcs[:, 1]] = arcs[:, 2]
+    return label_target
+
+
+class BERTologyCollator(object):
+    """
+        动态padding：只把一个batch内的样本padding到该batch中最长的句子（而不是max_seq_len），
+        样本来自 utils.data.custom_dataset.RaggedTensorDataset
+
+        返回的tuple顺序和原先的TensorDataset保持一致：
+            input_ids, input_mask, segment_ids, start_pos, end_pos, dep_ids, pos_ids(如果有)
+
+        注意：
+        （1）start_pos/end_pos 的PAD值为该batch的token长度-1，
+            batch中token最长的句子在该位置上是[SEP]，而任何单词的位置都不会指向[SEP]，
+            其余句子在该位置上都是PAD，所以用 start_pos == input_ids.size(1)-1 即可得到单词粒度的PAD
+        （2）单词维度（包含ROOT）为batch中单词数最多的句子的长度
+        （3）数据集中依存弧以(dependent, head, label)三元组保存，dense的dep_ids在这里按照batch的实际长度生成
+    """
+
+    def __init__(self, pad_token_id: int = 0, pad_segment_id: int = 0, pos_pad_id: int = 0, input_masker=None):
+        """
+
+        :param input_masker: 训练数据的动态Input Mask（InputMasker），为None时不做mask（dev/infer）
+        """
+        self.pad_token_id = pad_token_id
+        self.pad_segment_id = pad_segment_id
+        self.pos_pad_id = pos_pad_id
+        self.input_masker = input_masker
+
+    def __call__(self, samples: Union[List[Dict[str, np.ndarray]], Dict[str, tuple]]):
+        """
+        :param samples: 样本列表（逐个样本取数据），
+                        或者 RaggedTensorDataset.get_batch 得到的整个batch（{name: (拼接之后的values, 每个样本的长度)}）
+        """
+        if isinstance(samples, dict):
+            batch = samples
+        else:
+            batch = {name: (np.concatenate([s[name] for s in samples]),
+                            np.array([len(s[name]) for s in samples], dtype=np.int64))
+                     for name in samples[0].keys()}
+        return self.collate_batch(batch)
+
+    def collate_batch(self, batch: Dict[str, tuple]):
+        """
+            对整个batch做padding：每个字段只需要一次scatter（O(字段数)次numpy操作，和batch大小无关）
+        """
+        token_lens = batch['input_ids'][1]
+        word_lens = batch['start_pos'][1]
+        batch_size = len(token_lens)
+        max_token_len, max_word_len = int(token_lens.max()), int(word_lens.max())
+
+        input_ids = _pad_flat(*batch['input_ids'], max_token_len, self.pad_token_id)
+        # 1 代表 实际输入； 0 代表 padding
+        input_mask = (np.arange(max_token_len)[None, :] < token_lens[:, None]).astype(np.int64)
+        segment_ids = _pad_flat(*batch['segment_ids'], max_token_len, self.pad_segment_id)
+        start_pos = _pad_flat(*batch['start_pos'], max_word_len, max_token_len - 1)
+        end_pos = _pad_flat(*batch['end_pos'], max_word_len, max_token_len - 1)
+
+        arcs, arc_nums = batch['arcs']
+        dep_ids = arcs_to_label_target(torch.from_numpy(np.asarray(arcs, dtype=np.int64).reshape(-1, 3)),
+                                       torch.from_numpy(arc_nums), max_word_len)
+        assert dep_ids.size(0) == batch_size
+
+        tensors = [torch.from_numpy(t) for t in (input_ids, input_mask, segment_ids, start_pos, end_pos)]
+        if self.input_masker is not None:
+            tensors[0] = self.input_masker(tensors[0], tensors[1], tensors[3], tensors[4])
+        tensors.append(dep_ids)
+        if 'pos_ids' in batch:
+            tensors.append(torch.from_numpy(_pad_flat(*batch['pos_ids'], max_word_len, self.pos_pad_id)))
+        return tuple(tensors)
+
+
+def _pad_flat(values: np.ndarray, lengths: np.ndarray, max_len: int, pad_value: int) -> np.ndarray:
+    """
+        把拼接在一起的变长序列一次性scatter到 (batch_size x max_len) 的padding矩阵中
+    """
+    padded = np.full((len(lengths), max_len), pad_value, dtype=np.int64)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(values)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    padded[rows, cols] = values
+    return padded
+
+
+def spans_to_token_mask(start_pos: torch.Tensor, end_pos: torch.Tensor, word_selected: torch.Tensor,
+                        token_seq_len: int) -> torch.Tensor:
+    """
+        把选中单词的token区间 [start_pos, end_pos] 展开为token粒度的mask（差分数组+累加和，不需要逐个单词循环）
+
+    :param start_pos: (batch_size x word_seq_len)
+    :param end_pos: (batch_size x word_seq_len)
+    :param word_selected: (batch_size x word_seq_len) bool
+    :param token_seq_len: token维度的长度
+    :return: (batch_size x token_seq_len) bool
+    """
+    selected = word_selected.long()
+    delta = torch.zeros(start_pos.size(0), token_seq_len + 1, dtype=torch.long, device=start_pos.device)
+    delta.scatter_add_(1, start_pos.long(), selected)
+    delta.scatter_add_(1, end_pos.long() + 1, -selected)
+    return delta.cumsum(dim=1)[:, :token_seq_len] > 0
+
+
+def get_cjk_token_table(tokenizer) -> torch.Tensor:
+    """
+        词表中每个token是否是单个CJK字符（bool，长度为词表大小，包含added tokens）
+    """
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    return torch.tensor([len(t) == 1 and is_cjk_char(t) for t in tokens], dtype=torch.bool)
+
+
+class InputMasker(object):
+    """
+        训练时的动态Input Mask：在collate阶段直接对padding之后的input_ids做mask，
+        预处理缓存中保存的始终是没有mask的token id，每个batch（每个epoch）都会重新采样mask
+
+        char: 以input_mask_prob的概率把单词中的单个CJK字符token替换为[MASK]
+              （只对CJK字符做mask，英文等经过WordPiece切分的token不做mask）
+        word: 以input_mask_prob的概率把整个单词（start_pos到end_pos之间的所有token）替换为[MASK]，
+              token数量不变，所以单词的开始、结束位置不需要重新计算
+
+        ROOT以及PAD单词永远不会被mask
+
+        注意：随机数来自torch的默认生成器，DataLoader的每个worker在每个epoch都会用不同的种子初始化该生成器，
+        所以不同worker、不同epoch得到的mask都不相同
+    """
+
+    def __init__(self, mask_token_id: int, mask_prob: float, granularity: str = 'char',
+                 cjk_token_table: torch.Tensor = None):
+        """
+
+        :param mask_token_id: [MASK]的id
+        :param mask_prob: 每个字（或者单词）被mask的概率
+        :param granularity: char or word
+        :param cjk_token_table: get_cjk_token_table 的结果，char粒度时必须提供
+        """
+        if granularity not in ['char', 'word']:
+            raise ValueError(f'illegal input mask granularity:{granularity}')
+        if granularity == 'char' and cjk_token_table is None:
+            raise ValueError('char granularity input mask needs cjk_token_table')
+        self.mask_token_id = mask_token_id
+        self.mask_prob = mask_prob
+        self.granularity = granularity
+        self.cjk_token_table = cjk_token_table
+
+    def __call__(self, input_ids: torch.Tensor, input_mask: torch.Tensor, start_pos: torch.Tensor,
+                 end_pos: torch.Tensor) -> torch.Tensor:
+        """
+            所有tensor都是padding之后的batch（可以在CPU上，也可以在GPU上）
+        :return: mask之后的input_ids
+        """
+        token_seq_len = input_ids.size(1)
+        # 第0个单词是ROOT；start_pos == token_seq_len-1 的位置是PAD单词
+        real_words = torch.ne(start_pos, token_seq_len - 1)
+        real_words[:, 0] = False
+        if self.granularity == 'char':
+            word_tokens = spans_to_token_mask(start_pos, end_pos, real_words, token_seq_len)
+            candidates = word_tokens & input_mask.bool() & self.cjk_token_table.to(input_ids.device)[input_ids]
+            masked = candidates & (torch.rand(input_ids.shape, device=input_ids.device) < self.mask_prob)
+        else:
+            selected = real_words & (torch.rand(start_pos.shape, device=start_pos.device) < self.mask_prob)
+            masked = spans_to_token_mask(start_pos, end_pos, selected, token_seq_len)
+        return input_ids.masked_fill(masked, self.mask_token_id)
+
+
+if __name__ == '__main__':
+    pass
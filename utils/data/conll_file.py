@@ -3,13 +3,17 @@ A wrapper/loader for the official conll-u format files.
 """
 import os
 import io
+from array import array
 from typing import List, Tuple
 
+import numpy as np
+
 FIELD_NUM = 10
 
 FIELD_TO_IDX = {'id': 0, 'word': 1, 'lemma': 2, 'upos': 3, 'xpos': 4,
                 'feats': 5, 'head': 6, 'deprel': 7, 'deps': 8,
                 'misc': 9}
+_HEAD_IDX, _DEPREL_IDX, _DEPS_IDX, _MISC_IDX = [FIELD_TO_IDX[f] for f in ('head', 'deprel', 'deps', 'misc')]
 
 
 class CoNLLFile(object):
@@ -159,23 +163,36 @@ class CoNLLFile(object):
                 cidx += 1
         return
 
-    def write_conll(self, filename):
+    def set_arcs(self, arcs):
+        """
+            写入预测的依存弧，只修改 head、deprel、deps 三列，
+            不需要像 set(['deps'], ...) 那样重新切分每个deps字符串
+        :param arcs: 每个句子每个单词的 (head, deprel, deps)，参考 GraphVocab.parse_to_arcs_batch
+        """
+        if len(arcs) != len(self.sents):
+            raise ValueError(f'arcs num ({len(arcs)}) != sentences num ({len(self.sents)})')
+        for sent, sent_arcs in zip(self.sents, arcs):
+            words = [ln for ln in sent if '-' not in ln[0]]
+            if len(words) != len(sent_arcs):
+                raise ValueError(f'arcs num ({len(sent_arcs)}) != words num ({len(words)})')
+            for ln, (head, deprel, deps) in zip(words, sent_arcs):
+                ln[_HEAD_IDX] = head
+                ln[_DEPREL_IDX] = deprel
+                ln[_DEPS_IDX] = deps
+        return
+
+    def write_conll(self, filename, arcs=None):
         """ Write current conll contents to file.
+            arcs不为None时，写入时用预测的依存弧替换 head、deprel、deps 三列（参考 set_arcs）
         """
-        conll_string = self.conll_as_string()
-        with open(filename, 'w', encoding='utf-8') as outfile:
-            outfile.write(conll_string)
+        with CoNLLUWriter(filename) as writer:
+            writer.write_sentences(self.sents, arcs)
         return
 
     def conll_as_string(self):
         """ Return current conll contents as string
         """
-        return_string = ""
-        for sent in self.sents:
-            for ln in sent:
-                return_string += ("\t".join(ln) + "\n")
-            return_string += "\n"
-        return return_string
+        return ''.join(sentence_as_string(sent) for sent in self.sents)
 
     def write_conll_with_lemmas(self, lemmas, filename):
         """ Write a new conll file, but use the new lemmas to replace the old ones."""
@@ -266,6 +283,509 @@ class CoNLLFile(object):
         return
 
 
+class IndexedCoNLLFile(CoNLLFile):
+    """
+        按需读取的CoNLL-U文件：
+        （1）第一次使用时扫描一遍文件，记录每个句子在文件中的字节范围（[start, end)），
+            索引缓存在文件旁边（{filename}.index.npz），文件大小或修改时间变化后自动重建
+        （2）通过下标或切片随机访问句子（conll_file[i], conll_file[i:j]），只解析需要的句子，
+            整个文件不需要一次性读入内存，DataLoader的worker也可以按下标读取句子
+        （3）iter_sents 按顺序流式读取所有句子
+
+        返回的句子格式和 CoNLLFile.sents 中的元素一致（每行是一个字段列表），
+        访问 sents（set/write_conll等方法依赖它）时仍然会加载整个文件
+    """
+    # 2: 只包含注释行（或者被忽略的gapping行）的块不再作为句子
+    INDEX_FORMAT_VERSION = 2
+
+    def __init__(self, filename, ignore_gapping=True, use_index_cache=True, index_file=None):
+        """
+
+        :param filename: conllu文件路径（不支持input_str）
+        :param ignore_gapping:
+        :param use_index_cache: 是否读取/保存索引缓存
+        :param index_file: 索引缓存的路径，默认为 {filename}.index.npz
+        """
+        super().__init__(filename=filename, ignore_gapping=ignore_gapping)
+        self.use_index_cache = use_index_cache
+        self.index_file = index_file if index_file is not None else filename + '.index.npz'
+        self._handle = None
+        self._handle_pid = None
+
+    def __getstate__(self):
+        # 文件句柄不能跨进程传递，各个进程（例如DataLoader worker）各自重新打开
+        state = self.__dict__.copy()
+        state['_handle'] = None
+        state['_handle_pid'] = None
+        return state
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, '_handle', None) is not None:
+            self._handle.close()
+            self._handle = None
+
+    def _file_signature(self):
+        stat = os.stat(self.file)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def _load_index_cache(self, signature):
+        if not self.use_index_cache or not os.path.isfile(self.index_file):
+            return None
+        try:
+            with np.load(self.index_file) as data:
+                if int(data['version']) != self.INDEX_FORMAT_VERSION or not np.array_equal(data['signature'],
+                                                                                          signature) \
+                        or bool(data['ignore_gapping']) != self.ignore_gapping:
+                    return None
+                return data['spans']
+        except (OSError, KeyError, ValueError):
+            # 缓存损坏，重新建立索引
+            return None
+
+    def _save_index_cache(self, spans, signature):
+        if not self.use_index_cache:
+            return
+        tmp_file = f'{self.index_file}.tmp{os.getpid()}.npz'
+        try:
+            np.savez(tmp_file, version=np.int64(self.INDEX_FORMAT_VERSION), signature=signature, spans=spans,
+                     ignore_gapping=np.bool_(self.ignore_gapping))
+            os.replace(tmp_file, self.index_file)
+        except OSError:
+            # 文件所在目录不可写时，只在内存中使用索引
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def build_index(self):
+        """
+            扫描一遍文件，得到每个句子（以空行分隔的块）的字节范围：
+            句子从块中第一个单词行开始（之前的注释行不包含在内），
+            和 CoNLLFile.load_conll 一致，没有任何单词行的块（例如只有注释）不作为句子
+        :return: int64 array (sent_num x 2)
+        """
+        spans = []
+        start = None
+        pos = 0
+        with open(self.file, 'rb') as f:
+            for line in f:
+                stripped = line.strip()
+                if stripped:
+                    if start is None and not stripped.startswith(b'#') and \
+                            not (self.ignore_gapping and b'.' in stripped.split(b'\t', 1)[0]):
+                        start = pos
+                elif start is not None:
+                    spans.append((start, pos))
+                    start = None
+                pos += len(line)
+        if start is not None:
+            spans.append((start, pos))
+        return np.array(spans, dtype=np.int64).reshape(-1, 2)
+
+    @property
+    def spans(self):
+        if not hasattr(self, '_spans'):
+            signature = self._file_signature()
+            spans = self._load_index_cache(signature)
+            if spans is None:
+                spans = self.build_index()
+                self._save_index_cache(spans, signature)
+            self._spans = spans
+        return self._spans
+
+    def _read_bytes(self, start, end):
+        if self._handle is None or self._handle_pid != os.getpid():
+            self._handle = open(self.file, 'rb')
+            self._handle_pid = os.getpid()
+        self._handle.seek(start)
+        return self._handle.read(end - start)
+
+    def _parse_block(self, block: str):
+        sent = []
+        for line in block.split('\n'):
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):  # skip comment line
+                continue
+            array = line.split('\t')
+            if self.ignore_gapping and '.' in array[0]:
+                continue
+            assert len(array) == FIELD_NUM
+            sent.append(array)
+        return sent
+
+    def get_sentence(self, idx):
+        start, end = self.spans[idx]
+        return self._parse_block(self._read_bytes(int(start), int(end)).decode('utf-8'))
+
+    def get_sentences(self, start, end):
+        """
+            读取下标在[start, end)之间的句子，连续的句子只需要一次读取
+        """
+        spans = self.spans[start:end]
+        if len(spans) == 0:
+            return []
+        base = int(spans[0, 0])
+        block = self._read_bytes(base, int(spans[-1, 1]))
+        return [self._parse_block(block[s - base:e - base].decode('utf-8')) for s, e in spans.tolist()]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step == 1:
+                return self.get_sentences(start, stop)
+            return [self.get_sentence(i) for i in range(start, stop, step)]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(f'sentence index out of range: {item}')
+        return self.get_sentence(item)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def iter_sents(self, chunk_size=1000):
+        """
+            按顺序流式读取所有句子（每次读取chunk_size个句子）
+        """
+        for start in range(0, len(self), chunk_size):
+            yield from self.get_sentences(start, start + chunk_size)
+
+    def load_conll(self):
+        return list(self.iter_sents())
+
+    @property
+    def num_words(self):
+        """ Num of total words, after multi-word expansion."""
+        if not hasattr(self, '_num_words'):
+            sents = self._sents if hasattr(self, '_sents') else self.iter_sents()
+            self._num_words = sum(1 for sent in sents for ln in sent if '-' not in ln[0])
+        return self._num_words
+
+    def get(self, fields, as_sentences=False, start=0, end=None):
+        """
+            和CoNLLFile.get相同，但是不需要先把整个文件加载为sents；
+            可以通过start/end只读取一部分句子
+        """
+        assert isinstance(fields, list), "Must provide field names as a list."
+        assert len(fields) >= 1, "Must have at least one field."
+        field_idxs = [FIELD_TO_IDX[f.lower()] for f in fields]
+        end = len(self) if end is None else min(end, len(self))
+        if hasattr(self, '_sents'):
+            sents = self._sents[start:end]
+        else:
+            sents = self.get_sentences(start, end)
+        results = []
+        for sent in sents:
+            if len(field_idxs) == 1:
+                cursent = [ln[field_idxs[0]] for ln in sent if '-' not in ln[0]]
+            else:
+                cursent = [[ln[fid] for fid in field_idxs] for ln in sent if '-' not in ln[0]]
+            if as_sentences:
+                results.append(cursent)
+            else:
+                results += cursent
+        return results
+
+
+def _compact_codes(codes, table_size):
+    """ 根据字符串表的大小选择能容纳所有下标的最小整数类型 """
+    if table_size <= np.iinfo(np.uint8).max + 1:
+        dtype = np.uint8
+    elif table_size <= np.iinfo(np.uint16).max + 1:
+        dtype = np.uint16
+    else:
+        dtype = np.int32
+    return np.asarray(codes).astype(dtype, copy=False)
+
+
+class ColumnarCoNLLFile(CoNLLFile):
+    """
+        按列存储的CoNLL-U文件，用来替代 list-of-lists-of-strings 以及 CoNLLUData/CoNLLUSent/CoNLLUWord 对象树：
+        （1）每一列的字符串保存在该列的字符串表中（相同的字符串只保存一次），
+            每一行只保存字符串表的下标（按字符串表的大小使用uint8/uint16/int32），每个token只占用十几个字节
+        （2）sent_offsets 记录每个句子在所有行中的起止位置
+        （3）pickle时只保存几个数组和字符串表，而不是大量的小对象
+
+        get/set/set_arcs/write_conll 直接基于列实现；
+        sents 仍然可用，但每次访问都会重新生成 list-of-lists（修改它不会影响本对象），应尽量避免使用
+    """
+
+    def __init__(self, filename=None, input_str=None, ignore_gapping=True):
+        super().__init__(filename=filename, input_str=input_str, ignore_gapping=ignore_gapping)
+        self._columns = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # 字符串到下标的字典可以由字符串表重建，不需要保存
+        state.pop('_table_index', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._columns is not None:
+            self._table_index = [{v: i for i, v in enumerate(table)} for table in self._tables]
+
+    def load_columns(self):
+        """
+            逐行读取文件，直接生成按列存储的数据（不生成中间的句子列表）
+        """
+        table_index = [dict() for _ in range(FIELD_NUM)]
+        codes = [array('q') for _ in range(FIELD_NUM)]
+        sent_lens = []
+        line_num = 0
+        if self._from_str:
+            infile = io.StringIO(self.file)
+        else:
+            infile = open(self.file, encoding='utf-8')
+        for line in infile:
+            line = line.strip()
+            if len(line) == 0:
+                if line_num > 0:
+                    sent_lens.append(line_num)
+                    line_num = 0
+                continue
+            if line.startswith('#'):  # skip comment line
+                continue
+            fields = line.split('\t')
+            if self.ignore_gapping and '.' in fields[0]:
+                continue
+            assert len(fields) == FIELD_NUM
+            for index, column, value in zip(table_index, codes, fields):
+                code = index.get(value)
+                if code is None:
+                    code = index[value] = len(index)
+                column.append(code)
+            line_num += 1
+        if line_num > 0:
+            sent_lens.append(line_num)
+        if not self._from_str:
+            infile.close()
+        self._table_index = table_index
+        # dict保持插入顺序，即字符串表的顺序
+        self._tables = [list(index.keys()) for index in table_index]
+        self._columns = [_compact_codes(np.frombuffer(column, dtype=np.int64) if len(column) else
+                                        np.zeros(0, dtype=np.int64), len(table))
+                         for column, table in zip(codes, self._tables)]
+        self._sent_offsets = np.concatenate([[0], np.cumsum(sent_lens, dtype=np.int64)]).astype(np.int64)
+        self._update_word_mask()
+
+    def _ensure_loaded(self):
+        if self._columns is None:
+            self.load_columns()
+
+    def _update_word_mask(self):
+        # 多词单元行（id形如 1-2）不是单词
+        is_mwt = np.array(['-' in v for v in self._tables[FIELD_TO_IDX['id']]], dtype=np.bool_)
+        self._word_mask = ~is_mwt[self._columns[FIELD_TO_IDX['id']]] if len(is_mwt) else \
+            np.zeros(0, dtype=np.bool_)
+        word_cum = np.concatenate([[0], np.cumsum(self._word_mask, dtype=np.int64)])
+        self._word_offsets = word_cum[self._sent_offsets]
+
+    def load_conll(self):
+        self._ensure_loaded()
+        return [self.sentence(i) for i in range(len(self))]
+
+    @property
+    def sents(self):
+        return self.load_conll()
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._sent_offsets) - 1
+
+    @property
+    def num_words(self):
+        """ Num of total words, after multi-word expansion."""
+        self._ensure_loaded()
+        return int(self._word_offsets[-1])
+
+    def sentence(self, idx):
+        """ 第idx个句子，格式和 CoNLLFile.sents 中的元素一致 """
+        self._ensure_loaded()
+        start, end = int(self._sent_offsets[idx]), int(self._sent_offsets[idx + 1])
+        columns = [[table[c] for c in column[start:end].tolist()] for table, column in
+                   zip(self._tables, self._columns)]
+        return [list(ln) for ln in zip(*columns)]
+
+    def _decode_words(self, field_idx):
+        table = self._tables[field_idx]
+        return [table[c] for c in self._columns[field_idx][self._word_mask].tolist()]
+
+    def get(self, fields, as_sentences=False):
+        """ Get fields from a list of field names. If only one field name is provided, return a list
+        of that field; if more than one, return a list of list. Note that all returned fields are after
+        multi-word expansion.
+        """
+        assert isinstance(fields, list), "Must provide field names as a list."
+        assert len(fields) >= 1, "Must have at least one field."
+        self._ensure_loaded()
+        field_idxs = [FIELD_TO_IDX[f.lower()] for f in fields]
+        if len(field_idxs) == 1:
+            results = self._decode_words(field_idxs[0])
+        else:
+            results = [list(w) for w in zip(*[self._decode_words(fid) for fid in field_idxs])]
+        if as_sentences:
+            offsets = self._word_offsets.tolist()
+            results = [results[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        return results
+
+    def _set_words_column(self, field_idx, values: List[str]):
+        index, table = self._table_index[field_idx], self._tables[field_idx]
+        codes = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(table)
+                table.append(value)
+            codes[i] = code
+        column = self._columns[field_idx].astype(np.int64)
+        column[self._word_mask] = codes
+        self._columns[field_idx] = _compact_codes(column, len(table))
+        if field_idx == FIELD_TO_IDX['id']:
+            self._update_word_mask()
+
+    def set(self, fields, contents):
+        """
+        Set fields based on contents. If only one field (singleton list) is provided,
+        then a list of content will be expected; otherwise a list of list of contents will be expected.
+        """
+        assert isinstance(fields, list), "Must provide field names as a list."
+        assert isinstance(contents, list), "Must provide contents as a list (one item per line)."
+        assert len(fields) >= 1, "Must have at least one field."
+        if self.num_words != len(contents):
+            raise ValueError(f"Contents must have the same number as the original file: "
+                             f"{len(contents)} != {self.num_words}")
+        field_idxs = [FIELD_TO_IDX[f.lower()] for f in fields]
+        if len(field_idxs) == 1:
+            self._set_words_column(field_idxs[0], contents)
+            if fields == ['deps']:
+                heads, deprels = zip(*(c.split('|')[0].split(':') for c in contents)) if contents else ([], [])
+                self._set_words_column(_HEAD_IDX, list(heads))
+                self._set_words_column(_DEPREL_IDX, list(deprels))
+        else:
+            for fid, column in zip(field_idxs, zip(*contents)):
+                self._set_words_column(fid, list(column))
+        return
+
+    def set_arcs(self, arcs):
+        """
+            写入预测的依存弧，只修改 head、deprel、deps 三列
+        :param arcs: 每个句子每个单词的 (head, deprel, deps)，参考 GraphVocab.parse_to_arcs_batch
+        """
+        if len(arcs) != len(self):
+            raise ValueError(f'arcs num ({len(arcs)}) != sentences num ({len(self)})')
+        word_arcs = [a for sent_arcs in arcs for a in sent_arcs]
+        if len(word_arcs) != self.num_words:
+            raise ValueError(f'arcs num ({len(word_arcs)}) != words num ({self.num_words})')
+        heads, deprels, deps = zip(*word_arcs) if word_arcs else ([], [], [])
+        self._set_words_column(_HEAD_IDX, list(heads))
+        self._set_words_column(_DEPREL_IDX, list(deprels))
+        self._set_words_column(_DEPS_IDX, list(deps))
+        return
+
+    def write_conll(self, filename, arcs=None):
+        """ Write current conll contents to file.
+            arcs不为None时，写入时用预测的依存弧替换 head、deprel、deps 三列
+        """
+        if arcs is not None and len(arcs) != len(self):
+            raise ValueError(f'arcs num ({len(arcs)}) != sentences num ({len(self)})')
+        with CoNLLUWriter(filename) as writer:
+            for i in range(len(self)):
+                writer.write_sentence(self.sentence(i), arcs[i] if arcs is not None else None)
+        return
+
+    def conll_as_string(self):
+        """ Return current conll contents as string
+        """
+        return ''.join(sentence_as_string(self.sentence(i)) for i in range(len(self)))
+
+
+def sentence_as_string(sent: List[List[str]], arcs: List[Tuple[str, str, str]] = None) -> str:
+    """
+        Return one sentence in conll format (with the trailing blank line)
+
+    :param sent: CoNLLFile.sents 中的一个句子
+    :param arcs: 不为None时，用每个单词的 (head, deprel, deps) 替换对应的三列（不修改sent本身）
+    """
+    if arcs is None:
+        return ''.join("\t".join(ln) + "\n" for ln in sent) + "\n"
+    lines = []
+    arc_iter = iter(arcs)
+    for ln in sent:
+        if '-' in ln[0]:
+            lines.append("\t".join(ln))
+        else:
+            head, deprel, deps = next(arc_iter)
+            lines.append("\t".join(ln[:_HEAD_IDX]) + f"\t{head}\t{deprel}\t{deps}\t" + ln[_MISC_IDX])
+    return "\n".join(lines) + "\n\n"
+
+
+class CoNLLUWriter(object):
+    """
+        带缓冲的CoNLL-U写入：逐句把文本放入缓冲区，缓冲区超过buffer_size个字符时一次性写入文件，
+        不需要先把整个输出拼接为一个字符串
+
+        with CoNLLUWriter(output_file) as writer:
+            writer.write_sentences(conll_file.sents, arcs)
+    """
+
+    def __init__(self, file, buffer_size=1 << 20):
+        """
+
+        :param file: 文件路径或者已打开的文件对象（文件对象由调用者负责关闭）
+        :param buffer_size: 缓冲区大小（字符数）
+        """
+        if isinstance(file, (str, os.PathLike)):
+            self._file = open(file, 'w', encoding='utf-8')
+            self._own_file = True
+        else:
+            self._file = file
+            self._own_file = False
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffer_len = 0
+
+    def write_sentence(self, sent: List[List[str]], arcs: List[Tuple[str, str, str]] = None):
+        text = sentence_as_string(sent, arcs)
+        self._buffer.append(text)
+        self._buffer_len += len(text)
+        if self._buffer_len >= self.buffer_size:
+            self.flush()
+
+    def write_sentences(self, sents, arcs=None):
+        """
+        :param sents: 句子列表
+        :param arcs: 每个句子的预测结果（参考 GraphVocab.parse_to_arcs_batch），为None时原样写入
+        """
+        if arcs is None:
+            for sent in sents:
+                self.write_sentence(sent)
+        else:
+            if len(sents) != len(arcs):
+                raise ValueError(f'arcs num ({len(arcs)}) != sentences num ({len(sents)})')
+            for sent, sent_arcs in zip(sents, arcs):
+                self.write_sentence(sent, sent_arcs)
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffer_len = 0
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        if self._own_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class CoNLLUWord(object):
     def __init__(self, word_data):
         self.word = word_data[0]
@@ -1,9 +1,233 @@
 import bisect
+import json
+import os
+import pathlib
+import shutil
 import warnings
 from torch.utils.data import Dataset, TensorDataset
 from torch.utils.data import IterableDataset
 import numpy as np
-from typing import List
+from typing import Dict, List
+
+# 缓存格式的版本号，格式变化时需要修改
+RAGGED_DATASET_FORMAT_VERSION = 1
+RAGGED_DATASET_META_FILE = 'meta.json'
+
+
+def lengths_to_offsets(lengths) -> np.ndarray:
+    """
+        由每个样本的长度得到offsets，第i个样本对应 values[offsets[i]:offsets[i+1]]
+    :param lengths:
+    :return: int64, 长度为 len(lengths)+1
+    """
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def concat_ragged_arrays(parts: List) -> tuple:
+    """
+        拼接多个 (values, offsets)，例如分块并行预处理的结果
+        在同一个part中共享offsets的字段，拼接之后仍然共享offsets
+
+    :param parts: [(values, offsets), ...]，所有part的字段必须一致
+    :return: (values, offsets)
+    """
+    if len(parts) == 1:
+        return parts[0]
+    first_values, first_offsets = parts[0]
+    values = {name: np.concatenate([p[0][name] for p in parts]) for name in first_values.keys()}
+    offsets = {}
+    shared_offsets = {}
+    for name, first in first_offsets.items():
+        if id(first) not in shared_offsets:
+            lengths = np.concatenate([np.diff(p[1][name]) for p in parts])
+            shared_offsets[id(first)] = lengths_to_offsets(lengths)
+        offsets[name] = shared_offsets[id(first)]
+    return values, offsets
+
+
+def compact_int_array(array: np.ndarray) -> np.ndarray:
+    """
+        将整数数组转换为能容纳其取值范围的最小的数据类型（uint8/int16/int32/int64）
+    """
+    if array.size == 0:
+        return array.astype(np.uint8)
+    min_value, max_value = int(array.min()), int(array.max())
+    for dtype in (np.uint8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return array.astype(dtype, copy=False)
+    return array.astype(np.int64, copy=False)
+
+
+class RaggedTensorDataset(Dataset):
+    r"""
+    变长（不做padding）的数据集：
+    每个字段保存为一个拼接之后的扁平数组 values[name] 以及对应的 offsets[name]，
+    第i个样本该字段的取值为 values[name][offsets[name][i]:offsets[name][i+1]]
+    注意：
+    （1）padding推迟到collate阶段，按照batch内最长的句子完成，参考 utils.data.collate.BERTologyCollator
+    （2）长度相同的字段可以共享同一个offsets数组（例如input_ids与segment_ids）
+    （3）可以用save_to_dir保存为一个目录（每个数组一个.npy文件+meta.json），
+        load_from_dir以numpy.memmap的方式加载，DataLoader的各个worker以及分布式训练的各个进程共享同一份page cache，
+        加载几乎不耗时，内存占用也不会随着worker数量增长
+    """
+
+    def __init__(self, values: Dict[str, np.ndarray], offsets: Dict[str, np.ndarray], mmap_dir: str = None):
+        super().__init__()
+        assert values and set(values.keys()) == set(offsets.keys()), 'values和offsets的字段必须一致'
+        sample_nums = {len(o) - 1 for o in offsets.values()}
+        assert len(sample_nums) == 1, '所有字段的样本数量必须相同'
+        self.values = values
+        self.offsets = offsets
+        self._len = sample_nums.pop()
+        # 如果是从缓存目录memmap加载的，记录目录路径（序列化时只传递路径，不复制数据）
+        self.mmap_dir = mmap_dir
+
+    def save_to_dir(self, save_dir):
+        """
+            保存为一个目录：每个字段的values和offsets各一个.npy文件（共享的offsets只保存一次），以及一个meta.json
+            先写入临时目录，完成之后再rename，保证不会读到写了一半的缓存
+        """
+        save_dir = pathlib.Path(save_dir)
+        tmp_dir = save_dir.with_name(f'{save_dir.name}.tmp-{os.getpid()}')
+        if tmp_dir.exists():
+            shutil.rmtree(str(tmp_dir))
+        tmp_dir.mkdir(parents=True)
+        meta = {'version': RAGGED_DATASET_FORMAT_VERSION, 'size': len(self), 'fields': {}}
+        offsets_files = {}
+        for name, value in self.values.items():
+            values_file = f'{name}.npy'
+            np.save(str(tmp_dir / values_file), compact_int_array(np.asarray(value)))
+            offsets = self.offsets[name]
+            if id(offsets) not in offsets_files:
+                offsets_files[id(offsets)] = f'{name}.offsets.npy'
+                np.save(str(tmp_dir / offsets_files[id(offsets)]), np.asarray(offsets, dtype=np.int64))
+            meta['fields'][name] = {'values': values_file, 'offsets': offsets_files[id(offsets)]}
+        with open(str(tmp_dir / RAGGED_DATASET_META_FILE), 'w', encoding='utf-8')as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        if save_dir.exists():
+            shutil.rmtree(str(save_dir))
+        os.rename(str(tmp_dir), str(save_dir))
+
+    @classmethod
+    def is_saved_dir(cls, save_dir) -> bool:
+        meta_file = pathlib.Path(save_dir) / RAGGED_DATASET_META_FILE
+        if not meta_file.is_file():
+            return False
+        with open(str(meta_file), encoding='utf-8')as f:
+            return json.load(f).get('version') == RAGGED_DATASET_FORMAT_VERSION
+
+    @classmethod
+    def load_from_dir(cls, save_dir):
+        """
+            以只读的numpy.memmap方式加载save_to_dir保存的数据集
+        """
+        save_dir = pathlib.Path(save_dir)
+        with open(str(save_dir / RAGGED_DATASET_META_FILE), encoding='utf-8')as f:
+            meta = json.load(f)
+        if meta['version'] != RAGGED_DATASET_FORMAT_VERSION:
+            raise RuntimeError(f'不支持的缓存格式版本:{meta["version"]}')
+        arrays = {}
+
+        def _load(file_name):
+            if file_name not in arrays:
+                arrays[file_name] = np.load(str(save_dir / file_name), mmap_mode='r')
+            return arrays[file_name]
+
+        values = {name: _load(files['values']) for name, files in meta['fields'].items()}
+        offsets = {name: _load(files['offsets']) for name, files in meta['fields'].items()}
+        return cls(values, offsets, mmap_dir=str(save_dir))
+
+    def __getstate__(self):
+        if self.mmap_dir is not None:
+            # memmap数据只传递目录路径，反序列化时重新映射（例如spawn方式启动的DataLoader worker）
+            return {'mmap_dir': self.mmap_dir}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if set(state.keys()) == {'mmap_dir'}:
+            state = self.load_from_dir(state['mmap_dir']).__dict__
+        self.__dict__.update(state)
+
+    @property
+    def fields(self) -> List[str]:
+        return list(self.values.keys())
+
+    def get_lengths(self, name: str) -> np.ndarray:
+        """
+            每个样本在某个字段上的长度
+        """
+        return np.diff(self.offsets[name])
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, tuple, np.ndarray)):
+            # 由batch sampler直接给出整个batch的下标，参考 get_batch
+            return self.get_batch(idx)
+        if idx < 0:
+            idx = len(self) + idx
+        sample = {}
+        for name, value in self.values.items():
+            offsets = self.offsets[name]
+            # np.asarray: 对memmap的切片不复制数据，只去掉memmap的子类
+            sample[name] = np.asarray(value[offsets[idx]:offsets[idx + 1]])
+        return sample
+
+    def get_batch(self, indices) -> Dict[str, tuple]:
+        """
+            一次取出一个batch：每个字段只需要一次fancy indexing（共享offsets的字段共用同一个下标数组），
+            下标连续且递增时（例如顺序读取的dev/test数据）直接返回切片，不复制数据
+
+        :param indices: 样本下标
+        :return: {name: (batch内所有样本拼接之后的values, 每个样本的长度)}
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        contiguous = len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1 and \
+            np.all(np.diff(indices) == 1)
+        gathers = {}
+        batch = {}
+        for name, value in self.values.items():
+            offsets = self.offsets[name]
+            if id(offsets) not in gathers:
+                starts = np.asarray(offsets[indices], dtype=np.int64)
+                lengths = np.asarray(offsets[indices + 1], dtype=np.int64) - starts
+                if contiguous:
+                    gather = slice(int(starts[0]), int(starts[-1] + lengths[-1]))
+                else:
+                    # 每个样本的第j个元素在values中的位置为 starts[i] + j
+                    batch_offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+                    gather = np.repeat(starts - batch_offsets, lengths) + np.arange(int(lengths.sum()))
+                gathers[id(offsets)] = (gather, lengths)
+            gather, lengths = gathers[id(offsets)]
+            batch[name] = (np.asarray(value[gather]), lengths)
+        return batch
+
+
+def get_mixture_probs(lengths: List[int], probs: List[float] = None, exp: float = None, mode: str = 'exp'):
+    """
+        多个源混合采样时每个源的采样概率
+
+    :param lengths: 每个源的数据量
+    :param probs: mode == 'prob' 时直接使用的概率
+    :param exp: mode == 'exp' 时的指数平滑系数，0<exp<1
+    :param mode: prob 或者 exp
+    :return: np.ndarray
+    """
+    assert mode in ['prob', 'exp'], 'mode只能为prob或者exp'
+    if mode == 'exp':
+        assert exp and 0 < exp < 1
+        original_probs = np.asarray(lengths) / np.sum(lengths)
+        # 指数加权
+        probs_exp = original_probs ** exp
+        # softmax
+        pes = np.exp(probs_exp)
+        return pes / np.sum(pes)
+    assert isinstance(probs, list) and len(probs) == len(lengths) and np.isclose(sum(probs), 1)
+    return np.array(probs)
 
 
 class ConcatTensorRandomDataset(Dataset):
@@ -38,16 +262,7 @@ class ConcatTensorRandomDataset(Dataset):
         for d in self.datasets:
             assert not isinstance(d, IterableDataset), "ConcatDataset does not support IterableDataset"
             self.original_lengths.append(len(d))
-        if mode == 'exp':
-            original_probs = self.original_lengths / np.sum(self.original_lengths)
-            # 指数加权
-            probs_exp = original_probs ** exp
-            # softmax
-            pes = np.exp(probs_exp)
-            self.probs = pes / np.sum(pes)
-        else:
-            assert isinstance(probs, list) and probs
-            self.probs = np.array(probs)
+        self.probs = get_mixture_probs(self.original_lengths, probs=probs, exp=exp, mode=mode)
         self.sample_total_length = np.sum(self.original_lengths * self.probs)
 
     def __len__(self):
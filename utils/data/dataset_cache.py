@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Created by li huayong on 2020/4/26
+"""
+    预处理数据缓存的管理：
+    缓存文件名由输入文件内容、tokenizer词表、graph vocab以及所有影响特征的配置项的哈希值决定（content-addressed），
+    任何一项发生变化都会自动得到一个新的缓存，不再需要手动清空 dataset/cached
+"""
+import hashlib
+import json
+import os
+import pathlib
+from typing import Dict, Tuple
+
+from utils.data.custom_dataset import RAGGED_DATASET_FORMAT_VERSION
+
+# 所有影响预处理结果（特征）的配置项
+# 注意：缓存中保存的是不做padding、不截断的token id（padding在collate阶段完成，过长的句子由encoder滑动窗口编码），
+# 所以max_seq_len不影响特征，不同max_seq_len的实验共用同一份缓存
+FEATURE_CONFIG_FIELDS = [
+    'encoder_type',
+    'bertology_type',
+    'root_representation',
+    'use_pos',
+]
+
+# 进程内缓存文件的哈希值，key: (文件绝对路径, 文件大小, 修改时间)
+_file_digest_memo: Dict[Tuple[str, int, int], str] = {}
+
+
+def file_digest(file_path, chunk_size=1 << 20) -> str:
+    """
+        文件内容的sha1值（分块读取，不会把整个文件读入内存）
+    """
+    file_path = pathlib.Path(file_path).resolve()
+    stat = file_path.stat()
+    memo_key = (str(file_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_digest_memo:
+        sha1 = hashlib.sha1()
+        with open(str(file_path), 'rb')as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        _file_digest_memo[memo_key] = sha1.hexdigest()
+    return _file_digest_memo[memo_key]
+
+
+def get_feature_info(args, tokenizer_vocab_file, graph_vocab_file, pos_list_file=None) -> Dict:
+    """
+        除输入文件之外，所有决定预处理特征的信息（词表文件的哈希值以及配置项）
+
+    :param args: 配置参数
+    :param tokenizer_vocab_file: BERTology tokenizer的词表文件
+    :param graph_vocab_file: 依存标签词表文件
+    :param pos_list_file: 词性列表文件（use_pos时dev数据依赖训练时生成的词性列表）
+    """
+    feature_info = {
+        'tokenizer_vocab': file_digest(tokenizer_vocab_file),
+        'graph_vocab': file_digest(graph_vocab_file),
+        'configs': {k: getattr(args, k, None) for k in FEATURE_CONFIG_FIELDS},
+    }
+    if pos_list_file is not None and os.path.isfile(str(pos_list_file)):
+        feature_info['pos_list'] = file_digest(pos_list_file)
+    return feature_info
+
+
+def get_feature_cache_key(args, conllu_file_path, tokenizer_vocab_file, graph_vocab_file,
+                          pos_list_file=None, training=False) -> str:
+    """
+        计算预处理特征缓存的key
+
+    :param args: 配置参数
+    :param conllu_file_path: 输入的conllu文件
+    :param tokenizer_vocab_file: BERTology tokenizer的词表文件
+    :param graph_vocab_file: 依存标签词表文件
+    :param pos_list_file: 词性列表文件（use_pos时dev数据依赖训练时生成的词性列表）
+    :param training: 是否是训练数据
+    :return: 16位十六进制字符串
+    """
+    key_items = {
+        'cache_format_version': RAGGED_DATASET_FORMAT_VERSION,
+        'input_file': file_digest(conllu_file_path),
+        'training': training,
+    }
+    key_items.update(get_feature_info(args, tokenizer_vocab_file, graph_vocab_file, pos_list_file))
+    key_string = json.dumps(key_items, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(key_string.encode('utf-8')).hexdigest()[:16]
+
+
+def get_cache_paths(cached_dir, conllu_file_path, feature_cache_key) -> Tuple[pathlib.Path, pathlib.Path]:
+    """
+        得到特征数据集缓存（目录）以及conllu文件缓存的路径，
+        conllu文件缓存只依赖于输入文件的内容
+
+    :return: (cached_dataset, cached_conllu)
+    """
+    cached_dir = pathlib.Path(cached_dir)
+    file_name = pathlib.Path(conllu_file_path).name
+    cached_dataset = cached_dir / f'{file_name}-{feature_cache_key}-dataset.mmap.cache'
+    cached_conllu = cached_dir / f'{file_name}-{file_digest(conllu_file_path)[:16]}-conllu.columnar.pickle.cache'
+    return cached_dataset, cached_conllu
+
+
+if __name__ == '__main__':
+    pass
@@ -1,40 +1,75 @@
 # -*- coding: utf-8 -*-
 # Created by li huayong on 2019/9/24
+import numpy as np
+
+from utils.data.id_map import IdMap
 
 
 class GraphVocab(object):
     def __init__(self, vocab_file):
-        self.id2unit = ['<EMPTY>', '<UNK>']
         with open(vocab_file, encoding='utf-8')as f:
-            for line in f:
-                if line.strip() not in self.id2unit:
-                    self.id2unit.append(line.strip())
-        self.unit2id = {u: i for i, u in enumerate(self.id2unit)}
+            self.id_map = IdMap(['<EMPTY>', '<UNK>'] + [line.strip() for line in f])
+        self.id2unit = self.id_map.id2unit
+        self.unit2id = self.id_map.unit2id
 
     def get_labels(self):
         return self.id2unit
 
+    def graph_to_arcs_batch(self, sem_graph: np.ndarray, sentence_lengths):
+        """
+            直接从解码得到的语义图生成conllu的 head、deprel、deps 三列
+            （等价于 parse_to_arcs_batch(parse_semgraph(sem_graph, sentence_lengths))，但依存弧的查找和标签的解码都是批量完成的）
+
+        :param sem_graph: sdp_decoder的结果 (batch_size x seq_len x seq_len)，[b, dependent, head] 为 标签id+1，0表示没有依存弧
+        :param sentence_lengths: 每个句子的长度（包含ROOT）
+        :return: 每个句子每个单词的 (head, deprel, deps)
+        """
+        lengths = np.asarray(sentence_lengths, dtype=np.int64)
+        batch_idx, dep_idx, head_idx = np.nonzero(sem_graph)
+        keep = (dep_idx >= 1) & (dep_idx < lengths[batch_idx]) & (head_idx < lengths[batch_idx])
+        batch_idx, dep_idx, head_idx = batch_idx[keep], dep_idx[keep], head_idx[keep]
+        deprels = self.id_map.decode(sem_graph[batch_idx, dep_idx, head_idx] - 1).tolist()
+        heads = head_idx.tolist()
+        arc_strings = [f'{head}:{deprel}' for head, deprel in zip(heads, deprels)]
+        # np.nonzero按行优先的顺序返回，同一个单词的依存弧是连续的，且按head从小到大排列
+        word_keys = batch_idx * sem_graph.shape[1] + dep_idx
+        group_starts = np.flatnonzero(np.diff(word_keys, prepend=-1)).tolist()
+        group_ends = group_starts[1:] + [len(arc_strings)]
+        sents = [[('_', '_', '_')] * (length - 1) for length in lengths.tolist()]
+        for start, end, b, d in zip(group_starts, group_ends, batch_idx[group_starts].tolist(),
+                                    dep_idx[group_starts].tolist()):
+            sents[b][d - 1] = (str(heads[start]), deprels[start], '|'.join(arc_strings[start:end]))
+        return sents
+
     def parse_to_sent_batch(self, inputs):
         sents = []
         for s in inputs:
             words = []
             for w in s:
-                arc = []
-                for a in w:
-                    head = str(a[0])
-                    deprel = self.id2unit[a[1]]
-                    arc.append([head, deprel])
-                if len(arc) == 1:
-                    string = ':'.join(arc[0])
-                    words.append(string)
-                else:
-                    string = ''
-                    for item in arc:
-                        string += ':'.join(item) + '|'
-                    words.append(string[:-1])
+                words.append('|'.join(f'{a[0]}:{self.id2unit[a[1]]}' for a in w))
             sents.append(words)
         return sents
 
+    def parse_to_arcs_batch(self, inputs):
+        """
+            将预测的依存弧转换为conllu的 head、deprel、deps 三列，
+            head和deprel取第一条弧（和 CoNLLFile.set(['deps'], ...) 一致），写入时不需要再切分deps
+
+        :param inputs: parse_semgraph的结果，每个单词为 [[head_idx, label_idx], ...]
+        :return: 每个句子每个单词的 (head, deprel, deps)
+        """
+        id2unit = self.id2unit
+        sents = []
+        for s in inputs:
+            words = []
+            for w in s:
+                if not w:
+                    words.append(('_', '_', '_'))
+                    continue
+                arcs = [(str(head), id2unit[label]) for head, label in w]
+                words.append((arcs[0][0], arcs[0][1], '|'.join(f'{head}:{deprel}' for head, deprel in arcs)))
+            sents.append(words)
+        return sents
 
 if __name__ == '__main__':
     vocab = GraphVocab('../dataset/graph_vocab.txt')
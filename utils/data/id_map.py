@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Created by li huayong on 2020/4/27
+"""
+    基于dict/numpy数组的 字符串<->id 映射表，支持对整个numpy数组批量编码/解码
+"""
+from typing import Iterable, List
+
+import numpy as np
+
+# BERT BasicTokenizer 中的CJK字符范围（参考 pytorch_transformers.tokenization_bert.BasicTokenizer._is_chinese_char）
+_CJK_RANGES = (
+    (0x4E00, 0x9FFF),
+    (0x3400, 0x4DBF),
+    (0x20000, 0x2A6DF),
+    (0x2A700, 0x2B73F),
+    (0x2B740, 0x2B81F),
+    (0x2B820, 0x2CEAF),
+    (0xF900, 0xFAFF),
+    (0x2F800, 0x2FA1F),
+)
+
+
+def is_cjk_char(char: str) -> bool:
+    cp = ord(char)
+    for start, end in _CJK_RANGES:
+        if start <= cp <= end:
+            return True
+    return False
+
+
+class IdMap(object):
+    """
+        字符串与id之间的映射：
+        编码使用dict（O(1)），批量编码时只对输入中不同的字符串查表；
+        解码使用object类型的numpy数组，直接用id数组做索引
+    """
+
+    def __init__(self, units: Iterable[str], unk: str = None):
+        """
+
+        :param units: 按id顺序排列的字符串，重复的字符串只保留第一次出现的位置
+        :param unk: 不在映射表中的字符串编码为unk的id，为None时遇到未知字符串抛出KeyError
+        """
+        self.id2unit: List[str] = list(dict.fromkeys(units))
+        self.unit2id = {u: i for i, u in enumerate(self.id2unit)}
+        self.unk_id = self.unit2id[unk] if unk is not None else None
+        self._id2unit_array = np.array(self.id2unit, dtype=object)
+
+    def __len__(self):
+        return len(self.id2unit)
+
+    def __contains__(self, unit):
+        return unit in self.unit2id
+
+    def get_id(self, unit: str) -> int:
+        if self.unk_id is None:
+            return self.unit2id[unit]
+        return self.unit2id.get(unit, self.unk_id)
+
+    def encode(self, units) -> np.ndarray:
+        """
+            批量编码
+        :param units: 字符串列表或者numpy数组（任意形状）
+        :return: int64数组，形状和输入一致
+        """
+        units = np.asarray(units, dtype=object)
+        if units.size == 0:
+            return np.zeros(units.shape, dtype=np.int64)
+        uniques, inverse = np.unique(units, return_inverse=True)
+        unique_ids = np.fromiter((self.get_id(u) for u in uniques.tolist()), dtype=np.int64, count=len(uniques))
+        return unique_ids[inverse].reshape(units.shape)
+
+    def decode(self, ids) -> np.ndarray:
+        """
+            批量解码
+        :param ids: int数组（任意形状）
+        :return: object数组，形状和输入一致
+        """
+        return self._id2unit_array[np.asarray(ids, dtype=np.int64)]
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Created by li huayong on 2020/4/28
+import torch
+
+
+class DevicePrefetcher(object):
+    """
+        包装DataLoader，把batch（tensor的tuple）拷贝到device上：
+        device为CUDA时，在当前batch计算的同时，用单独的CUDA stream把下一个batch异步（non_blocking）拷贝到GPU，
+        拷贝不再阻塞每个step的开始；其他device时退化为同步的 .to(device)
+
+        注意：异步拷贝要求CPU上的tensor位于pinned memory，
+        DataLoader应该设置pin_memory=True（否则这里会在主进程中逐个pin，速度较慢）
+    """
+
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.data_loader:
+                yield tuple(t.to(self.device) for t in batch)
+            return
+        stream = torch.cuda.Stream(device=self.device)
+        batch_iter = iter(self.data_loader)
+        next_batch = self._preload(batch_iter, stream)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            # 计算之前等待拷贝完成
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            for t in batch:
+                # 告诉caching allocator这些显存被当前stream使用，避免被提前复用
+                t.record_stream(current_stream)
+            next_batch = self._preload(batch_iter, stream)
+            yield batch
+
+    def _preload(self, batch_iter, stream):
+        try:
+            batch = next(batch_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            return tuple((t if t.is_pinned() else t.pin_memory()).to(self.device, non_blocking=True) for t in batch)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# Created by li huayong on 2020/4/29
+"""
+    超出内存的训练语料（例如几十GB的自动分析语料）：
+    预先切分、转换为一个目录下的多个shard（每个shard是一个 RaggedTensorDataset.save_to_dir 保存的目录），
+    训练时以IterableDataset的方式流式读取，内存占用只和shuffle buffer的大小有关
+"""
+import json
+import math
+import pathlib
+from typing import Dict, List
+
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+
+from utils.data.batch_sampler import get_dist_info
+from utils.data.custom_dataset import RaggedTensorDataset, RAGGED_DATASET_FORMAT_VERSION
+
+SHARDS_MANIFEST_FILE = 'shards.json'
+
+
+def get_shard_name(shard_idx: int) -> str:
+    return f'shard-{shard_idx:05d}'
+
+
+def write_shards_manifest(shards_dir, shard_sizes: List[int], feature_info: Dict = None):
+    """
+        所有shard写入完成之后写入manifest，记录每个shard的样本数量（用于估计epoch长度和划分数据），
+        以及生成这些shard时的特征配置（训练时检查是否和当前配置一致）
+    """
+    shards_dir = pathlib.Path(shards_dir)
+    manifest = {
+        'version': RAGGED_DATASET_FORMAT_VERSION,
+        'shards': [{'dir': get_shard_name(i), 'size': int(size)} for i, size in enumerate(shard_sizes)],
+        'size': int(sum(shard_sizes)),
+        'feature_info': feature_info or {},
+    }
+    with open(str(shards_dir / SHARDS_MANIFEST_FILE), 'w', encoding='utf-8')as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def load_shards_manifest(shards_dir) -> Dict:
+    manifest_file = pathlib.Path(shards_dir) / SHARDS_MANIFEST_FILE
+    if not manifest_file.is_file():
+        raise RuntimeError(f'{shards_dir} 中没有 {SHARDS_MANIFEST_FILE}，请先用 build_train_shards.py 生成shard')
+    with open(str(manifest_file), encoding='utf-8')as f:
+        manifest = json.load(f)
+    if manifest['version'] != RAGGED_DATASET_FORMAT_VERSION:
+        raise RuntimeError(f'不支持的shard格式版本:{manifest["version"]}')
+    return manifest
+
+
+class ShardedIterableDataset(IterableDataset):
+    r"""
+    流式读取shard目录的训练数据集，每次产生一个batch（样本dict的列表，由 BERTologyCollator 完成padding）：
+    （1）所有shard首尾相连，按固定的大小（参考 _block_size）切分为块，块可以跨越shard的边界
+    （2）每个epoch用 seed+epoch 打乱块的顺序（所有进程、所有worker一致），
+        打乱后的块依次均分给分布式训练的各个进程 x DataLoader的各个worker，每个worker只读取分配给自己的部分
+    （3）每个worker顺序读取自己的数据（memmap，按块读取），经过一个大小有限的shuffle buffer打乱之后组成batch
+    （4）所有worker每个epoch读取相同数量的样本：样本总数//worker总数（与epoch无关，参考 _worker_quota），
+        每个epoch最多丢弃 worker总数-1 个样本（不超过一个块），并且丢弃的样本每个epoch都不同，
+        保证分布式训练时各个进程的step数量相同，并且每个epoch的batch数量都等于__len__
+
+    注意：
+    DataLoader必须设置batch_size=None，num_workers必须和这里的num_workers一致（用于划分数据和计算epoch长度，
+    不一致时__iter__会报错）
+    每个epoch开始时需要调用set_epoch
+    """
+
+    def __init__(self, shards_dir, batch_size: int, shuffle_buffer_size: int = 10000, shuffle: bool = True,
+                 seed: int = 0, num_workers: int = 0, read_block_size: int = 1024,
+                 num_replicas: int = None, rank: int = None):
+        """
+
+        :param shards_dir: build_train_shards.py 生成的目录
+        :param batch_size: 每个batch的句子数量
+        :param shuffle_buffer_size: shuffle buffer中最多保存的样本数量，<=1 则不打乱样本（仍然打乱shard顺序）
+        :param shuffle: 是否打乱
+        :param seed: 随机种子
+        :param num_workers: DataLoader的worker数量
+        :param read_block_size: 每次从shard中连续读取的样本数量
+        :param num_replicas: 分布式训练的进程数量，默认自动获取
+        :param rank: 当前进程的rank，默认自动获取
+        """
+        super().__init__()
+        self.shards_dir = pathlib.Path(shards_dir)
+        self.manifest = load_shards_manifest(self.shards_dir)
+        self.shard_sizes = [s['size'] for s in self.manifest['shards']]
+        if not self.shard_sizes:
+            raise RuntimeError(f'{shards_dir} 中没有任何shard')
+        self.batch_size = batch_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_workers = max(1, num_workers)
+        self.read_block_size = read_block_size
+        self.num_replicas, self.rank = get_dist_info(num_replicas, rank)
+        self.epoch = 0
+
+    @property
+    def feature_info(self) -> Dict:
+        return self.manifest['feature_info']
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _worker_quota(self, total_workers: int) -> int:
+        """
+            每个worker每个epoch读取的样本数量
+        """
+        quota = sum(self.shard_sizes) // total_workers
+        if quota <= 0:
+            raise RuntimeError(f'样本数量（{sum(self.shard_sizes)}）少于worker总数（{total_workers}）')
+        return quota
+
+    def _block_size(self, total_workers: int) -> int:
+        """
+            块的大小：不超过read_block_size以及每个worker的样本数量，
+            并且不小于worker总数（每个epoch丢弃的样本少于worker总数，因此不超过一个块）
+        """
+        return max(total_workers, min(self.read_block_size, self._worker_quota(total_workers)))
+
+    def _locate(self, start: int, end: int):
+        """
+            所有shard首尾相连之后的样本区间[start, end)对应的 (shard下标, 开始, 结束) 列表
+        """
+        offsets = np.cumsum([0] + self.shard_sizes)
+        shard_idx = int(np.searchsorted(offsets, start, side='right')) - 1
+        pieces = []
+        while start < end:
+            piece_end = min(end, int(offsets[shard_idx + 1]))
+            if piece_end > start:
+                pieces.append((shard_idx, start - int(offsets[shard_idx]), piece_end - int(offsets[shard_idx])))
+            start = piece_end
+            shard_idx += 1
+        return pieces
+
+    def _plan_epoch(self, num_workers: int):
+        """
+            规划当前epoch：每个worker（全局编号 rank*num_workers+worker_id）读取的 (shard下标, 开始, 结束) 列表，
+            以及每个worker读取的样本数量
+        """
+        total_workers = self.num_replicas * num_workers
+        total = sum(self.shard_sizes)
+        quota = self._worker_quota(total_workers)
+        block_size = self._block_size(total_workers)
+        assert quota * total_workers >= total - block_size
+        block_num = math.ceil(total / block_size)
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch).permutation(block_num).tolist()
+        else:
+            order = list(range(block_num))
+        # 打乱后的块首尾相连，第i个worker读取其中的[i*quota, (i+1)*quota)
+        plans = [[] for _ in range(total_workers)]
+        position = 0
+        for block_idx in order:
+            start, end = block_idx * block_size, min((block_idx + 1) * block_size, total)
+            while start < end and position < quota * total_workers:
+                worker = position // quota
+                take = min(end - start, (worker + 1) * quota - position)
+                plans[worker].extend(self._locate(start, start + take))
+                start += take
+                position += take
+        return plans, quota
+
+    def __len__(self):
+        """
+            当前进程每个epoch的batch数量（每个epoch都相同，可作为学习率schedule的epoch长度）
+        """
+        quota = self._worker_quota(self.num_replicas * self.num_workers)
+        return self.num_workers * math.ceil(quota / self.batch_size)
+
+    def _iter_samples(self, plan, quota: int):
+        """
+            按顺序读取分配给当前worker的样本（最多quota个），每次从memmap中连续读取一块并复制到内存中
+        """
+        remaining = quota
+        shards = {}
+        for shard_idx, start, end in plan:
+            if remaining <= 0:
+                return
+            if shard_idx not in shards:
+                shards[shard_idx] = RaggedTensorDataset.load_from_dir(
+                    self.shards_dir / self.manifest['shards'][shard_idx]['dir'])
+            shard = shards[shard_idx]
+            end = min(end, start + remaining)
+            for block_start in range(start, end, self.read_block_size):
+                block = shard.get_batch(np.arange(block_start, min(block_start + self.read_block_size, end)))
+                splits = {name: np.split(np.array(values), np.cumsum(lengths)[:-1])
+                          for name, (values, lengths) in block.items()}
+                for i in range(len(next(iter(splits.values())))):
+                    yield {name: parts[i] for name, parts in splits.items()}
+            remaining -= end - start
+
+    def _shuffle(self, samples, rng: np.random.RandomState):
+        """
+            大小有限的shuffle buffer：buffer满了之后，每读入一个样本就随机替换出buffer中的一个样本
+        """
+        if not self.shuffle or self.shuffle_buffer_size <= 1:
+            yield from samples
+            return
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(sample)
+                continue
+            idx = rng.randint(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        if num_workers != self.num_workers:
+            raise RuntimeError(f'DataLoader的worker数量（{num_workers}）必须和ShardedIterableDataset的num_workers'
+                               f'（{self.num_workers}）一致，否则epoch长度与实际的batch数量不一致')
+        plans, quota = self._plan_epoch(num_workers)
+        global_worker_id = self.rank * num_workers + worker_id
+        rng = np.random.RandomState([self.seed, self.epoch, global_worker_id])
+        batch = []
+        for sample in self._shuffle(self._iter_samples(plans[global_worker_id], quota), rng):
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Created by li huayong on 2020/4/27
+import unicodedata
+from collections import OrderedDict
+from typing import List, Tuple
+
+from pytorch_transformers import BertTokenizer
+
+from utils.data.id_map import is_cjk_char
+
+
+class WordTokenCache(object):
+    """
+        以单词为key的有界LRU缓存，保存单词切分之后的sub-token id：
+        语料（以及线上的输入）中相同的单词会反复出现，按单词缓存之后只有第一次出现时需要调用tokenizer
+
+        句子的token序列由各个单词的token拼接得到，所以单词的token数量和切分结果始终一致，
+        特征转换和单词开始/结束位置的计算共用同一份结果
+    """
+
+    def __init__(self, tokenizer, max_size: int = 100000):
+        """
+
+        :param tokenizer: BERTology tokenizer
+        :param max_size: 最多缓存的单词数量，<=0 时不缓存（只统计）
+        """
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # 切分结果为空的单词（例如只包含控制字符）用[UNK]表示，保证每个单词至少对应一个token
+        self._unk_ids = tuple(tokenizer.convert_tokens_to_ids([tokenizer.unk_token]))
+        # 中文BERT的词表以字为单位，BasicTokenizer会把每个CJK字符单独切开，
+        # 所以全部由CJK字符组成的单词可以直接逐字查表（不需要经过BasicTokenizer和WordPiece）
+        use_basic_tokenizer = isinstance(tokenizer, BertTokenizer) and getattr(tokenizer, 'do_basic_tokenize', True)
+        self._char_vocab = tokenizer.vocab if use_basic_tokenizer else None
+        # do_lower_case时BasicTokenizer会先做NFD（去掉重音符号），
+        # CJK兼容表意文字（U+F900–U+FAFF、U+2F800–U+2FA1F）会被映射为对应的统一表意文字，查表之前必须做同样的变换
+        self._nfd = use_basic_tokenizer and getattr(getattr(tokenizer, 'basic_tokenizer', None), 'do_lower_case', False)
+
+    def get(self, word: str) -> Tuple[int, ...]:
+        """
+            单词的sub-token id
+        """
+        ids = self._cache.get(word)
+        if ids is not None:
+            self._cache.move_to_end(word)
+            self.hits += 1
+            return ids
+        self.misses += 1
+        ids = self._cjk_char_ids(word)
+        if ids is None:
+            ids = tuple(self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(word))) or self._unk_ids
+        if self.max_size > 0:
+            self._cache[word] = ids
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return ids
+
+    def _cjk_char_ids(self, word: str):
+        """
+            全部由CJK字符组成的单词：逐字查表（do_lower_case时先做NFD，不在词表中的字为[UNK]，
+            和 BasicTokenizer + WordPiece 的结果一致）；其他单词返回None
+        """
+        # CJK范围内未分配的码位（类别Cn）会被BasicTokenizer当作控制字符删除，这样的单词交给tokenizer处理
+        if self._char_vocab is None or not word or \
+                not all(is_cjk_char(c) and not unicodedata.category(c).startswith('C') for c in word):
+            return None
+        if self._nfd:
+            # CJK字符的NFD只会把兼容表意文字逐个替换为统一表意文字，字数不变
+            word = unicodedata.normalize('NFD', word)
+        unk_id = self._unk_ids[0]
+        return tuple(self._char_vocab.get(c, unk_id) for c in word)
+
+    def token_num(self, word: str) -> int:
+        return len(self.get(word))
+
+    def encode_words(self, words: List[str]) -> Tuple[List[int], List[int]]:
+        """
+            切分一个单词序列
+        :return: (拼接之后的token id, 每个单词的token数量)
+        """
+        input_ids = []
+        token_nums = []
+        for word in words:
+            ids = self.get(word)
+            input_ids += ids
+            token_nums.append(len(ids))
+        return input_ids, token_nums
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def stats(self) -> str:
+        return f'word token cache: size {len(self._cache)}/{self.max_size}, ' \
+               f'hits {self.hits}, misses {self.misses}, hit rate {self.hit_rate:.2%}'
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+
+if __name__ == '__main__':
+    pass
@@ -11,4 +11,4 @@
 -------------------------------------------------
 """
 from .sort import unsort, sort, tensor_unsort
-from .parser_funs import sdp_decoder, parse_semgraph
+from .parser_funs import sdp_decoder, sdp_decoder_from_heads, sdp_decoder_heads, parse_semgraph
@@ -19,6 +19,32 @@ def sdp_decoder(semgraph_probs, sentlens):
     semhead_probs type:ndarray, shape:(n,m,m)
     '''
     semhead_probs = semgraph_probs.sum(axis=-1)
+    # (n x m x m x c) -> (n x m x m)
+    semrel_preds = np.argmax(semgraph_probs, axis=-1)
+    return sdp_decoder_from_heads(semhead_probs, semrel_preds, sentlens)
+
+
+def sdp_decoder_from_heads(semhead_probs, semrel_preds, sentlens):
+    '''
+    不需要 (n x m x m x c) 的概率：
+    semhead_probs type:ndarray, shape:(n,m,m)，依存弧的概率（PAD位置为0）
+    semrel_preds type:ndarray, shape:(n,m,m)，每个位置对概率最大的标签id
+    注意：semhead_probs会被修改
+    '''
+    masked_semhead_preds = sdp_decoder_heads(semhead_probs, sentlens)
+    # (n x m x m) (*) (n x m x m) -> (n x m x m)
+    semgraph_preds = masked_semhead_preds * semrel_preds
+    result = masked_semhead_preds + semgraph_preds
+    return result
+
+
+def sdp_decoder_heads(semhead_probs, sentlens):
+    '''
+    只解码依存弧（不包含标签）：
+    semhead_probs type:ndarray, shape:(n,m,m)，依存弧的概率（PAD位置为0）
+    return: (n,m,m)，1表示存在依存弧
+    注意：semhead_probs会被修改
+    '''
     semhead_preds = np.where(semhead_probs >= 0.5, 1, 0)
     masked_semhead_preds = np.zeros(semhead_preds.shape, dtype=np.int32)
     for i, (sem_preds, length) in enumerate(zip(semhead_preds, sentlens)):
@@ -47,12 +73,7 @@ def sdp_decoder(semgraph_probs, sentlens):
                 semhead_probs[i, j, j] = 0
                 new_head = np.argmax(semhead_probs[i, j, 1:length]) + 1
                 masked_semhead_preds[i, j, new_head] = 1
-    # (n x m x m x c) -> (n x m x m)
-    semrel_preds = np.argmax(semgraph_probs, axis=-1)
-    # (n x m x m) (*) (n x m x m) -> (n x m x m)
-    semgraph_preds = masked_semhead_preds * semrel_preds
-    result = masked_semhead_preds + semgraph_preds
-    return result
+    return masked_semhead_preds
 
 
 def parse_semgraph(semgraph, sentlens):